@@ -70,7 +70,7 @@ from collectivevariable import (
     FunctionCV, MDTrajFunctionCV, MSMBFeaturizerCV,
     InVolumeCV, CollectiveVariable, CoordinateGeneratorCV,
     CoordinateFunctionCV, CallableCV, PyEMMAFeaturizerCV,
-    GeneratorCV)
+    GeneratorCV, DerivedCV, CoordinateArrayCV, evaluate_cvs)
 
 from ensemble import (
     Ensemble, EnsembleCombination, EnsembleFactory, EntersXEnsemble,
@@ -140,9 +140,10 @@ from storage.storage import Storage, AnalysisStorage
 
 from volume import (
     Volume, VolumeCombination, VolumeFactory, VoronoiVolume,
+    KDTreeVoronoiVolume,
     EmptyVolume, FullVolume, CVDefinedVolume, PeriodicCVDefinedVolume,
     IntersectionVolume, UnionVolume, SymmetricDifferenceVolume,
-    RelativeComplementVolume, join_volumes
+    RelativeComplementVolume, CompiledVolume, join_volumes
 )
 
 from high_level import move_strategy as strategies
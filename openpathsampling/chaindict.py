@@ -1,7 +1,7 @@
 import collections
 import numpy as np
 
-from openpathsampling.netcdfplus import LoaderProxy
+from openpathsampling.netcdfplus import LoaderProxy, StorableObject
 
 __author__ = 'Jan-Hendrik Prinz'
 
@@ -52,9 +52,16 @@ class ChainDict(object):
     ----------
     _post : ChainDict
         the ChainDict to be called when this instance cannot evaluate given keys
+    pass_arrays : bool
+        if `True` and none of the keys is known here, the result of `_post`
+        is returned as is (e.g. a numpy array) instead of a list. Only use
+        this if the result is converted anyway, e.g. by a `MergeNumpy` in
+        front, otherwise the type of the result depends on the cache
 
     """
 
+    pass_arrays = False
+
     def __init__(self):
         self._post = None
 
@@ -72,6 +79,11 @@ class ChainDict(object):
                 rep = self._post[nones]
                 self._set_list(nones, rep)
 
+                if self.pass_arrays and len(nones) == len(results):
+                    # nothing was known here, so pass on the result as is
+                    # (e.g. a numpy array) without splitting it into a list
+                    return rep
+
                 it = iter(rep)
                 return [it.next() if p[1] is None else p[1]
                         for p in zip(items, results)]
@@ -287,6 +299,24 @@ class Function(ChainDict):
     Uses a regular function to evaluate given keys.
 
     This works effective like a function called with square brackets
+
+    Attributes
+    ----------
+    executor : object or None
+        if not `None` an object with a `map(fnc, iterable)` method, e.g. a
+        `multiprocessing.Pool` or `multiprocessing.pool.ThreadPool`. Lists
+        of more than `chunk_size` keys are then split into chunks that are
+        evaluated by `executor.map` and merged again in order.
+    chunk_size : int
+        the maximal number of keys evaluated in one chunk by the executor
+    chunk_evaluator : callable or None
+        the function passed to `executor.map` to evaluate a list of keys.
+        If `None` the (serial) `evaluate` of this dict is used. Process
+        pools need a function that can be pickled instead.
+    chunk_encoder : callable or None
+        if not `None` each chunk is passed through this function in this
+        process before it is handed to the executor, e.g. to pickle it
+        here so that `chunk_evaluator` gets errors while unpickling
     """
     def __init__(
             self,
@@ -313,6 +343,10 @@ class Function(ChainDict):
         self._eval = fnc
         self.requires_lists = requires_lists
         self.scalarize_numpy_singletons = scalarize_numpy_singletons
+        self.executor = None
+        self.chunk_size = 1000
+        self.chunk_evaluator = None
+        self.chunk_encoder = None
 
     def _get(self, item):
         if self._eval is None:
@@ -333,6 +367,58 @@ class Function(ChainDict):
         if self._eval is None:
             return [None] * len(items)
 
+        if self.executor is not None and len(items) > self.chunk_size:
+            return self._evaluate_chunked(items)
+
+        return self.evaluate(items)
+
+    def _evaluate_chunked(self, items):
+        """
+        Evaluate a list of keys in chunks using the executor
+
+        Returns
+        -------
+        list of object or numpy.ndarray
+            the results in the order of `items`
+        """
+        # load proxies here: the workers cannot access the storage
+        items = [
+            item.__subject__ if type(item) is LoaderProxy else item
+            for item in items
+        ]
+        chunks = [
+            items[pos:pos + self.chunk_size]
+            for pos in range(0, len(items), self.chunk_size)
+        ]
+
+        if self.chunk_encoder is not None:
+            chunks = map(self.chunk_encoder, chunks)
+
+        evaluator = self.chunk_evaluator
+        if evaluator is None:
+            evaluator = self.evaluate
+
+        results = list(self.executor.map(evaluator, chunks))
+
+        if all(isinstance(result, np.ndarray) for result in results):
+            return np.concatenate(results)
+        else:
+            return [value for result in results for value in result]
+
+    def evaluate(self, items):
+        """
+        Evaluate the function for a list of keys in this process
+
+        Parameters
+        ----------
+        items : list of object
+            the keys to be evaluated
+
+        Returns
+        -------
+        list of object or numpy.ndarray
+            the values for all keys
+        """
         if self.requires_lists:
             results = self._eval(items)
 
@@ -383,6 +469,13 @@ class CacheChainDict(ChainDict):
         except KeyError:
             return None
 
+    def _get_list(self, items):
+        if hasattr(self.cache, 'get_list'):
+            # caches that can look up many keys at once
+            return self.cache.get_list(items)
+
+        return [self._get(item) for item in items]
+
     def _set(self, item, value):
         self.cache[item] = value
 
@@ -390,6 +483,12 @@ class CacheChainDict(ChainDict):
 class ReversibleCacheChainDict(CacheChainDict):
     """
     Return Values from a cache filled from the underlying CD
+
+    If the CV is reversible and the cache is keyed by UUIDs (its
+    `uuid_keys` is `True`), an object and its reversed share a single entry
+    under their `StorableObject.pair_uuid`. Values are then found for both
+    orientations without the reversed object being created. Otherwise the
+    reversed object is only tried if it already exists.
     """
     def __init__(self, cache, reversible=False):
         """
@@ -401,10 +500,27 @@ class ReversibleCacheChainDict(CacheChainDict):
         super(ReversibleCacheChainDict, self).__init__(cache)
         self.reversible = reversible
 
+    @property
+    def pair_keys(self):
+        """
+        bool : if `True` values are stored by the UUID of the pair
+        """
+        return self.reversible and getattr(self.cache, 'uuid_keys', False)
+
+    @staticmethod
+    def _pair_key(item):
+        return StorableObject.pair_uuid(getattr(item, '__uuid__', item))
+
     def _get(self, item):
         if item is None:
             return None
 
+        if self.pair_keys:
+            try:
+                return self.cache[self._pair_key(item)]
+            except KeyError:
+                return None
+
         try:
             return self.cache[item]
         except KeyError:
@@ -416,6 +532,26 @@ class ReversibleCacheChainDict(CacheChainDict):
             else:
                 return None
 
+    def _get_list(self, items):
+        if self.pair_keys:
+            return [self._get(item) for item in items]
+
+        results = super(ReversibleCacheChainDict, self)._get_list(items)
+        if self.reversible and hasattr(self.cache, 'get_list'):
+            # the bulk lookup does not try the reversed items
+            results = [
+                self._get(item) if value is None else value
+                for item, value in zip(items, results)
+            ]
+
+        return results
+
+    def _set(self, item, value):
+        if self.pair_keys:
+            self.cache[self._pair_key(item)] = value
+        else:
+            self.cache[item] = value
+
 
 class StoredDict(ChainDict):
     """
@@ -439,10 +575,13 @@ class StoredDict(ChainDict):
         return
 
     def _get(self, item):
-        return self.value_store.get(item)
+        # a background writer might use the storage at the same time
+        with self.value_store.storage.lock:
+            return self.value_store.get(item)
 
     def _get_list(self, items):
-        return map(self._get, items)
+        with self.value_store.storage.lock:
+            return map(self.value_store.get, items)
 
     def sync(self):
         pass
@@ -1,9 +1,56 @@
+import cPickle
+import functools
+import multiprocessing
+import multiprocessing.pool
+import traceback
+from contextlib import contextmanager
+
 import chaindict as cd
 from openpathsampling.netcdfplus import StorableNamedObject, WeakKeyCache, \
     ObjectJSON, create_to_dict
 
 import openpathsampling.engines as peng
-from openpathsampling.engines.openmm.tools import trajectory_to_mdtraj
+from openpathsampling.engines.openmm.tools import mdtraj_conversion_cache
+
+
+# CVs rebuilt inside of worker processes, by the UUID of the original CV
+_worker_cvs = {}
+
+
+def _encode_chunk(items):
+    """
+    Pickle a chunk of snapshots for `_evaluate_in_worker`
+    """
+    return cPickle.dumps(items, cPickle.HIGHEST_PROTOCOL)
+
+
+def _evaluate_in_worker(cv_json, uuid, chunk):
+    """
+    Evaluate a chunk of snapshots with a CV inside of a worker process
+
+    The CV is rebuilt from its JSON representation once per process, in the
+    same way it would be restored from storage. The snapshots are unpickled
+    here (and not by the pool) so that failures are reported and do not
+    leave the pool waiting for a lost task.
+
+    Raises
+    ------
+    RuntimeError
+        if the CV cannot be rebuilt or evaluated. It contains the traceback
+        of the worker as a string, so it can always be sent back to the
+        main process
+    """
+    try:
+        cv = _worker_cvs.get(uuid)
+        if cv is None:
+            cv = ObjectJSON().from_json(cv_json)
+            _worker_cvs[uuid] = cv
+
+        return cv._eval_dict.evaluate(cPickle.loads(chunk))
+    except Exception:
+        raise RuntimeError(
+            'Evaluation in a worker process failed:\n%s' %
+            traceback.format_exc())
 
 
 # ==============================================================================
@@ -101,6 +148,56 @@ class CollectiveVariable(cd.Wrap, StorableNamedObject):
         self.diskcache_enabled = False
         return self
 
+    def set_cache(self, cache):
+        """
+        Replace the cache of computed values
+
+        By default values are kept in a :class:`WeakKeyCache`, so values
+        are lost once a snapshot is removed from memory and the cache has
+        no size limit. A :class:`openpathsampling.netcdfplus.UUIDLRUCache`
+        keeps values by UUID with a limited number of values or bytes and
+        can share a :class:`openpathsampling.netcdfplus.ByteBudget` with
+        the caches of other CVs.
+
+        Parameters
+        ----------
+        cache : :class:`openpathsampling.netcdfplus.Cache`
+            the new cache. Values of the current cache are transferred if
+            the new cache can hold them
+
+        Returns
+        -------
+        :class:`openpathsampling.CollectiveVariable`
+            the CV itself
+
+        """
+        old_cache = self._cache_dict.cache
+        if old_cache is cache:
+            return self
+
+        # the replaced cache must not count for a budget anymore, otherwise
+        # its values evict the ones copied into the new cache
+        budget = getattr(old_cache, 'budget', None)
+        if budget is not None:
+            budget.unregister(old_cache)
+
+        self._cache_dict.cache = cache
+
+        # set the values through the chaindict so they use its keys. LRU
+        # caches iterate the oldest values first, so these are evicted
+        # first if the new cache is smaller
+        for key in list(old_cache):
+            try:
+                self._cache_dict._set(key, old_cache[key])
+            except (KeyError, TypeError, AttributeError):
+                # e.g. weak caches cannot hold values keyed by uuid
+                pass
+
+        if budget is not None:
+            old_cache.clear()
+
+        return self
+
     def set_cache_store(self, value_store):
         """
         Attach store variables to the collective variables.
@@ -116,6 +213,7 @@ class CollectiveVariable(cd.Wrap, StorableNamedObject):
 
         """
         self._store_dict = cd.StoredDict(value_store)
+        self._store_dict.pass_arrays = self._cache_dict.pass_arrays
         # hook_store = self._single_dict
         hook_store = self._cache_dict
         self._store_dict._post = hook_store._post
@@ -317,8 +415,85 @@ class CallableCV(CollectiveVariable):
             # noinspection PyTypeChecker
             post = cd.MergeNumpy() > post
 
+            # results are numpy arrays anyway, so arrays from the function
+            # do not need to be split into lists on the way
+            self._cache_dict.pass_arrays = True
+
         self._post = post
 
+    def set_executor(self, executor, chunk_size=None):
+        """
+        Evaluate missing values in parallel chunks using an executor
+
+        Parameters
+        ----------
+        executor : object or None
+            an object with a `map(fnc, iterable)` method like a
+            `multiprocessing.Pool` or `multiprocessing.pool.ThreadPool`.
+            `None` returns to serial evaluation. For all executors other
+            than a `ThreadPool` the CV is rebuilt in the workers from its
+            JSON representation (as if it were loaded from storage), so it
+            must be storable, and the snapshots must be picklable. Errors
+            in the workers are raised as `RuntimeError`.
+        chunk_size : int or None
+            the maximal number of snapshots evaluated in one call. Lists
+            with fewer missing snapshots are evaluated serially. If `None`
+            the current value is kept.
+        """
+        self._eval_dict.executor = executor
+        if chunk_size is not None:
+            self._eval_dict.chunk_size = chunk_size
+
+        if executor is None or \
+                isinstance(executor, multiprocessing.pool.ThreadPool):
+            self._eval_dict.chunk_evaluator = None
+            self._eval_dict.chunk_encoder = None
+        else:
+            self._eval_dict.chunk_encoder = _encode_chunk
+            self._eval_dict.chunk_evaluator = functools.partial(
+                _evaluate_in_worker,
+                ObjectJSON().to_json_object(self),
+                self.__uuid__
+            )
+
+    @contextmanager
+    def parallel(self, processes=None, backend='process', chunk_size=None):
+        """
+        Context manager to evaluate the CV in parallel using a local pool
+
+        Examples
+        --------
+        >>> with cv.parallel(processes=16, chunk_size=500):
+        >>>     values = cv(storage.snapshots)
+
+        Parameters
+        ----------
+        processes : int or None
+            the number of workers, `None` uses the number of cpus
+        backend : str
+            `process` for a `multiprocessing.Pool` or `thread` for a
+            `multiprocessing.pool.ThreadPool`. Threads only help if the
+            CV function releases the GIL (like most numpy or mdtraj code)
+        chunk_size : int or None
+            the maximal number of snapshots evaluated in one call
+        """
+        if backend == 'process':
+            pool = multiprocessing.Pool(processes)
+        elif backend == 'thread':
+            pool = multiprocessing.pool.ThreadPool(processes)
+        else:
+            raise ValueError(
+                'backend must be `process` or `thread`, not %s' % backend)
+
+        old_chunk_size = self._eval_dict.chunk_size
+        self.set_executor(pool, chunk_size)
+        try:
+            yield self
+        finally:
+            self.set_executor(None, old_chunk_size)
+            pool.close()
+            pool.join()
+
     def to_dict(self):
         dct = super(CallableCV, self).to_dict()
         callable_argument = self.__class__.args()[2]
@@ -472,6 +647,222 @@ class CoordinateFunctionCV(FunctionCV):
         return dct
 
 
+class CoordinateArrayCV(CallableCV):
+    """Make a `CollectiveVariable` from a function of a coordinate array.
+
+    The function is called once for all missing snapshots with their
+    coordinates (without units) stacked into a single array of shape
+    `(n_frames, n_atoms, n_spatial)` and must return an array with one
+    value (or row) per frame. Simple geometric CVs can so be evaluated with
+    a single vectorized numpy call instead of one call per snapshot.
+
+    Examples
+    --------
+    >>> def distance(xyz, pair):
+    >>>     import numpy as np
+    >>>     delta = xyz[:, pair[0], :] - xyz[:, pair[1], :]
+    >>>     return np.sqrt((delta ** 2).sum(axis=-1))
+    >>> cv = CoordinateArrayCV("d", distance, pair=[0, 1])
+
+    Attributes
+    ----------
+    cv_callable
+    """
+
+    def __init__(
+            self,
+            name,
+            f,
+            cv_wrap_numpy_array=True,
+            cv_scalarize_numpy_singletons=False,
+            **kwargs
+    ):
+        """
+        Parameters
+        ----------
+        name : str
+        f : callable
+            the function called as `f(xyz, **kwargs)`
+        cv_wrap_numpy_array
+        cv_scalarize_numpy_singletons
+        kwargs
+        """
+        super(CoordinateArrayCV, self).__init__(
+            name,
+            cv_callable=f,
+            cv_time_reversible=True,
+            cv_requires_lists=True,
+            cv_wrap_numpy_array=cv_wrap_numpy_array,
+            cv_scalarize_numpy_singletons=cv_scalarize_numpy_singletons,
+            **kwargs
+        )
+
+    @property
+    def f(self):
+        return self.cv_callable
+
+    def _eval(self, items):
+        xyz = peng.Trajectory(items).xyz
+        return self.cv_callable(xyz, **self.kwargs)
+
+    def to_dict(self):
+        dct = super(CoordinateArrayCV, self).to_dict()
+        del dct['cv_time_reversible']
+        del dct['cv_requires_lists']
+        return dct
+
+
+class DerivedCV(CallableCV):
+    """Make a `CollectiveVariable` from the values of other CVs.
+
+    The input CVs are evaluated for the whole list of missing snapshots
+    through their own caches, and `f` is called with their values. An
+    expensive intermediate (e.g. all pairwise distances) can so be
+    computed once by one CV and shared by all CVs derived from it.
+
+    Examples
+    --------
+    >>> distances = MDTrajFunctionCV(
+    >>>     "d", md.compute_distances, topology, atom_pairs=pairs)
+    >>> contacts = DerivedCV(
+    >>>     "contacts", lambda d: (d < 0.5).sum(), [distances])
+    >>> min_dist = DerivedCV("min_d", lambda d: d.min(), [distances])
+
+    Attributes
+    ----------
+    inputs : list of :class:`openpathsampling.CollectiveVariable`
+        the CVs whose values are passed to `f`
+    """
+
+    def __init__(
+            self,
+            name,
+            f,
+            inputs,
+            cv_time_reversible=None,
+            cv_requires_lists=False,
+            cv_wrap_numpy_array=False,
+            **kwargs
+    ):
+        """
+        Parameters
+        ----------
+        name : str
+        f : callable
+            the function called with the values of all inputs, in order,
+            and the `kwargs`
+        inputs : list of :class:`openpathsampling.CollectiveVariable`
+            the CVs this CV depends on
+        cv_time_reversible : bool or None
+            if `None` the CV is time reversible if all inputs are
+        cv_requires_lists : bool
+            if `True` `f` is called once with the lists of values of all
+            missing snapshots, otherwise once per snapshot
+        cv_wrap_numpy_array
+        kwargs
+        """
+        self.inputs = list(inputs)
+        if cv_time_reversible is None:
+            cv_time_reversible = all(
+                cv.cv_time_reversible for cv in self.inputs)
+
+        super(DerivedCV, self).__init__(
+            name,
+            cv_callable=f,
+            cv_time_reversible=cv_time_reversible,
+            cv_requires_lists=cv_requires_lists,
+            cv_wrap_numpy_array=cv_wrap_numpy_array,
+            **kwargs
+        )
+
+        # the inputs are always evaluated for all missing snapshots at once
+        self._eval_dict.requires_lists = True
+
+    @property
+    def f(self):
+        return self.cv_callable
+
+    def _eval(self, items):
+        values = [cv(items) for cv in self.inputs]
+        if self.cv_requires_lists:
+            return self.cv_callable(*values, **self.kwargs)
+        else:
+            return [
+                self.cv_callable(*row, **self.kwargs)
+                for row in zip(*values)
+            ]
+
+    def to_dict(self):
+        dct = super(DerivedCV, self).to_dict()
+        del dct['cv_scalarize_numpy_singletons']
+        dct['inputs'] = self.inputs
+        return dct
+
+
+def cv_dependency_order(cvs):
+    """
+    Sort CVs and all their (indirect) inputs so that inputs come first
+
+    Parameters
+    ----------
+    cvs : list of :class:`openpathsampling.CollectiveVariable`
+
+    Returns
+    -------
+    list of :class:`openpathsampling.CollectiveVariable`
+        every CV of the graph once, each after all of its inputs
+    """
+    order = []
+    visited = set()
+    in_progress = set()
+
+    def visit(cv):
+        if cv in visited:
+            return
+        if cv in in_progress:
+            raise ValueError('CV %s depends on itself' % cv.name)
+
+        in_progress.add(cv)
+        for cv_input in getattr(cv, 'inputs', []):
+            visit(cv_input)
+
+        in_progress.remove(cv)
+        visited.add(cv)
+        order.append(cv)
+
+    for cv in cvs:
+        visit(cv)
+
+    return order
+
+
+def evaluate_cvs(cvs, items):
+    """
+    Evaluate several CVs for a batch of snapshots
+
+    All CVs and their inputs are evaluated once for the whole batch in
+    dependency order, so each shared input fills its cache before the CVs
+    derived from it need it.
+
+    Parameters
+    ----------
+    cvs : list of :class:`openpathsampling.CollectiveVariable`
+        the CVs to be evaluated
+    items : iterable of :class:`openpathsampling.engines.BaseSnapshot`
+        the snapshots
+
+    Returns
+    -------
+    list
+        the values of each CV for all snapshots
+    """
+    items = list(items)
+    for cv in cv_dependency_order(cvs):
+        cv(items)
+
+    return [cv(items) for cv in cvs]
+
+
 class GeneratorCV(CallableCV):
     """Turn a callable class or function generating a callable object into a CV
 
@@ -618,6 +1009,9 @@ class MDTrajFunctionCV(CoordinateFunctionCV):
         ----------
         name : str
         f
+            a function of an `mdtraj.Trajectory`. The trajectory is shared
+            with other CVs (see `mdtraj_conversion_cache`), so `f` must not
+            change it in place, e.g. by `superpose`; work on a copy instead
         topology : :obj:`openpathsampling.engines.openmm.MDTopology`
             the mdtraj topology wrapper from OPS that is used to initialize
             the featurizer in `pyemma.coordinates.featurizer(topology)`
@@ -646,7 +1040,7 @@ class MDTrajFunctionCV(CoordinateFunctionCV):
     def _eval(self, items):
         trajectory = peng.Trajectory(items)
 
-        t = trajectory_to_mdtraj(trajectory, self.topology.mdtraj)
+        t = mdtraj_conversion_cache(trajectory, self.topology.mdtraj)
         return self.cv_callable(t, **self.kwargs)
 
     @property
@@ -738,7 +1132,7 @@ class MSMBFeaturizerCV(CoordinateGeneratorCV):
         trajectory = peng.Trajectory(items)
 
         # create an MDtraj trajectory out of it
-        ptraj = trajectory_to_mdtraj(trajectory, self.topology.mdtraj)
+        ptraj = mdtraj_conversion_cache(trajectory, self.topology.mdtraj)
 
         # run the featurizer
         return self._instance.partial_transform(ptraj)
@@ -822,7 +1216,7 @@ class PyEMMAFeaturizerCV(MSMBFeaturizerCV):
     def _eval(self, items):
         trajectory = peng.Trajectory(items)
 
-        t = trajectory_to_mdtraj(trajectory, self.topology.mdtraj)
+        t = mdtraj_conversion_cache(trajectory, self.topology.mdtraj)
         return self._instance.transform(t)
 
     def to_dict(self):
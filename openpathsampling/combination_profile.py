@@ -0,0 +1,136 @@
+'''
+Runtime statistics for the short-circuit evaluation of logical combinations.
+
+Combinations of ensembles and volumes only evaluate their second part if
+the first part does not already decide the result. For commutative
+combinations (`and`, `or`), the order of the parts does not change the
+result, but it can change the cost a lot: a cheap test that often decides
+the result should run first. The :class:`ShortCircuitProfile` measures the
+mean evaluation time of both parts and how often each of them decides the
+result, and from that picks the cheaper order.
+
+The statistics are used by :class:`openpathsampling.EnsembleCombination`
+and :class:`openpathsampling.VolumeCombination` if their `profiling` or
+`reorder` attributes are set.
+'''
+
+import time
+
+
+class ShortCircuitProfile(object):
+    """
+    Timing and selectivity of the two parts of a logical combination
+
+    The expected cost of evaluating part `i` first is the mean time of part
+    `i` plus the mean time of the other part, weighted by the fraction of
+    evaluations where part `i` did not decide the result.
+
+    Parameters
+    ----------
+    fnc : callable
+        the combination function; takes the two results as bools
+    min_samples : int
+        number of evaluations of each part that are needed before the order
+        is changed
+
+    Attributes
+    ----------
+    n_evaluated : list of int
+        number of evaluations (of frames, for masks) of each part
+    total_time : list of float
+        total time spent in each part (seconds)
+    n_decided : list of int
+        number of evaluations where the result of the part alone decided
+        the result of the combination
+    swapped : bool
+        `True` if the second part should be evaluated first
+    """
+    def __init__(self, fnc, min_samples=20):
+        self.fnc = fnc
+        self.min_samples = min_samples
+        self.n_evaluated = [0, 0]
+        self.total_time = [0.0, 0.0]
+        self.n_decided = [0, 0]
+        self.swapped = False
+
+    def decides(self, value):
+        """
+        bool : `True` if the result is the same whatever the other part is
+        """
+        return self.fnc(value, True) == self.fnc(value, False)
+
+    def record(self, part, elapsed, n_evaluated, n_decided):
+        """
+        Add the statistics of one evaluation of a part
+
+        Parameters
+        ----------
+        part : 0 or 1
+            which part of the combination was evaluated
+        elapsed : float
+            time spent for the evaluation
+        n_evaluated : int
+            number of evaluated items (1 for a single test)
+        n_decided : int
+            number of items for which the part decided the result
+        """
+        self.total_time[part] += elapsed
+        self.n_evaluated[part] += n_evaluated
+        self.n_decided[part] += n_decided
+
+    def evaluate(self, part, fnc, *args):
+        """
+        Call `fnc(*args)` for the given part and record its statistics
+
+        Returns
+        -------
+        the result of `fnc(*args)`
+        """
+        start = time.time()
+        value = fnc(*args)
+        elapsed = time.time() - start
+        self.record(part, elapsed, 1, int(self.decides(bool(value))))
+        return value
+
+    def mean_time(self, part):
+        """float : mean evaluation time of the part"""
+        if self.n_evaluated[part] == 0:
+            return 0.0
+        return self.total_time[part] / self.n_evaluated[part]
+
+    def decided_fraction(self, part):
+        """float : fraction of evaluations where the part decided"""
+        if self.n_evaluated[part] == 0:
+            return 0.0
+        return float(self.n_decided[part]) / self.n_evaluated[part]
+
+    def expected_cost(self, first):
+        """float : expected time of the combination if `first` runs first"""
+        other = 1 - first
+        return (self.mean_time(first) +
+                (1.0 - self.decided_fraction(first)) * self.mean_time(other))
+
+    def update_order(self):
+        """
+        Choose the order with the lower expected cost
+
+        The order is only changed once both parts have been evaluated at
+        least `min_samples` times. (If the first part always decides, the
+        second is never evaluated and the order is kept.)
+
+        Returns
+        -------
+        bool
+            the new value of `swapped`
+        """
+        if min(self.n_evaluated) >= self.min_samples:
+            self.swapped = self.expected_cost(1) < self.expected_cost(0)
+        return self.swapped
+
+    def __str__(self):
+        return '\n'.join(
+            'part {0}: {1} evaluations, {2:.3g} s mean, {3:.1%} decided'
+            .format(part, self.n_evaluated[part], self.mean_time(part),
+                    self.decided_fraction(part))
+            for part in [0, 1]
+        )
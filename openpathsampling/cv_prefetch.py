@@ -0,0 +1,241 @@
+'''
+Background computation of collective variables for new snapshots.
+
+While an engine integrates the next frame (e.g. an OpenMM context running on
+a GPU) the CPU is mostly idle. A :class:`CVPrefetcher` attached to the
+engine receives every new snapshot and evaluates a list of CVs for it in a
+background thread. The values end up in the caches of the CVs.
+
+Only CVs whose values are not needed right away profit from this. The
+stopping conditions of the ensembles evaluate each new frame immediately
+after it was generated, so their CVs would be computed twice. The typical
+candidates are the CVs the storage completes when a snapshot is saved, see
+:meth:`CVPrefetcher.for_storage`.
+
+Thread safety
+-------------
+The caches of CVs are not thread-safe. The prefetcher holds its `lock` while
+it evaluates and the engine holds it while it checks the stopping
+conditions. Other threads that use the CVs while a trajectory is generated
+have to hold it as well. The engine also removes the CVs of its stopping
+conditions from the prefetcher (see :meth:`CVPrefetcher.exclude`) and waits
+for the prefetcher before it returns the trajectory. CVs reading from their
+disk cache hold the lock of the storage.
+'''
+
+import logging
+import threading
+import Queue
+
+from openpathsampling.collectivevariable import CollectiveVariable
+from openpathsampling.netcdfplus import StorableObject
+
+logger = logging.getLogger(__name__)
+
+
+def find_collectivevariables(objects):
+    """
+    Return all CVs that are used (directly or indirectly) by the objects
+
+    The objects are searched like they would be stored, by following the
+    content of their `to_dict`.
+
+    Parameters
+    ----------
+    objects : list of :class:`openpathsampling.netcdfplus.StorableObject`
+        the objects, e.g. ensembles or volumes, to be searched
+
+    Returns
+    -------
+    list of :class:`openpathsampling.CollectiveVariable`
+        the found CVs in order of appearance
+    """
+    found = []
+    visited = set()
+
+    def search(obj):
+        if isinstance(obj, CollectiveVariable):
+            if obj not in found:
+                found.append(obj)
+        elif isinstance(obj, StorableObject):
+            if id(obj) in visited:
+                return
+            visited.add(id(obj))
+            search(obj.to_dict())
+        elif isinstance(obj, dict):
+            map(search, obj.values())
+        elif isinstance(obj, (list, tuple)):
+            map(search, obj)
+
+    search(list(objects))
+    return found
+
+
+class CVPrefetcher(object):
+    """
+    Evaluate a list of CVs for submitted snapshots in a background thread
+
+    Examples
+    --------
+    >>> engine.prefetcher = CVPrefetcher.for_storage(
+    >>>     storage, exclude=[network])
+    >>> # ... run the simulation
+    >>> engine.prefetcher.stop()
+
+    Attributes
+    ----------
+    cvs : list of :class:`openpathsampling.CollectiveVariable`
+        the CVs to be computed for each snapshot
+    batch_size : int
+        the maximal number of snapshots evaluated in one call of a CV
+    errors : list of Exception
+        the errors raised by the CVs. A CV that fails is not evaluated by
+        the prefetcher again
+    lock : threading.RLock
+        held while the CVs are evaluated
+    """
+
+    def __init__(self, cvs, batch_size=100):
+        """
+        Parameters
+        ----------
+        cvs : list of :class:`openpathsampling.CollectiveVariable`
+            the CVs to be computed
+        batch_size : int
+            the maximal number of snapshots evaluated in one call of a CV
+        """
+        self.cvs = list(cvs)
+        self.batch_size = batch_size
+        self.errors = []
+        self.lock = threading.RLock()
+        self._excluded = []
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    @classmethod
+    def for_storage(cls, storage, exclude=None, batch_size=100):
+        """
+        Create a prefetcher for the CVs completed when saving snapshots
+
+        Parameters
+        ----------
+        storage : :class:`openpathsampling.storage.Storage`
+            the storage whose CVs without `allow_incomplete` are computed
+        exclude : list of :class:`openpathsampling.netcdfplus.StorableObject`
+            objects, e.g. the ensembles of the stopping conditions, whose
+            CVs are evaluated for each frame anyway and are left out
+        batch_size : int
+
+        Returns
+        -------
+        :class:`CVPrefetcher`
+        """
+        cvs = [
+            cv for cv, (cv_store, cv_idx)
+            in storage.snapshots.cv_list.items()
+            if not cv_store.allow_incomplete
+        ]
+        prefetcher = cls(cvs, batch_size)
+        prefetcher.exclude(exclude or [])
+        return prefetcher
+
+    def exclude(self, objects):
+        """
+        Stop prefetching the CVs used by the given objects
+
+        The engine calls this with its stopping conditions, since their CVs
+        are evaluated for each frame right away.
+
+        Parameters
+        ----------
+        objects : list of :class:`openpathsampling.netcdfplus.StorableObject`
+            the objects, e.g. ensembles, or bound methods of these, like
+            `ensemble.can_append`
+        """
+        objects = [getattr(obj, '__self__', obj) for obj in objects]
+        new = [
+            obj for obj in objects
+            if not any(obj is other for other in self._excluded)]
+        if not new:
+            return
+
+        self._excluded.extend(new)
+        excluded = find_collectivevariables(new)
+        with self.lock:
+            self.cvs = [cv for cv in self.cvs if cv not in excluded]
+
+    @property
+    def running(self):
+        """bool : `True` if the background thread is running"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Start the background thread (done automatically by `submit`)
+        """
+        if not self.running:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def submit(self, snapshot):
+        """
+        Queue a snapshot for the computation of all CVs
+
+        Parameters
+        ----------
+        snapshot : :class:`openpathsampling.engines.BaseSnapshot`
+        """
+        self.start()
+        self._queue.put(snapshot)
+
+    def wait(self):
+        """
+        Block until all submitted snapshots are processed
+        """
+        self._queue.join()
+
+    def stop(self):
+        """
+        Process all submitted snapshots and stop the background thread
+        """
+        if self.running:
+            self._queue.put(None)
+            self._thread.join()
+
+        self._thread = None
+
+    def _run(self):
+        while True:
+            snapshot = self._queue.get()
+            batch = [snapshot]
+            # take all snapshots that are already waiting
+            while snapshot is not None and len(batch) < self.batch_size:
+                try:
+                    snapshot = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                batch.append(snapshot)
+
+            snapshots = [snap for snap in batch if snap is not None]
+            if snapshots:
+                self._evaluate(snapshots)
+
+            for _ in batch:
+                self._queue.task_done()
+
+            if len(snapshots) < len(batch):
+                # the stop signal
+                return
+
+    def _evaluate(self, snapshots):
+        for cv in list(self.cvs):
+            try:
+                with self.lock:
+                    cv(snapshots)
+            except Exception as e:
+                logger.warning(
+                    'CV %s failed in the prefetcher and will not be '
+                    'prefetched any more: %s' % (cv.name, e))
+                self.errors.append(e)
+                self.cvs.remove(cv)
@@ -7,6 +7,7 @@ Created on 01.07.2014
 
 import logging
 import sys
+from contextlib import contextmanager
 
 import simtk.unit as u
 
@@ -91,6 +92,11 @@ class DynamicsEngine(StorableNamedObject):
         4.  a callable will be used as a function to generate the new from the
             old trajectories, e.g. `lambda t: t[:10]` would restart with the
             first 10 frames
+    prefetcher : :class:`openpathsampling.cv_prefetch.CVPrefetcher` or None
+        if set, every new snapshot is submitted to it, so it can compute
+        CVs in the background while the next frame is generated. The CVs
+        of the stopping conditions are removed from it and the engine waits
+        for it before the trajectory is returned
 
     Notes
     -----
@@ -120,6 +126,8 @@ class DynamicsEngine(StorableNamedObject):
 
     base_snapshot_type = BaseSnapshot
 
+    prefetcher = None
+
     def __init__(self, options=None, descriptor=None):
         """
         Create an empty DynamicsEngine object
@@ -248,6 +256,11 @@ class DynamicsEngine(StorableNamedObject):
             self.options = {}
 
     def __getattr__(self, item):
+        # `descriptor` and `options` are missing until `__init__` ran, e.g.
+        # while unpickling. Looking them up here would recurse forever
+        if item in ['descriptor', 'options'] or item.startswith('__'):
+            raise AttributeError(item)
+
         # first, check for errors that might be shadowed in properties
         if item in self.__class__.__dict__:
             # we should have this attribute
@@ -461,6 +474,10 @@ class DynamicsEngine(StorableNamedObject):
         except TypeError:
             running = [running]
 
+        if self.prefetcher is not None:
+            # the CVs of the stopping conditions are needed right away
+            self.prefetcher.exclude(running)
+
         if hasattr(initial, '__iter__'):
             initial = Trajectory(initial)
         else:
@@ -506,9 +523,10 @@ class DynamicsEngine(StorableNamedObject):
 
             frame = 0
             # maybe we should stop before we even begin?
-            stop = self.stop_conditions(trajectory=trajectory,
-                                        continue_conditions=running,
-                                        trusted=False)
+            with self._prefetcher_lock():
+                stop = self.stop_conditions(trajectory=trajectory,
+                                            continue_conditions=running,
+                                            trusted=False)
 
             log_rate = 10
             has_nan = False
@@ -563,7 +581,11 @@ class DynamicsEngine(StorableNamedObject):
                 if direction > 0:
                     trajectory.append(snapshot)
                 elif direction < 0:
-                    trajectory.insert(0, snapshot.reversed)
+                    snapshot = snapshot.reversed
+                    trajectory.insert(0, snapshot)
+
+                if self.prefetcher is not None:
+                    self.prefetcher.submit(snapshot)
 
                 if 0 < max_length < len(trajectory):
                     # hit the max length criterion
@@ -594,8 +616,10 @@ class DynamicsEngine(StorableNamedObject):
 
                 if stop is False:
                     # Check if we should stop. If not, continue simulation
-                    stop = self.stop_conditions(trajectory=trajectory,
-                                            continue_conditions=running)
+                    with self._prefetcher_lock():
+                        stop = self.stop_conditions(
+                            trajectory=trajectory,
+                            continue_conditions=running)
 
             if has_nan:
                 on = self.on_nan
@@ -628,6 +652,10 @@ class DynamicsEngine(StorableNamedObject):
 
             self.stop(trajectory)
 
+        if self.prefetcher is not None:
+            # afterwards the prefetched CVs can be used in this thread
+            self.prefetcher.wait()
+
         if errors:
             logger.info('Errors occurred during generation :')
             for no, e in enumerate(errors):
@@ -641,6 +669,15 @@ class DynamicsEngine(StorableNamedObject):
         logger.info("Finished trajectory, length: %d", len(trajectory))
         yield trajectory
 
+    @contextmanager
+    def _prefetcher_lock(self):
+        # the CV caches must not be used by the prefetcher at the same time
+        if self.prefetcher is None:
+            yield
+        else:
+            with self.prefetcher.lock:
+                yield
+
     def generate_next_frame(self):
         raise NotImplementedError('Next frame generation must be implemented!')
 
@@ -148,7 +148,7 @@ class StaticContainerStore(ObjectStore):
         if atom_indices is None:
             atom_indices = slice(None)
 
-        variable = self.storage.variables[self.prefix + '_coordinates']
+        variable = self.variables['coordinates']
 
         return variable[frame_indices, atom_indices, :].astype(
             np.float32).copy()
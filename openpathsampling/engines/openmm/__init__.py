@@ -5,7 +5,9 @@ from tools import (
     snapshot_from_testsystem,
     to_openmm_topology,
     trajectory_from_mdtraj,
-    trajectory_to_mdtraj
+    trajectory_to_mdtraj,
+    MDTrajConversionCache,
+    mdtraj_conversion_cache
 )
 
 import features
@@ -1,3 +1,6 @@
+from collections import OrderedDict
+import threading
+
 import mdtraj as md
 import numpy as np
 import simtk.unit as u
@@ -326,4 +329,78 @@ def trajectory_to_mdtraj(trajectory, md_topology=None):
     # traj = md.Trajectory(output, md_topology)
     # traj.unitcell_vectors = trajectory.box_vectors
     return trajectory.to_mdtraj(md_topology)
-                         
+
+
+class MDTrajConversionCache(object):
+    """
+    A small LRU cache of `mdtraj.Trajectory` objects built from snapshots
+
+    CVs that work on `mdtraj.Trajectory` objects are usually evaluated for
+    the same list of snapshots one after another. The cache keeps the last
+    conversions keyed by the UUIDs of the snapshots and the topology, so
+    all these CVs share a single conversion.
+
+    The returned objects are shared by all callers and must not be changed.
+    Functions like `superpose` or `center_coordinates` work in place, so
+    use them on a copy, e.g. `md_trajectory[:]`.
+
+    The cache can be used from several threads (e.g. a thread pool executor
+    or the CV prefetcher). A lock guards the cache itself, the conversions
+    run outside of it.
+
+    Attributes
+    ----------
+    size_limit : int
+        the maximal number of conversions kept, 0 disables the cache
+    """
+    def __init__(self, size_limit=4):
+        self.size_limit = size_limit
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, trajectory, md_topology=None):
+        """
+        Return the (possibly cached) `mdtraj.Trajectory` for the snapshots
+
+        Parameters
+        ----------
+        trajectory : :obj:`openpathsampling.engines.Trajectory` or list
+            the snapshots to be converted
+        md_topology : :obj:`mdtraj.Topology` or None
+            the topology, if `None` the topology of the snapshots is used
+
+        Returns
+        -------
+        :obj:`mdtraj.Trajectory`
+        """
+        if self.size_limit <= 0:
+            return trajectory_to_mdtraj(trajectory, md_topology)
+
+        key = (
+            tuple(snapshot.__uuid__ for snapshot in trajectory),
+            id(md_topology)
+        )
+
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is not None and entry[0] is md_topology:
+                self._cache[key] = entry
+                return entry[1]
+
+        md_trajectory = trajectory_to_mdtraj(trajectory, md_topology)
+
+        with self._lock:
+            # keep the topology to make sure its id is not reused
+            self._cache[key] = (md_topology, md_trajectory)
+            while len(self._cache) > self.size_limit:
+                self._cache.popitem(last=False)
+
+        return md_trajectory
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+#: the conversion cache shared by all mdtraj based CVs
+mdtraj_conversion_cache = MDTrajConversionCache()
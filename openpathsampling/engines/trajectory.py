@@ -359,13 +359,12 @@ class Trajectory(list, StorableObject):
         last_vol = None
         count = 0
         segment_labels = []
-        # list.__iter__ for speed
-        for frame in list.__iter__(self):
-            in_state = []
-            for key in label_dict.keys():
-                vol = label_dict[key]
-                if vol(frame):
-                    in_state.append(key)
+        # evaluate each volume for all frames at once
+        labels = label_dict.keys()
+        masks = [label_dict[key].mask(self) for key in labels]
+        for frame_idx in range(len(self)):
+            in_state = [key for key, mask in zip(labels, masks)
+                        if mask[frame_idx]]
             if len(in_state) > 1:
                 raise RuntimeError(
                     "Volumes given to summarize_by_volumes not disjoint")
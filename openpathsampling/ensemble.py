@@ -6,9 +6,13 @@ Created on 03.09.2014
 
 import logging
 import itertools
+import collections
+import weakref
 
 from openpathsampling.netcdfplus import StorableNamedObject
 import openpathsampling as paths
+from ensemble_labels import LabelEvaluator
+from combination_profile import ShortCircuitProfile
 
 import abc
 
@@ -40,21 +44,76 @@ class EnsembleCache(object):
 
     This object also contains basic functions to manage the cache.
 
+    The cache keeps separate contents for up to `max_size` trajectories,
+    identified by the UUID of their start frame (the first frame for
+    forward caches, the final frame for backward caches) and the direction.
+    The attributes always refer to the trajectory that was checked last;
+    the least recently checked trajectory is dropped if there are too many.
+    This way, trajectories that are alternately extended (e.g., forward and
+    backward segments, or several slices of one trajectory) don't reset
+    each other's cache.
+
     Attributes
     ----------
+        max_size : int
+            maximal number of trajectories with cached contents
         start_frame : :class:`openpathsampling.snapshot.Snapshot`
         prev_last_frame : :class:`openpathsampling.snapshot.Snapshot`
+        prev_last_index : int
+            index of `prev_last_frame` in the last checked trajectory; this
+            saves searching the trajectory for it
         direction : +1 or -1
         contents : dictionary
     """
 
-    def __init__(self, direction=None):
+    def __init__(self, direction=None, max_size=8):
         self.start_frame = None
         self.prev_last_frame = None
+        self.prev_last_index = None
         self.last_length = None
         self.direction = direction
         self.contents = {}
         self.trusted = False
+        self.max_size = max_size
+        self._key = None
+        self._inactive = collections.OrderedDict()
+
+    _slot_attributes = ['start_frame', 'prev_last_frame', 'prev_last_index',
+                        'last_length', 'contents']
+
+    def _activate(self, trajectory):
+        """Makes the slot for the start frame of `trajectory` the active one
+        """
+        if self.direction > 0:
+            start_frame = trajectory.get_as_proxy(0)
+        elif self.direction < 0:
+            start_frame = trajectory.get_as_proxy(-1)
+        else:
+            self.bad_direction_error()
+
+        # frames without UUID are identified by id; this is unique as long
+        # as the slot (which holds the start frame) exists
+        key = (getattr(start_frame, '__uuid__', id(start_frame)),
+               self.direction)
+        if key == self._key:
+            return
+
+        if self._key is not None:
+            self._inactive[self._key] = {
+                attr: getattr(self, attr) for attr in self._slot_attributes
+            }
+
+        slot = self._inactive.pop(key, None)
+        if slot is None:
+            slot = {attr: None for attr in self._slot_attributes}
+            slot['contents'] = {}
+        for attr in self._slot_attributes:
+            setattr(self, attr, slot[attr])
+        self._key = key
+
+        # the active slot counts towards max_size
+        while self._inactive and len(self._inactive) >= self.max_size:
+            self._inactive.popitem(last=False)
 
     def bad_direction_error(self):
         raise RuntimeError("EnsembleCache.direction = " +
@@ -101,6 +160,8 @@ class EnsembleCache(object):
         logger.debug("prev_last " + str(id(self.prev_last_frame)))
 
         if trajectory is not None:
+            if len(trajectory) > 0:
+                self._activate(trajectory)
             # if the first frame has changed, we should reset
             if reset is None:
                 lentraj = len(trajectory)
@@ -160,8 +221,10 @@ class EnsembleCache(object):
         # other things as well
         if self.direction > 0:
             self.prev_last_frame = trajectory.get_as_proxy(-1)
+            self.prev_last_index = len(trajectory) - 1
         elif self.direction < 0:
             self.prev_last_frame = trajectory.get_as_proxy(0)
+            self.prev_last_index = 0
         else:
             self.bad_direction_error()
 
@@ -185,6 +248,19 @@ class Ensemble(StorableNamedObject):
     >>>     True
     >>>     )
 
+    Attributes
+    ----------
+    use_frame_labels : bool
+        if `True` (default), searches for subtrajectories and untrusted
+        calls of sequential ensembles use precomputed volume labels of all
+        frames whenever the ensemble allows it. Set to `False` to always use
+        the ensemble functions directly.
+    memoize : bool
+        if `True`, :meth:`.check` remembers its results for the last
+        `memo_size` trajectories. Default is `False`.
+    memo_size : int
+        number of trajectories with remembered results (per ensemble)
+
     Notes
     -----
     Maybe replace - by / to get better notation. So far it has not been used
@@ -192,6 +268,10 @@ class Ensemble(StorableNamedObject):
 
     __metaclass__ = abc.ABCMeta
 
+    use_frame_labels = True
+    memoize = False
+    memo_size = 100
+
     def __init__(self):
         """
         A path volume defines a set of paths.
@@ -225,8 +305,87 @@ class Ensemble(StorableNamedObject):
     def check_reverse(self, trajectory, trusted=False):
         return self(trajectory, trusted=False)
 
+    def _frame_label_evaluator(self):
+        """
+        :class:`.LabelEvaluator` of this ensemble, or None if the ensemble
+        can not be evaluated from frame labels. Created on first use.
+        """
+        try:
+            return self._label_evaluator
+        except AttributeError:
+            self._label_evaluator = LabelEvaluator.from_ensemble(self)
+            return self._label_evaluator
+
     def check(self, trajectory):
-        return self(trajectory, trusted=False)
+        """
+        Untrusted test whether the trajectory is in the ensemble
+
+        If `memoize` is set, the result is remembered for this trajectory
+        object. The memo only keeps weak references to the trajectories and
+        holds at most `memo_size` results.
+
+        Trajectories that are changed in place (like the trajectory which is
+        extended in `DynamicsEngine.iter_generate`) are recognized by their
+        length and their first and final frame: if any of these changed, the
+        result is computed again. Other changes in place require a call to
+        :meth:`.clear_memo`.
+
+        Parameters
+        ----------
+        trajectory : :class:`.Trajectory`
+            the trajectory to test
+
+        Returns
+        -------
+        bool
+            same as `self(trajectory, trusted=False)`
+        """
+        if not self.memoize:
+            return self(trajectory, trusted=False)
+
+        try:
+            memo = self._memo
+        except AttributeError:
+            memo = self._memo = collections.OrderedDict()
+
+        key = id(trajectory)
+        fingerprint = self._memo_fingerprint(trajectory)
+        entry = memo.pop(key, None)
+        if entry is not None:
+            (traj_ref, (length, first, final), result) = entry
+            if (traj_ref() is trajectory and length == fingerprint[0] and
+                    first is fingerprint[1] and final is fingerprint[2]):
+                memo[key] = entry
+                return result
+
+        result = self(trajectory, trusted=False)
+        try:
+            traj_ref = weakref.ref(trajectory)
+        except TypeError:
+            # trajectory can not be referenced weakly: nothing to remember
+            return result
+
+        memo[key] = (traj_ref, fingerprint, result)
+        while len(memo) > self.memo_size:
+            memo.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _memo_fingerprint(trajectory):
+        """
+        Length, first and final frame of the trajectory (as stored, without
+        loading proxies)
+        """
+        if len(trajectory) == 0:
+            return (0, None, None)
+        return (len(trajectory), list.__getitem__(trajectory, 0),
+                list.__getitem__(trajectory, -1))
+
+    def clear_memo(self):
+        """
+        Forget all results remembered by :meth:`.check`
+        """
+        self._memo = collections.OrderedDict()
 
     def trajectory_summary(self, trajectory):
         """
@@ -379,6 +538,26 @@ class Ensemble(StorableNamedObject):
         list of `slice`
             Returns a list of index-slices for sub-trajectories in
             trajectory that are in the ensemble.
+
+        Notes
+        -----
+        If the ensemble only depends on the volumes that the frames are in
+        (see :mod:`openpathsampling.ensemble_labels`), all frames are
+        labeled once and the slices are found from the labels.
+        """
+        if self.use_frame_labels and len(trajectory) > 0:
+            evaluator = self._frame_label_evaluator()
+            if evaluator is not None:
+                return evaluator.iter_valid_slices(
+                    trajectory, max_length, min_length, overlap, reverse)
+
+        return self._iter_valid_slices(
+            trajectory, max_length, min_length, overlap, reverse)
+
+    def _iter_valid_slices(self, trajectory, max_length, min_length,
+                           overlap, reverse):
+        """
+        Implementation of `iter_valid_slices` using the ensemble functions
         """
         length = len(trajectory)
 
@@ -1219,8 +1398,25 @@ class NegatedEnsemble(Ensemble):
 class EnsembleCombination(Ensemble):
     """
     Logical combination of two ensembles
+
+    Attributes
+    ----------
+    profiling : bool
+        if `True`, record the evaluation time of both ensembles and how
+        often each decides the result (see :meth:`.short_circuit_profile`).
+        Default is `False`.
+    reorder : bool
+        if `True`, commutative combinations evaluate the ensemble with the
+        lower expected cost first, based on the recorded statistics. This
+        implies `profiling`. Default is `False`.
+    commutative : bool
+        whether the order of the two ensembles can be changed
     """
 
+    profiling = False
+    reorder = False
+    commutative = False
+
     def __init__(self, ensemble1, ensemble2, fnc, str_fnc):
         super(EnsembleCombination, self).__init__()
         self.ensemble1 = ensemble1
@@ -1253,8 +1449,13 @@ class EnsembleCombination(Ensemble):
         trusted : bool
             the `trusted` flag to send to f1 and f2
         fname : string
-            name of the functions f1 and f2. Only used in debug output.
+            name of the functions f1 and f2. Used in debug output and to
+            keep separate statistics for each function when profiling.
         """
+        if self.profiling or self.reorder:
+            return self._profiled_short_circuit(f1, f2, trajectory, trusted,
+                                                fname)
+
         logger.debug("Combination is " + self.__class__.__name__)
         a = f1(trajectory, trusted)
         if logger.isEnabledFor(logging.DEBUG):  # pragma: no cover
@@ -1279,6 +1480,46 @@ class EnsembleCombination(Ensemble):
             #              str(b) + str(self.fnc(a,b)))
             return self.fnc(a, b)
 
+    def short_circuit_profile(self, fname="__call__"):
+        """
+        Statistics of the two ensembles for one of the functions
+
+        Parameters
+        ----------
+        fname : string
+            name of the function, e.g. `__call__` or `can_append`
+
+        Returns
+        -------
+        :class:`.ShortCircuitProfile`
+            the statistics; empty unless `profiling` or `reorder` is set
+        """
+        try:
+            profiles = self._short_circuit_profiles
+        except AttributeError:
+            profiles = self._short_circuit_profiles = {}
+        if fname not in profiles:
+            profiles[fname] = ShortCircuitProfile(self.fnc)
+        return profiles[fname]
+
+    def _profiled_short_circuit(self, f1, f2, trajectory, trusted, fname):
+        """
+        Short-circuit logic which records the statistics of f1 and f2, and
+        changes their order if `reorder` is set
+        """
+        profile = self.short_circuit_profile(fname)
+        functions = [f1, f2]
+        first = 0
+        if self.reorder and self.commutative and profile.update_order():
+            first = 1
+        a = profile.evaluate(first, functions[first], trajectory, trusted)
+        if profile.decides(a):
+            return self.fnc(a, True)
+        else:
+            b = profile.evaluate(1 - first, functions[1 - first],
+                                 trajectory, trusted)
+            return self.fnc(a, b)
+
     def __call__(self, trajectory, trusted=None):
         return self._generalized_short_circuit(
             combo=self.fnc,
@@ -1340,6 +1581,8 @@ class EnsembleCombination(Ensemble):
 
 
 class UnionEnsemble(EnsembleCombination):
+    commutative = True
+
     def __init__(self, ensemble1, ensemble2):
         super(UnionEnsemble, self).__init__(ensemble1, ensemble2,
                                             fnc=lambda a, b: a or b,
@@ -1347,6 +1590,8 @@ class UnionEnsemble(EnsembleCombination):
 
 
 class IntersectionEnsemble(EnsembleCombination):
+    commutative = True
+
     def __init__(self, ensemble1, ensemble2):
         super(IntersectionEnsemble, self).__init__(ensemble1, ensemble2,
                                                    fnc=lambda a, b: a and b,
@@ -1531,6 +1776,14 @@ class SequentialEnsemble(Ensemble):
                     return transitions
 
     def __call__(self, trajectory, trusted=None):
+        if not trusted and self.use_frame_labels and len(trajectory) > 0:
+            # label all frames once instead of testing subtrajectories
+            # frame by frame; trusted calls use the caches of the
+            # subensembles instead
+            evaluator = self._frame_label_evaluator()
+            if evaluator is not None:
+                return evaluator(evaluator.label(trajectory))
+
         logger.debug("Looking for transitions in trajectory " + str(trajectory))
         transitions = self.transition_frames(trajectory, trusted)
         logger.debug("Found transitions: " + str(transitions))
@@ -1667,7 +1920,7 @@ class SequentialEnsemble(Ensemble):
         if cache.trusted:
             logger.debug("Cache contents: " + str(cache.contents))
             logger.debug("cache.prev_last_frame: " +
-                         str(trajectory.index(cache.prev_last_frame)))
+                         str(cache.prev_last_index))
         for i in range(len(self.ensembles)):
             ens = self.ensembles[i]
             logger.debug("Ensemble " + str(i) + " : " + ens.__class__.__name__)
@@ -1678,7 +1931,9 @@ class SequentialEnsemble(Ensemble):
                 offset = 0
                 # if cache.last_length == len(trajectory):
                 # offset += 1
-                last_checked = trajectory.index(cache.prev_last_frame) - offset
+                # the cache knows where the last frame is: searching the
+                # trajectory for it would make each call O(len(trajectory))
+                last_checked = cache.prev_last_index - offset
             else:
                 last_checked = None
             logger.debug("last_checked = " + str(last_checked))
@@ -1830,7 +2085,7 @@ class SequentialEnsemble(Ensemble):
         if cache.trusted:
             logger.debug("Cache contents: " + str(cache.contents))
             logger.debug("cache.prev_start_frame: " +
-                         str(trajectory.index(cache.start_frame)))
+                         str(len(trajectory) - 1))
         for i in range(len(self.ensembles)):
             logger.debug(
                 "Ensemble " + str(i) +
@@ -1841,7 +2096,7 @@ class SequentialEnsemble(Ensemble):
             if self._use_cache and cache.trusted:
                 # offset = 1
                 offset = 0
-                last_checked = trajectory.index(cache.prev_last_frame) + offset
+                last_checked = cache.prev_last_index + offset
             else:
                 last_checked = None
             subtraj_first = self._find_subtraj_first(
@@ -2132,10 +2387,9 @@ class AllInXEnsemble(VolumeEnsemble):
         else:
             logger.debug("Untrusted VolumeEnsemble " + repr(self))
             # logger.debug("Trajectory " + repr(trajectory))
-            for frame in trajectory.as_proxies():
-                if not self._volume(frame):
-                    return False
-            return True
+            # evaluate all frames at once: for CV-based volumes this is a
+            # single CV call for the whole trajectory and one array test
+            return bool(self._volume.mask(trajectory).all())
 
     def check_reverse(self, trajectory, trusted=False):
         # order in this one only matters if it is trusted
@@ -0,0 +1,724 @@
+'''
+Fast evaluation of volume-based ensembles on precomputed frame labels.
+
+Many ensembles only depend on which volumes the frames of a trajectory are
+in: `AllInXEnsemble`, `PartInXEnsemble`, `LengthEnsemble`, their
+combinations, and `SequentialEnsemble`s of those (like `TISEnsemble` and
+`MinusInterfaceEnsemble`). For such ensembles, every frame of a trajectory
+can be labeled once with its volume memberships (using `Volume.mask`, which
+evaluates the collective variables for all frames at once). After that,
+every question about a subtrajectory `trajectory[start:end]` can be answered
+from the labels, without creating the subtrajectory and, for the volume
+ensembles, in constant time.
+
+The evaluators in this file reproduce the untrusted behavior of the
+corresponding ensembles exactly. Pieces of an ensemble that don't only
+depend on labels (like `ExitsXEnsemble`) are evaluated with their own
+functions on the subtrajectories, so that the rest of the ensemble can
+still use the labels. Since `start` is fixed in most searches,
+evaluators return the set of all `end` values in a given range for which a
+test is `True`, as a sorted list of half-open intervals `(a, b)`. This
+allows to find the first `end` at which a test fails without testing all
+the `end` values in between.
+
+Tests in the backward direction (`can_prepend` and friends) are done on the
+reversed labels: in the reversed view, `can_append` means `can_prepend` of
+the original trajectory, while `__call__` always refers to the original
+direction of the trajectory.
+'''
+
+import numpy as np
+
+import openpathsampling as paths
+
+
+def _complement(intervals, lo, hi):
+    """Complement of a sorted list of intervals in the range [lo, hi)"""
+    result = []
+    current = lo
+    for (low, high) in intervals:
+        if low > current:
+            result.append((current, low))
+        current = max(current, high)
+    if current < hi:
+        result.append((current, hi))
+    return result
+
+
+def _merge(intervals):
+    """Sorts and merges a list of intervals"""
+    result = []
+    for (low, high) in sorted(intervals):
+        if result and low <= result[-1][1]:
+            result[-1] = (result[-1][0], max(result[-1][1], high))
+        else:
+            result.append((low, high))
+    return result
+
+
+def _interval(lo, hi):
+    """List with the single interval [lo, hi) (empty if lo >= hi)"""
+    if lo < hi:
+        return [(lo, hi)]
+    else:
+        return []
+
+
+def _from_points(points):
+    """Intervals from a sorted list of integers"""
+    return _merge([(p, p + 1) for p in points])
+
+
+def _first_missing(intervals, lo, hi):
+    """First integer in [lo, hi) which is not in the intervals, or None"""
+    current = lo
+    for (low, high) in intervals:
+        if low > current:
+            break
+        current = max(current, high)
+    if current < hi:
+        return current
+    return None
+
+
+def _first_false(true_intervals, lo, hi):
+    """
+    First integer in [lo, hi) which is not in `true_intervals(lo, hi)`, or
+    `hi` if there is none.
+
+    The range is tested in chunks of increasing size, so that tests which
+    are evaluated point by point don't need to test the whole range.
+    """
+    chunk = 16
+    while lo < hi:
+        chunk_hi = min(hi, lo + chunk)
+        missing = _first_missing(true_intervals(lo, chunk_hi), lo, chunk_hi)
+        if missing is not None:
+            return missing
+        lo = chunk_hi
+        chunk *= 2
+    return hi
+
+
+class FrameLabels(object):
+    """
+    Volume memberships for all frames of a trajectory
+
+    Parameters
+    ----------
+    trajectory : :class:`openpathsampling.Trajectory`
+        the trajectory to be labeled
+    volumes : list of :class:`openpathsampling.Volume`
+        the volumes to test
+
+    Attributes
+    ----------
+    trajectory : :class:`openpathsampling.Trajectory`
+        the labeled trajectory
+    volumes : list of :class:`openpathsampling.Volume`
+        the volumes that are tested
+    masks : list of numpy.ndarray
+        one boolean array per volume with `True` for the frames in the
+        volume
+    n_frames : int
+        number of labeled frames
+    """
+    def __init__(self, trajectory, volumes):
+        self.trajectory = trajectory
+        self.volumes = list(volumes)
+        self.n_frames = len(trajectory)
+        self.masks = [np.asarray(vol.mask(trajectory), dtype=bool)
+                      for vol in self.volumes]
+        self._views = None
+
+    @property
+    def labels(self):
+        """
+        numpy.ndarray : per-frame bitmask; bit `i` is set if the frame is
+        in `volumes[i]`
+        """
+        if len(self.volumes) < 63:
+            labels = np.zeros(self.n_frames, dtype=np.int64)
+            one = np.int64(1)
+        else:
+            labels = np.zeros(self.n_frames, dtype=object)
+            one = 1
+        for idx, mask in enumerate(self.masks):
+            labels[mask] += one << idx
+        return labels
+
+    def view(self, reverse=False):
+        """
+        :class:`_LabelView` : the labels in forward or backward direction
+        """
+        if self._views is None:
+            forward = _LabelView(self.trajectory, self.masks,
+                                 self.n_frames, False)
+            backward = _LabelView(self.trajectory,
+                                  [mask[::-1] for mask in self.masks],
+                                  self.n_frames, True)
+            forward.flipped = backward
+            backward.flipped = forward
+            self._views = (forward, backward)
+        return self._views[1] if reverse else self._views[0]
+
+
+class _LabelView(object):
+    """Labels of all frames in one direction"""
+    def __init__(self, trajectory, masks, n_frames, reverse):
+        self.trajectory = trajectory
+        self.masks = masks
+        self.n_frames = n_frames
+        self.reverse = reverse
+        self.flipped = None
+        self._next = {}
+
+    def next_index(self, volume_idx, value):
+        """
+        Array with the index of the next frame at or after each frame for
+        which the mask of the volume has the given value (or n_frames)
+        """
+        key = (volume_idx, value)
+        if key not in self._next:
+            mask = self.masks[volume_idx]
+            if not value:
+                mask = ~mask
+            positions = np.append(np.flatnonzero(mask), self.n_frames)
+            self._next[key] = positions[
+                np.searchsorted(positions, np.arange(self.n_frames + 1))
+            ]
+        return self._next[key]
+
+    def subtrajectory(self, start, end):
+        """
+        The frames [start, end) of this view as part of the original
+        trajectory (in original order)
+        """
+        if self.reverse:
+            start, end = self.n_frames - end, self.n_frames - start
+        return self.trajectory[start:end]
+
+
+class _LabelEvaluator(object):
+    """
+    Base class for label-based versions of ensembles.
+
+    `calls` and `appends` return the values `end` in the range [lo, hi) for
+    which `__call__` and (strict) `can_append` of `trajectory[start:end]`
+    are True.
+    """
+    def calls(self, view, start, lo, hi):
+        raise NotImplementedError
+
+    def appends(self, view, start, lo, hi, strict):
+        raise NotImplementedError
+
+    def call(self, view, start, end):
+        return len(self.calls(view, start, end, end + 1)) > 0
+
+    def can_append(self, view, start, end, strict=False):
+        return len(self.appends(view, start, end, end + 1, strict)) > 0
+
+
+class _AllInXLabels(_LabelEvaluator):
+    def __init__(self, volume_idx, value):
+        self.volume_idx = volume_idx
+        self.value = value
+
+    def _last_end(self, view, start):
+        return view.next_index(self.volume_idx, not self.value)[start]
+
+    def calls(self, view, start, lo, hi):
+        return _interval(max(lo, start + 1),
+                         min(hi, self._last_end(view, start) + 1))
+
+    def appends(self, view, start, lo, hi, strict):
+        return _interval(max(lo, start),
+                         min(hi, self._last_end(view, start) + 1))
+
+
+class _PartInXLabels(_LabelEvaluator):
+    def __init__(self, volume_idx, value):
+        self.volume_idx = volume_idx
+        self.value = value
+
+    def calls(self, view, start, lo, hi):
+        first = view.next_index(self.volume_idx, self.value)[start]
+        return _interval(max(lo, first + 1), hi)
+
+    def appends(self, view, start, lo, hi, strict):
+        return _interval(lo, hi)
+
+
+class _LengthLabels(_LabelEvaluator):
+    def __init__(self, length):
+        self.length = length
+
+    def calls(self, view, start, lo, hi):
+        if type(self.length) is int:
+            return _interval(max(lo, start + self.length),
+                             min(hi, start + self.length + 1))
+        else:
+            min_length = self.length.start
+            if min_length is None:
+                min_length = 0
+            if self.length.stop is not None:
+                hi = min(hi, start + self.length.stop)
+            return _interval(max(lo, start + min_length), hi)
+
+    def appends(self, view, start, lo, hi, strict):
+        if type(self.length) is int:
+            return _interval(lo, min(hi, start + self.length))
+        elif self.length.stop is None:
+            return _interval(lo, hi)
+        else:
+            return _interval(lo, min(hi, start + self.length.stop - 1))
+
+
+class _ConstantLabels(_LabelEvaluator):
+    def __init__(self, value):
+        self.value = value
+
+    def calls(self, view, start, lo, hi):
+        return _interval(lo, hi) if self.value else []
+
+    def appends(self, view, start, lo, hi, strict):
+        return _interval(lo, hi) if self.value else []
+
+
+class _NegatedLabels(_LabelEvaluator):
+    def __init__(self, ensemble):
+        self.ensemble = ensemble
+
+    def calls(self, view, start, lo, hi):
+        return _complement(self.ensemble.calls(view, start, lo, hi), lo, hi)
+
+    def appends(self, view, start, lo, hi, strict):
+        # NegatedEnsemble can always append
+        return _interval(lo, hi)
+
+
+class _CombinationLabels(_LabelEvaluator):
+    """
+    Union or intersection; the second ensemble is only tested for values of
+    `end` that are not already decided by the first one
+    """
+    def __init__(self, ensemble1, ensemble2, is_union):
+        self.ensemble1 = ensemble1
+        self.ensemble2 = ensemble2
+        self.is_union = is_union
+
+    def _combine(self, set1, fnc2, lo, hi):
+        if self.is_union:
+            undecided = _complement(set1, lo, hi)
+        else:
+            undecided = set1
+        set2 = []
+        for (low, high) in undecided:
+            set2.extend(fnc2(low, high))
+        if self.is_union:
+            return _merge(set1 + set2)
+        else:
+            return set2
+
+    def calls(self, view, start, lo, hi):
+        return self._combine(
+            self.ensemble1.calls(view, start, lo, hi),
+            lambda low, high: self.ensemble2.calls(view, start, low, high),
+            lo, hi
+        )
+
+    def appends(self, view, start, lo, hi, strict):
+        return self._combine(
+            self.ensemble1.appends(view, start, lo, hi, strict),
+            lambda low, high: self.ensemble2.appends(view, start, low, high,
+                                                     strict),
+            lo, hi
+        )
+
+
+class _EnsembleLabels(_LabelEvaluator):
+    """
+    Ensemble that can not be evaluated from labels; uses the functions of
+    the ensemble on the subtrajectories instead
+    """
+    def __init__(self, ensemble):
+        self.ensemble = ensemble
+
+    def calls(self, view, start, lo, hi):
+        if view.reverse:
+            # same test as `SequentialEnsemble._find_subtraj_first` uses
+            fnc = self.ensemble.check_reverse
+        else:
+            fnc = self.ensemble
+        return _from_points([end for end in range(lo, hi)
+                             if fnc(view.subtrajectory(start, end))])
+
+    def appends(self, view, start, lo, hi, strict):
+        if view.reverse and strict:
+            fnc = self.ensemble.strict_can_prepend
+        elif view.reverse:
+            fnc = self.ensemble.can_prepend
+        elif strict:
+            fnc = self.ensemble.strict_can_append
+        else:
+            fnc = self.ensemble.can_append
+        return _from_points([end for end in range(lo, hi)
+                             if fnc(view.subtrajectory(start, end))])
+
+
+class _SequentialLabels(_LabelEvaluator):
+    """
+    Label-based version of the (untrusted) `SequentialEnsemble` algorithms
+    """
+    def __init__(self, ensembles):
+        self.ensembles = ensembles
+
+    def _ensembles(self, view):
+        if view.reverse:
+            return self.ensembles[::-1]
+        else:
+            return self.ensembles
+
+    @staticmethod
+    def _find_subtraj_final(view, ensemble, subtraj_first, traj_final):
+        """
+        Same as `SequentialEnsemble._find_subtraj_final`: the end of the
+        longest subtrajectory starting at `subtraj_first` that satisfies
+        `ensemble.can_append` or `ensemble`
+        """
+        def accepted(lo, hi):
+            appends = ensemble.appends(view, subtraj_first, lo, hi, False)
+            calls = []
+            for (low, high) in _complement(appends, lo, hi):
+                calls.extend(ensemble.calls(view, subtraj_first, low, high))
+            return _merge(appends + calls)
+
+        return _first_false(accepted, subtraj_first + 1, traj_final + 1) - 1
+
+    def _transitions(self, view, start, end):
+        """Same as `SequentialEnsemble.transition_frames`"""
+        ensembles = self._ensembles(view)
+        final_ens = len(ensembles) - 1
+        ens_num = 0
+        subtraj_first = start
+        transitions = []
+        while ens_num <= final_ens:
+            subtraj_final = self._find_subtraj_final(
+                view, ensembles[ens_num], subtraj_first, end)
+            if subtraj_final - subtraj_first > 0:
+                transitions.append(subtraj_final)
+                if ens_num == final_ens:
+                    break
+                ens_num += 1
+                subtraj_first = subtraj_final
+            elif ensembles[ens_num].call(view, subtraj_first,
+                                         subtraj_first):
+                ens_num += 1
+                transitions.append(subtraj_final)
+                subtraj_first = subtraj_final
+            else:
+                break
+        return transitions
+
+    def _call(self, view, start, end):
+        """Same as `SequentialEnsemble.__call__`"""
+        if view.reverse:
+            # calls always refer to the original direction
+            n_frames = view.n_frames
+            return self._call(view.flipped, n_frames - end, n_frames - start)
+
+        transitions = self._transitions(view, start, end)
+        if len(transitions) != len(self.ensembles):
+            return False
+        elif transitions[-1] != end:
+            return False
+
+        subtraj_first = start
+        for (ens, subtraj_final) in zip(self.ensembles, transitions):
+            if not ens.call(view, subtraj_first, subtraj_final):
+                return False
+            subtraj_first = subtraj_final
+        return True
+
+    def calls(self, view, start, lo, hi):
+        return _from_points([end for end in range(lo, hi)
+                             if self._call(view, start, end)])
+
+    def appends(self, view, start, lo, hi, strict):
+        """
+        Same as `SequentialEnsemble._generic_can_append` (or
+        `_generic_can_prepend` in a reversed view) for all `end` in [lo, hi)
+
+        The assignment of frames to subensembles only depends on `end` when
+        a subtrajectory reaches it. We follow the algorithm for all `end`
+        values at once and split the range where the branches differ.
+        """
+        ensembles = self._ensembles(view)
+        final_ens = len(ensembles) - 1
+        result = []
+        # ranges of `end` with the state of the algorithm for them:
+        # (lo, hi, subtraj_first, ens_num, ens_first)
+        pending = [(lo, hi, start, 0, 0)]
+        while pending:
+            (lo, hi, subtraj_first, ens_num, ens_first) = pending.pop()
+            ens = ensembles[ens_num]
+            subtraj_final = self._find_subtraj_final(view, ens, subtraj_first,
+                                                     view.n_frames)
+            # end <= subtraj_final: the subtrajectory reaches the end
+            low, high = lo, min(hi, subtraj_final + 1)
+            if low <= subtraj_first < high:
+                # no frames left for this subensemble
+                result.append((subtraj_first, subtraj_first + 1))
+                low = subtraj_first + 1
+            if ens_num == final_ens:
+                result.extend(ens.appends(view, subtraj_first, low, high,
+                                          False))
+            elif low < high:
+                # next subensemble starts at the end: nothing left to assign
+                result.append((low, high))
+
+            # end > subtraj_final: the subtrajectory stops before the end
+            low = max(lo, subtraj_final + 1)
+            if low >= hi:
+                continue
+            if subtraj_final - subtraj_first > 0:
+                if ens_num != final_ens:
+                    pending.append((low, hi, subtraj_final, ens_num + 1,
+                                    ens_first))
+            elif ens.call(view, subtraj_final, subtraj_final):
+                pending.append((low, hi, subtraj_final, ens_num + 1,
+                                ens_first))
+            elif ens_first != final_ens and not strict:
+                pending.append((low, hi, start, ens_first + 1,
+                                ens_first + 1))
+        return _merge(result)
+
+
+class LabelEvaluator(object):
+    """
+    Evaluates an ensemble on the frame labels of a trajectory
+
+    Parameters
+    ----------
+    ensemble : :class:`openpathsampling.Ensemble`
+        the ensemble; use :meth:`.from_ensemble` to check whether the
+        ensemble can be evaluated from labels
+
+    Attributes
+    ----------
+    ensemble : :class:`openpathsampling.Ensemble`
+        the ensemble
+    volumes : list of :class:`openpathsampling.Volume`
+        the volumes needed to label the frames
+    """
+    def __init__(self, ensemble):
+        self.ensemble = ensemble
+        self.volumes = []
+        self._root = self._build(ensemble)
+
+    @classmethod
+    def from_ensemble(cls, ensemble):
+        """
+        Create the evaluator for an ensemble, if possible
+
+        Returns
+        -------
+        :class:`LabelEvaluator` or None
+            None if the ensemble contains pieces that cannot be evaluated
+            from volume labels or with their own functions, or if nothing
+            in the ensemble is evaluated from volume labels
+        """
+        try:
+            evaluator = cls(ensemble)
+        except TypeError:
+            return None
+        if isinstance(evaluator._root, _EnsembleLabels):
+            return None
+        return evaluator
+
+    def _volume_idx(self, volume):
+        for idx, vol in enumerate(self.volumes):
+            if vol is volume:
+                return idx
+        self.volumes.append(volume)
+        return len(self.volumes) - 1
+
+    def _build(self, ensemble, in_sequence=False):
+        ens_type = type(ensemble)
+        # only exact types: subclasses may change the behavior
+        if ens_type in [paths.AllInXEnsemble, paths.AllOutXEnsemble,
+                        paths.PartInXEnsemble, paths.PartOutXEnsemble]:
+            value = ens_type in [paths.AllInXEnsemble, paths.PartInXEnsemble]
+            volume_idx = self._volume_idx(ensemble.volume)
+            if ens_type in [paths.AllInXEnsemble, paths.AllOutXEnsemble]:
+                return _AllInXLabels(volume_idx, value)
+            else:
+                return _PartInXLabels(volume_idx, value)
+        elif ens_type is paths.LengthEnsemble:
+            return _LengthLabels(ensemble.length)
+        elif ens_type is paths.EmptyEnsemble:
+            return _ConstantLabels(False)
+        elif ens_type is paths.FullEnsemble:
+            return _ConstantLabels(True)
+        elif ens_type is paths.NegatedEnsemble:
+            return _NegatedLabels(self._build(ensemble.ensemble, in_sequence))
+        elif ens_type in [paths.UnionEnsemble, paths.IntersectionEnsemble]:
+            return _CombinationLabels(
+                self._build(ensemble.ensemble1, in_sequence),
+                self._build(ensemble.ensemble2, in_sequence),
+                is_union=(ens_type is paths.UnionEnsemble)
+            )
+        elif ens_type in [paths.OptionalEnsemble, paths.SingleFrameEnsemble,
+                          paths.ensemble.AppendedNameEnsemble]:
+            return self._build(ensemble._new_ensemble, in_sequence)
+        elif ens_type in [paths.SequentialEnsemble, paths.TISEnsemble,
+                          paths.MinusInterfaceEnsemble] and not in_sequence:
+            return _SequentialLabels([self._build(ens, in_sequence=True)
+                                      for ens in ensemble.ensembles])
+        elif isinstance(ensemble, (paths.SequentialEnsemble,
+                                   paths.ensemble.WrappedEnsemble)):
+            # nested sequential ensembles are not supported: they test
+            # empty subtrajectories, which their caches don't allow
+            raise TypeError("Ensemble of type " + ens_type.__name__ +
+                            " can not be evaluated from volume labels")
+        else:
+            return _EnsembleLabels(ensemble)
+
+    def label(self, trajectory):
+        """
+        :class:`FrameLabels` : labels of all frames of the trajectory
+        """
+        return FrameLabels(trajectory, self.volumes)
+
+    def __call__(self, labels, start=0, end=None):
+        """
+        Same as `ensemble(trajectory[start:end])`
+
+        Parameters
+        ----------
+        labels : :class:`FrameLabels`
+            the labels of the trajectory
+        start : int
+            first frame of the subtrajectory
+        end : int or None
+            end of the subtrajectory (exclusive); default is the end of the
+            trajectory
+        """
+        if end is None:
+            end = labels.n_frames
+        return self._root.call(labels.view(), start, end)
+
+    def can_append(self, labels, start=0, end=None, strict=False):
+        """
+        Same as `ensemble.can_append(trajectory[start:end])` (or
+        `strict_can_append` if `strict` is True)
+        """
+        if end is None:
+            end = labels.n_frames
+        return self._root.can_append(labels.view(), start, end, strict)
+
+    def can_prepend(self, labels, start=0, end=None, strict=False):
+        """
+        Same as `ensemble.can_prepend(trajectory[start:end])` (or
+        `strict_can_prepend` if `strict` is True)
+        """
+        if end is None:
+            end = labels.n_frames
+        n_frames = labels.n_frames
+        return self._root.can_append(labels.view(reverse=True),
+                                     n_frames - end, n_frames - start, strict)
+
+    def _grow(self, view, start, end, length, max_end, strict):
+        """
+        Grow `end` like the loops in `Ensemble.iter_valid_slices` do
+
+        Returns the first end in [end, length] where the subtrajectory can
+        not be appended (or `length`). Returns None if the subtrajectory
+        grows beyond `max_end` first.
+        """
+        stop = _first_false(
+            lambda lo, hi: self._root.appends(view, start, lo, hi, strict),
+            end, length
+        )
+        if stop > end and max(end + 1, max_end + 1) <= stop:
+            return None
+        return stop
+
+    def iter_valid_slices(self, trajectory, max_length=None, min_length=1,
+                          overlap=1, reverse=False):
+        """
+        Same as `Ensemble.iter_valid_slices`, but based on frame labels
+        """
+        labels = self.label(trajectory)
+        length = labels.n_frames
+        forward = labels.view()
+        backward = labels.view(reverse=True)
+        call = lambda start, end: self._root.call(forward, start, end)
+
+        if max_length is None:
+            max_length = length
+
+        max_length = min(length, max_length)
+        min_length = max(1, min_length)
+
+        if not reverse:
+            start = 0
+            end = start + min_length
+
+            while start <= length - min_length and end <= length:
+                if end < length:
+                    new_end = self._grow(forward, start, end, length,
+                                         start + max_length + 1, True)
+                    if new_end is None:
+                        start += 1
+                        end = start + min_length
+                        continue
+                    end = new_end
+
+                if end - start <= max_length and call(start, end):
+                    yield slice(start, end)
+                    pad = min(overlap, end - start - 1)
+                    start = end - pad
+                    if end == length:
+                        start = length
+                elif end - start >= min_length + 1 and \
+                        call(start, end - 1):
+                    yield slice(start, end - 1)
+                    pad = min(overlap + 1, end - start - 2)
+                    start = end - pad
+                else:
+                    start += 1
+                end = start + min_length
+
+        else:
+            end = length
+            start = end - min_length
+
+            while start >= 0 and end >= min_length:
+                if start > 0:
+                    # growing backward is growing forward in reversed view
+                    new_start = self._grow(
+                        backward, length - end, length - start, length,
+                        length - end + max_length + 1, False)
+                    if new_start is None:
+                        end -= 1
+                        start = end - min_length
+                        continue
+                    start = length - new_start
+
+                if end - start <= max_length and call(start, end):
+                    yield slice(start, end)
+                    pad = min(overlap, end - start - 1)
+                    end = start + pad
+                    if start == 0:
+                        end = 0
+                elif end - start >= min_length + 1 and \
+                        call(start + 1, end):
+                    yield slice(start + 1, end)
+                    pad = min(overlap + 1, end - start - 2)
+                    end = start + pad
+                else:
+                    end -= 1
+
+                start = end - min_length
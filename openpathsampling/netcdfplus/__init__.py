@@ -2,6 +2,8 @@ from netcdfplus import NetCDFPlus
 from base import StorableNamedObject, StorableObject, create_to_dict
 from proxy import DelayedLoader, lazy_loading_attributes, LoaderProxy
 from cache import WeakKeyCache, WeakLRUCache, WeakValueCache, MaxCache, \
-    NoCache, Cache, LRUCache, LRUChunkLoadingCache
+    NoCache, Cache, LRUCache, LRUChunkLoadingCache, UUIDLRUCache, ByteBudget, \
+    PositionCache
 from dictify import ObjectJSON, StorableObjectJSON, UUIDObjectJSON
 from objects import ObjectStore, VariableStore, DictStore, NamedObjectStore, UniqueNamedObjectStore, ImmutableDictStore
+from uuidindex import UUIDIndex
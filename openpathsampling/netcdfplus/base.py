@@ -40,6 +40,17 @@ class StorableObject(object):
     def ruuid(uid):
         return uuid.UUID(int=int(uid) ^ 1)
 
+    @staticmethod
+    def pair_uuid(uid):
+        """
+        Return the UUID shared by an object and its reversed
+
+        An object and its reversed differ only in the last bit of their
+        UUIDs (see `ruuid`), so the UUID with the last bit cleared can be
+        used as a key for both.
+        """
+        return uuid.UUID(int=int(uid) & ~1)
+
     def __init__(self):
         self.__uuid__ = StorableObject.get_uuid()
 
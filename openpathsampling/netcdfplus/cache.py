@@ -1,6 +1,10 @@
 from collections import OrderedDict
+import itertools
+import sys
 import weakref
 
+import numpy as np
+
 __author__ = 'Jan-Hendrik Prinz'
 
 
@@ -207,6 +211,546 @@ class LRUCache(Cache):
         return len(self._cache)
 
 
+def value_nbytes(value):
+    """
+    Estimate the memory used by a (cached) value in bytes
+
+    numpy arrays are counted by their data buffer, units by their value and
+    lists and tuples by the sum of their elements. Everything else uses
+    `sys.getsizeof`, which does not follow references.
+
+    Parameters
+    ----------
+    value : object
+        the value to be measured
+
+    Returns
+    -------
+    int
+        the estimated number of bytes
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes + sys.getsizeof(np.empty(0))
+    elif hasattr(value, '_value') and hasattr(value, 'unit'):
+        # a `simtk.unit.Quantity`
+        return value_nbytes(value._value) + sys.getsizeof(value)
+    elif isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(map(value_nbytes, value))
+    else:
+        return sys.getsizeof(value)
+
+
+class ByteBudget(object):
+    """
+    A memory limit shared by several :class:`UUIDLRUCache` instances
+
+    If the total size of all caches using the budget exceeds the limit, the
+    least recently used values of all these caches are removed until the
+    limit is met again. Only caches that are alive and registered count, so
+    the bytes of a cache are released once it is garbage collected or
+    unregistered.
+
+    Examples
+    --------
+    >>> budget = ByteBudget(2 * 1024 ** 3)
+    >>> for cv in [cv1, cv2, cv3]:
+    >>>     cv.set_cache(UUIDLRUCache(budget=budget))
+
+    Attributes
+    ----------
+    byte_limit : int
+        the maximal number of bytes in all caches together
+    nbytes : int
+        the number of bytes currently used by all caches
+    """
+
+    def __init__(self, byte_limit):
+        self.byte_limit = byte_limit
+        self._caches = weakref.WeakSet()
+        self._clock = itertools.count()
+
+    @property
+    def nbytes(self):
+        return sum(cache.nbytes for cache in self._caches)
+
+    def __str__(self):
+        return '%s(%d/%d bytes in %d caches)' % (
+            self.__class__.__name__,
+            self.nbytes, self.byte_limit, len(self._caches)
+        )
+
+    def register(self, cache):
+        self._caches.add(cache)
+
+    def unregister(self, cache):
+        """
+        Stop counting the bytes of a cache, e.g. when it is replaced
+        """
+        self._caches.discard(cache)
+
+    def tick(self):
+        """
+        int : a counter that defines the order of access for all caches
+        """
+        return next(self._clock)
+
+    def check(self):
+        """
+        Remove the least recently used values until the budget is met
+        """
+        while self.nbytes > self.byte_limit:
+            oldest = None
+            oldest_tick = None
+            for cache in self._caches:
+                tick = cache.oldest_tick
+                if tick is not None and (
+                        oldest_tick is None or tick < oldest_tick):
+                    oldest = cache
+                    oldest_tick = tick
+
+            if oldest is None:
+                break
+
+            oldest.pop_oldest()
+
+
+class UUIDLRUCache(Cache):
+    """
+    A Least Recently Used Cache of values keyed by the UUID of objects
+
+    Keys can be any :class:`StorableObject` or
+    :class:`openpathsampling.netcdfplus.LoaderProxy` or plain UUIDs. Since
+    only the UUID is kept, values survive if the object itself is removed
+    from memory and is later reloaded from the storage. The cache can be
+    limited by the number of values, the (estimated) number of bytes of the
+    values and by a :class:`ByteBudget` shared with other caches.
+
+    Iterating the cache returns the UUIDs.
+    """
+
+    uuid_keys = True
+
+    def __init__(self, size_limit=None, byte_limit=None, budget=None):
+        """
+        Parameters
+        ----------
+        size_limit : int or None
+            the maximal number of values, `None` means no limit
+        byte_limit : int or None
+            the maximal number of bytes of all values, `None` means no limit
+        budget : :class:`ByteBudget` or None
+            a budget of bytes shared with other caches
+        """
+        super(UUIDLRUCache, self).__init__()
+        self._size_limit = size_limit
+        self._byte_limit = byte_limit
+        self.budget = budget
+        self.nbytes = 0
+
+        # uuid -> (value, nbytes, tick)
+        self._cache = OrderedDict()
+
+        if budget is None:
+            self._clock = itertools.count()
+        else:
+            budget.register(self)
+
+    @staticmethod
+    def _key(item):
+        try:
+            return item.__uuid__
+        except AttributeError:
+            return item
+
+    def _tick(self):
+        if self.budget is None:
+            return next(self._clock)
+        else:
+            return self.budget.tick()
+
+    @property
+    def count(self):
+        return len(self._cache), 0
+
+    @property
+    def size(self):
+        if self._size_limit is None:
+            return -1, 0
+        else:
+            return self._size_limit, 0
+
+    @property
+    def size_limit(self):
+        return self._size_limit
+
+    @size_limit.setter
+    def size_limit(self, new_size):
+        self._size_limit = new_size
+        self._check_size_limit()
+
+    @property
+    def byte_limit(self):
+        return self._byte_limit
+
+    @byte_limit.setter
+    def byte_limit(self, new_limit):
+        self._byte_limit = new_limit
+        self._check_size_limit()
+
+    @property
+    def oldest_tick(self):
+        """
+        int or None : the access tick of the least recently used value
+        """
+        for key in self._cache:
+            return self._cache[key][2]
+
+        return None
+
+    def __str__(self):
+        return '%s(%d/%s values, %d/%s bytes)' % (
+            self.__class__.__name__,
+            len(self._cache),
+            'Inf' if self._size_limit is None else str(self._size_limit),
+            self.nbytes,
+            'Inf' if self._byte_limit is None else str(self._byte_limit)
+        )
+
+    def __iter__(self):
+        return iter(self._cache)
+
+    def __reversed__(self):
+        return reversed(self._cache)
+
+    def __getitem__(self, item):
+        key = self._key(item)
+        value, nbytes, _ = self._cache.pop(key)
+        self._cache[key] = (value, nbytes, self._tick())
+        return value
+
+    def get_silent(self, item):
+        try:
+            return self._cache[self._key(item)][0]
+        except KeyError:
+            return None
+
+    def __setitem__(self, key, value, **kwargs):
+        key = self._key(key)
+        self._remove(key)
+
+        nbytes = value_nbytes(value)
+        self._cache[key] = (value, nbytes, self._tick())
+        self._add_nbytes(nbytes)
+        self._check_size_limit()
+
+    def __delitem__(self, item):
+        key = self._key(item)
+        if key not in self._cache:
+            raise KeyError(item)
+
+        self._remove(key)
+
+    def _add_nbytes(self, nbytes):
+        self.nbytes += nbytes
+
+    def _remove(self, key):
+        entry = self._cache.pop(key, None)
+        if entry is not None:
+            self._add_nbytes(-entry[1])
+
+    def pop_oldest(self):
+        """
+        Remove the least recently used value
+        """
+        _, entry = self._cache.popitem(last=False)
+        self._add_nbytes(-entry[1])
+
+    def _check_size_limit(self):
+        if self._size_limit is not None:
+            while len(self._cache) > self._size_limit:
+                self.pop_oldest()
+
+        if self._byte_limit is not None:
+            while self.nbytes > self._byte_limit and len(self._cache) > 0:
+                self.pop_oldest()
+
+        if self.budget is not None:
+            self.budget.check()
+
+    def __contains__(self, item):
+        return self._key(item) in self._cache
+
+    def keys(self):
+        return list(self._cache)
+
+    def values(self):
+        return [entry[0] for entry in self._cache.values()]
+
+    def iteritems(self):
+        for key, entry in self._cache.iteritems():
+            yield key, entry[0]
+
+    def clear(self):
+        self._add_nbytes(-self.nbytes)
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class PositionCache(Cache):
+    """
+    A cache that keeps numeric values in a growable numpy array
+
+    The row of a value is the position of its key in a store, e.g.
+    `SnapshotWrapperStore.pos`. Values for a list of keys can be gathered
+    with a single fancy-indexing operation. A boolean array marks the rows
+    that hold a value. Keys without a position (objects that are not
+    stored) and values that do not fit the array (non-numeric or of a
+    different shape) are kept in a `fallback` cache instead. The dtype of
+    the array is taken from the first value and widened when a later value
+    cannot be cast safely, e.g. a float after an int.
+
+    Examples
+    --------
+    >>> cv.set_cache(PositionCache(
+    >>>     storage.snapshots.pos, time_reversible=cv.cv_time_reversible))
+
+    Iterating the cache only returns the keys of the fallback cache since
+    the rows of the array do not keep their keys.
+
+    Attributes
+    ----------
+    values : numpy.ndarray or None
+        the array of values, `None` before the first value is set
+    valid : numpy.ndarray of bool
+        `True` for all rows of `values` that hold a value
+    fallback : :class:`Cache`
+        the cache used for keys without position or non-numeric values
+    """
+
+    _numeric = (np.ndarray, np.generic, float, int, long, bool)
+
+    def __init__(self, pos, time_reversible=False, fallback=None,
+                 initial_size=1024):
+        """
+        Parameters
+        ----------
+        pos : callable
+            a function returning the integer position of a key or `None`
+        time_reversible : bool
+            if `True` a key and its reversed at position `pos ^ 1` share a
+            row, like snapshots in a `SnapshotWrapperStore`
+        fallback : :class:`Cache` or None
+            cache for all values that cannot be kept in the array. Default
+            is a :class:`WeakKeyCache`
+        initial_size : int
+            the number of rows allocated with the first value
+        """
+        super(PositionCache, self).__init__()
+        self.pos = pos
+        self.time_reversible = time_reversible
+        if fallback is None:
+            fallback = WeakKeyCache()
+
+        self.fallback = fallback
+        self.initial_size = initial_size
+        self.values = None
+        self.valid = np.zeros(0, dtype=bool)
+
+    @classmethod
+    def from_arrays(cls, pos, values, valid, time_reversible=False,
+                    fallback=None):
+        """
+        Create a cache on top of existing arrays
+
+        The arrays are used as they are and not copied, so these can be
+        read-only memory-mapped arrays, e.g. from
+        `SnapshotWrapperStore.cv_arrays`. If `values` is not writeable,
+        all new values are kept in the fallback cache.
+
+        Parameters
+        ----------
+        pos : callable
+            a function returning the integer position of a key or `None`
+        values : numpy.ndarray
+            the values, one row per position
+        valid : numpy.ndarray of bool
+            `True` for all rows of `values` that hold a value
+        time_reversible : bool
+        fallback : :class:`Cache` or None
+
+        Returns
+        -------
+        :class:`PositionCache`
+        """
+        cache = cls(pos, time_reversible=time_reversible, fallback=fallback)
+        cache.values = values
+        cache.valid = valid
+        return cache
+
+    @property
+    def count(self):
+        return int(self.valid.sum()) + len(self.fallback), 0
+
+    @property
+    def writeable(self):
+        """
+        bool : `False` if the arrays cannot be changed (e.g. read-only
+        memory-mapped arrays)
+        """
+        return self.values is None or (
+            self.values.flags.writeable and self.valid.flags.writeable)
+
+    @property
+    def nbytes(self):
+        """
+        int : the memory used by the arrays
+        """
+        if self.values is None:
+            return self.valid.nbytes
+        return self.values.nbytes + self.valid.nbytes
+
+    def _row(self, item):
+        pos = self.pos(item)
+        if pos is None:
+            return None
+
+        if self.time_reversible:
+            return pos / 2
+        else:
+            return pos
+
+    def _fits(self, value):
+        if not isinstance(value, self._numeric):
+            return False
+
+        if np.asarray(value).dtype.kind not in 'biufc':
+            return False
+
+        if self.values is None:
+            return True
+
+        return np.shape(value) == self.values.shape[1:]
+
+    def _grow(self, row, value):
+        value = np.asarray(value)
+        if self.values is None:
+            size = max(self.initial_size, row + 1)
+            self.values = np.zeros((size,) + value.shape, dtype=value.dtype)
+            self.valid = np.zeros(size, dtype=bool)
+            return
+
+        if not np.can_cast(value.dtype, self.values.dtype):
+            # the first value fixed the dtype, e.g. an int, so upcast the
+            # array instead of truncating later values, e.g. floats
+            self.values = self.values.astype(
+                np.result_type(self.values.dtype, value.dtype))
+
+        if row >= len(self.valid):
+            size = max(2 * len(self.valid), row + 1)
+            values = np.zeros(
+                (size,) + self.values.shape[1:], dtype=self.values.dtype)
+            values[:len(self.values)] = self.values
+            valid = np.zeros(size, dtype=bool)
+            valid[:len(self.valid)] = self.valid
+            self.values = values
+            self.valid = valid
+
+    def __getitem__(self, item):
+        row = self._row(item)
+        if row is not None and row < len(self.valid) and self.valid[row]:
+            return self.values[row]
+
+        return self.fallback[item]
+
+    def get_list(self, items):
+        """
+        Return the values of a list of keys, `None` for missing ones
+
+        All stored values are taken from the array in a single operation.
+
+        Parameters
+        ----------
+        items : list of object
+            the keys to be looked up
+
+        Returns
+        -------
+        list
+            the values or `None`
+        """
+        rows = np.array(
+            [self._row(item) for item in items], dtype=object)
+        results = [None] * len(rows)
+        if self.values is not None:
+            known = np.array([row is not None for row in rows], dtype=bool)
+            known_idx = np.nonzero(known)[0]
+            known_rows = rows[known].astype(int)
+            inside = known_rows < len(self.valid)
+            known_idx = known_idx[inside]
+            known_rows = known_rows[inside]
+            found = self.valid[known_rows]
+            values = self.values[known_rows[found]]
+            for idx, value in zip(known_idx[found], values):
+                results[idx] = value
+
+        for idx, value in enumerate(results):
+            if value is None:
+                results[idx] = self.fallback.get(items[idx])
+
+        return results
+
+    def __setitem__(self, key, value, **kwargs):
+        row = self._row(key)
+        if row is None or not self.writeable or not self._fits(value):
+            self.fallback[key] = value
+            return
+
+        self._grow(row, value)
+        self.values[row] = value
+        self.valid[row] = True
+
+    def __contains__(self, item):
+        row = self._row(item)
+        if row is not None and row < len(self.valid) and self.valid[row]:
+            return True
+
+        return item in self.fallback
+
+    def __iter__(self):
+        return iter(self.fallback)
+
+    def iteritems(self):
+        """
+        Iterate the keys and values of the fallback cache
+
+        The values in the array are returned by `row_items`.
+        """
+        return self.fallback.iteritems()
+
+    def row_items(self):
+        """
+        Iterate the rows and values kept in the array
+
+        For a `time_reversible` cache, row `n` holds the value for the
+        positions `2 * n` and `2 * n + 1`, otherwise for position `n`.
+        """
+        if self.values is None:
+            return
+
+        for row in np.nonzero(self.valid)[0]:
+            yield int(row), self.values[row]
+
+    def __len__(self):
+        return self.count[0]
+
+    def clear(self):
+        self.values = None
+        self.valid = np.zeros(0, dtype=bool)
+        self.fallback.clear()
+
+
 class WeakLRUCache(Cache):
     """
     Implements a cache that keeps weak references to all elements
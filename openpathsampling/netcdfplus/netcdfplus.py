@@ -8,7 +8,9 @@ from dictify import StorableObjectJSON, UUIDObjectJSON
 from proxy import LoaderProxy
 from collections import OrderedDict
 
+from base import StorableObject
 from objects import NamedObjectStore, ObjectStore
+from uuidindex import UUIDIndex
 
 from collections import OrderedDict
 
@@ -16,6 +18,7 @@ import numpy as np
 import netCDF4
 import os.path
 import abc
+import threading
 
 from uuid import UUID
 
@@ -74,6 +77,12 @@ class NetCDFPlus(netCDF4.Dataset):
 
         delegate[x] is equivalent to delegate.getter(delegate.variable[x])
 
+        If the storage uses write-behind (see
+        `NetCDFPlus.set_write_behind`) single rows of variables along an
+        unlimited dimension are not written at once but kept in `pending`
+        and later written in contiguous slabs by `flush`. Every read
+        flushes the pending rows first.
+
         Attributes
         ----------
         variable : dict-like
@@ -86,12 +95,28 @@ class NetCDFPlus(netCDF4.Dataset):
             on the variable
         store : openpathsampling.netcdfplus.ObjectStore
             a reference to an object store used for convenience in some cases
+        storage : openpathsampling.netcdfplus.NetCDFPlus or None
+            the storage that controls the write-behind
+        dimension : str or None
+            the unlimited dimension the rows belong to or `None` if the
+            variable is always written directly
+        pending : dict
+            the converted values of the rows not yet written by index
 
         """
 
-        def __init__(self, variable, getter=None, setter=None, store=None):
+        def __init__(self, variable, getter=None, setter=None, store=None,
+                     storage=None):
             self.variable = variable
             self.store = store
+            self.storage = storage
+            self.pending = {}
+
+            self.dimension = None
+            if storage is not None and len(variable.dimensions) > 0:
+                dimension = variable.dimensions[0]
+                if storage.dimensions[dimension].isunlimited():
+                    self.dimension = dimension
 
             if setter is None:
                 setter = lambda v: v
@@ -102,9 +127,17 @@ class NetCDFPlus(netCDF4.Dataset):
             self.getter = getter
 
         def __setitem__(self, key, value):
-            self.variable[key] = self.setter(value)
+            if self.dimension is not None and \
+                    self.storage.write_buffer_size and \
+                    isinstance(key, (int, long, np.integer)) and key >= 0:
+                self.pending[int(key)] = self.setter(value)
+                self.storage.stage(self, int(key))
+            else:
+                self.flush()
+                self.variable[key] = self.setter(value)
 
         def __getitem__(self, key):
+            self.flush()
             return self.getter(self.variable[key])
 
         def __getattr__(self, item):
@@ -117,8 +150,49 @@ class NetCDFPlus(netCDF4.Dataset):
             return repr(self.variable)
 
         def __len__(self):
+            if self.pending:
+                return max(len(self.variable), max(self.pending) + 1)
             return len(self.variable)
 
+        def flush(self):
+            """
+            Write all pending rows using one write per contiguous block
+            """
+            if not self.pending:
+                return
+
+            keys = sorted(self.pending)
+            start = 0
+            for end in range(1, len(keys) + 1):
+                if end == len(keys) or keys[end] != keys[end - 1] + 1:
+                    self._write_block(
+                        keys[start],
+                        [self.pending[key] for key in keys[start:end]])
+                    start = end
+
+            self.pending.clear()
+
+        def _write_block(self, first, values):
+            variable = self.variable
+            if len(values) > 1:
+                if hasattr(variable, 'var_vlen') or variable.dtype == str:
+                    block = np.empty(len(values), dtype=object)
+                    for idx, value in enumerate(values):
+                        block[idx] = value
+                else:
+                    block = np.asarray(values)
+                    if block.dtype == object or \
+                            block.shape[1:] != variable.shape[1:]:
+                        block = None
+
+                if block is not None:
+                    variable[first:first + len(values)] = block
+                    return
+
+            # single rows or values that do not stack
+            for idx, value in enumerate(values):
+                variable[first + idx] = value
+
     @property
     def objects(self):
         """
@@ -222,6 +296,7 @@ class NetCDFPlus(netCDF4.Dataset):
                 "reading from existing file", filename)
 
         self.filename = filename
+        self.mode = mode
         self.fallback = fallback
 
         # call netCDF4-python to create or open .nc file
@@ -245,6 +320,9 @@ class NetCDFPlus(netCDF4.Dataset):
             if use_uuid:
                 self.setncattr('use_uuid', 'True')
 
+            self.binary_uuid = True
+            self.setncattr('uuid_format', 'binary')
+
             self._create_simplifier()
 
             # create the store that holds stores
@@ -274,6 +352,12 @@ class NetCDFPlus(netCDF4.Dataset):
             self.check_version()
 
             self.reference_by_uuid = hasattr(self, 'use_uuid')
+            # BACKWARD COMPATIBILITY: files before 0.9.2 use UUID strings
+            self.binary_uuid = 'uuid_format' in self.ncattrs() and \
+                self.getncattr('uuid_format') == 'binary'
+            if self.reference_by_uuid:
+                self._restore_uuid_index()
+
             self._create_simplifier()
 
             # open the store that contains all stores
@@ -390,6 +474,166 @@ class NetCDFPlus(netCDF4.Dataset):
         self._storages_base_cls = {}
         self.vars = dict()
         self.units = dict()
+        self.binary_uuid = False
+        self.uuid_index = UUIDIndex()
+        self.uuid_index_start = dict()
+        self.write_buffer_size = 0
+        self._staged = 0
+        self._staged_length = dict()
+        self._dirty = set()
+
+        # held while a background thread (e.g. a `StepWriter`) writes to the
+        # file, since neither netCDF4 nor the indices are thread-safe
+        self.lock = threading.RLock()
+
+    def set_write_behind(self, buffer_size=10000):
+        """
+        Stage new rows in memory and write them in blocks
+
+        Instead of writing each row of each variable when an object is
+        saved, the rows are kept by the variable delegates in `vars` and
+        written as contiguous blocks when `sync` or `close` is called,
+        when `buffer_size` rows are staged or when a variable is read.
+        Indices and UUIDs are assigned at once as usual and the lengths of
+        the stores include the staged rows. Reading directly from the
+        `netCDF4.Variable` of the storage (not of a store) does not see
+        the staged rows.
+
+        Parameters
+        ----------
+        buffer_size : int
+            the number of staged rows that triggers writing all of them.
+            `0` disables write-behind (and writes all staged rows)
+        """
+        self.write_buffer_size = buffer_size
+        if not buffer_size:
+            self.flush_writes()
+
+    def stage(self, delegate, idx):
+        """
+        Register a row staged by a variable delegate
+
+        Parameters
+        ----------
+        delegate : :class:`NetCDFPlus.ValueDelegate`
+            the delegate that keeps the row
+        idx : int
+            the index of the row
+        """
+        self._dirty.add(delegate)
+        self._staged += 1
+        dimension = delegate.dimension
+        if idx >= self._staged_length.get(dimension, 0):
+            self._staged_length[dimension] = idx + 1
+
+        if self._staged >= self.write_buffer_size:
+            self.flush_writes()
+
+    def flush_writes(self):
+        """
+        Write all rows staged by write-behind to the file
+        """
+        for delegate in self._dirty:
+            delegate.flush()
+
+        self._dirty.clear()
+        self._staged = 0
+        self._staged_length.clear()
+
+    def dimension_length(self, name):
+        """
+        Return the length of a dimension including staged rows
+
+        Parameters
+        ----------
+        name : str
+            the name of the dimension
+
+        Returns
+        -------
+        int
+        """
+        return max(
+            len(self.dimensions[name]), self._staged_length.get(name, 0))
+
+    def sync(self):
+        self.flush_writes()
+        super(NetCDFPlus, self).sync()
+
+    def close(self):
+        self.flush_writes()
+        if self.mode != 'r' and self.reference_by_uuid and \
+                self.uuid_index.modified and \
+                UUIDIndex.exists(self.uuid_index_file):
+            # keep a saved index up to date, a read-only storage does not
+            # change it
+            try:
+                self.save_uuid_index()
+            except (IOError, OSError) as e:
+                logger.warning('Could not update the saved UUID index: %s' % e)
+
+        super(NetCDFPlus, self).close()
+
+    @property
+    def uuid_index_file(self):
+        """
+        str : the prefix of the files of a saved `uuid_index`
+        """
+        return self.filename + '.uuids'
+
+    def save_uuid_index(self):
+        """
+        Save the UUID index next to the file
+
+        If a saved index exists when the file is opened again, it is
+        memory-mapped and only the UUIDs of objects saved since are read
+        from the file. Opening a large file will then no longer read all
+        UUIDs. Once saved, the index is updated when the storage is closed.
+        """
+        self.flush_writes()
+        lengths = dict(self.uuid_index_start)
+        for name, store in zip(self.uuid_index.names,
+                               self.uuid_index.store_list):
+            if store is not None:
+                lengths[name] = len(self.variables[name + '_uuid'])
+
+        self.uuid_index.save(self.uuid_index_file, lengths)
+
+    def _restore_uuid_index(self):
+        """
+        Memory-map a saved UUID index if it matches the file
+
+        The index is used if all UUID variables have at least as many rows
+        as when the index was saved and their last saved UUIDs are found at
+        the right positions. The rows added since are read by the stores in
+        `ObjectStore.load_indices` starting at `uuid_index_start`.
+        """
+        if not UUIDIndex.exists(self.uuid_index_file):
+            return
+
+        try:
+            lengths = self.uuid_index.load(self.uuid_index_file)
+            for name, length in lengths.items():
+                variable = self.variables[name + '_uuid']
+                if len(variable) < length:
+                    raise ValueError('store %s is shorter' % name)
+
+                if length > 0:
+                    keys, _ = self.uuid_keys(variable[length - 1:length])
+                    if len(keys) > 0 and self.uuid_index.locate(
+                            UUID(bytes=keys[0].ljust(16, '\x00'))
+                    ) != (name, length - 1):
+                        raise ValueError('store %s does not match' % name)
+
+        except (IOError, OSError, ValueError, KeyError) as e:
+            logger.info(
+                'Saved UUID index %s is not used: %s' %
+                (self.uuid_index_file, e))
+            self.uuid_index = UUIDIndex()
+            self.uuid_index_start = dict()
+            return
+
+        self.uuid_index_start = lengths
 
     def create_store(self, name, store, register_attr=True):
         """
@@ -606,6 +850,12 @@ class NetCDFPlus(netCDF4.Dataset):
         """
 
         if self.reference_by_uuid:
+            # reversed objects are indexed under the UUID of their partner
+            found = self.uuid_index.get(uuid) or \
+                self.uuid_index.get(StorableObject.ruuid(uuid))
+            if found is not None and uuid in found[0].index:
+                return found[0][uuid]
+
             for store in self.objects.values():
                 if uuid in store.index:
                     return store[uuid]
@@ -737,7 +987,9 @@ class NetCDFPlus(netCDF4.Dataset):
         object
             A object of netcdf compatible varible types
         """
-        if var_type.startswith('obj.') or var_type.startswith('lazyobj.'):
+        if self.is_binary_uuid_type(var_type):
+            nc_type = np.uint64
+        elif var_type.startswith('obj.') or var_type.startswith('lazyobj.'):
             if self.reference_by_uuid:
                 nc_type = str
             else:
@@ -747,6 +999,193 @@ class NetCDFPlus(netCDF4.Dataset):
 
         return nc_type
 
+    def is_binary_uuid_type(self, var_type):
+        """
+        Return `True` if variables of var_type store UUIDs in binary form
+
+        Binary UUIDs are stored as a pair of uint64 (the upper and lower
+        64 bits), lists of UUIDs as the concatenation of these pairs.
+
+        Parameters
+        ----------
+        var_type : str
+            the variable type
+
+        Returns
+        -------
+        bool
+        """
+        if not self.binary_uuid:
+            return False
+
+        return var_type == 'uuid' or self.reference_by_uuid and (
+            var_type.startswith('obj.') or var_type.startswith('lazyobj.'))
+
+    @staticmethod
+    def uuids_to_binary(uuids):
+        """
+        Encode a list of UUIDs as an array of pairs of uint64
+
+        Parameters
+        ----------
+        uuids : list of :class:`uuid.UUID` or None
+            the UUIDs to be encoded. `None` is encoded as `(0, 0)`
+
+        Returns
+        -------
+        numpy.ndarray, shape=(len(uuids), 2), dtype=numpy.uint64
+        """
+        return np.frombuffer(
+            ''.join(NetCDFPlus._null_uuid_bytes if uuid is None else uuid.bytes
+                    for uuid in uuids),
+            dtype='>u8'
+        ).reshape((-1, 2)).astype(np.uint64)
+
+    @staticmethod
+    def binary_to_uuids(values):
+        """
+        Decode an array of pairs of uint64 into a list of UUIDs
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            the encoded UUIDs, either as pairs or flat. Pairs of zeros
+            and masked (not written) values are decoded as `None`
+
+        Returns
+        -------
+        list of :class:`uuid.UUID` or None
+        """
+        data = np.ma.getdata(values).reshape((-1, 2))
+        missing = np.ma.getmaskarray(values).reshape((-1, 2)).any(axis=1)
+        missing |= ~data.any(axis=1)
+        raw = np.ascontiguousarray(data, dtype='>u8').tostring()
+        return [
+            None if miss else UUID(bytes=raw[16 * pos:16 * pos + 16])
+            for pos, miss in enumerate(missing.tolist())
+        ]
+
+    def to_uuids(self, value):
+        """
+        Return the UUIDs in a value read directly from a netCDF variable
+
+        Works for variables of type `uuid`, `obj.<store>` and
+        `lazyobj.<store>` in both the binary and the (older) string format.
+
+        Parameters
+        ----------
+        value : str or numpy.ndarray
+            the value of one entry of the variable
+
+        Returns
+        -------
+        list of :class:`uuid.UUID` or None
+        """
+        if self.binary_uuid:
+            return NetCDFPlus.binary_to_uuids(value)
+        else:
+            return [
+                None if w[0] == '-' else UUID(w)
+                for w in NetCDFPlus.to_uuid_chunks(value)
+            ]
+
+    def uuid_keys(self, values):
+        """
+        Return the set UUIDs of a `uuid` variable as keys for the UUID index
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            all values of the variable as read directly from the file
+
+        Returns
+        -------
+        keys : numpy.ndarray of `S16`
+            the UUIDs as 16 byte big-endian strings
+        rows : numpy.ndarray of int
+            the row of each UUID in the variable
+        """
+        if self.binary_uuid:
+            data = np.ma.getdata(values).reshape((-1, 2))
+            missing = np.ma.getmaskarray(values).reshape((-1, 2)).any(axis=1)
+            missing |= ~data.any(axis=1)
+            rows = np.flatnonzero(~missing)
+            return UUIDIndex.keys_from_binary(data[rows]), rows
+        else:
+            rows = [
+                row for row, w in enumerate(values)
+                if len(w) > 0 and w[0] != '-'
+            ]
+            keys = np.array(
+                [UUID(values[row]).bytes for row in rows], dtype='S16')
+            return keys, np.array(rows, dtype=np.int64)
+
+    def create_binary_uuid_delegate(self, var_type, store, vlen):
+        """
+        Create getter and setter for a variable with binary UUIDs
+
+        Parameters
+        ----------
+        var_type : str
+            the variable type, `uuid`, `obj.<store>` or `lazyobj.<store>`
+        store : :class:`openpathsampling.netcdfplus.ObjectStore` or None
+            the store of referenced objects
+        vlen : bool
+            if `True` each entry of the variable holds a list
+
+        Returns
+        -------
+        getter : function
+        setter : function
+        """
+        decode = NetCDFPlus.binary_to_uuids
+        encode = NetCDFPlus.uuids_to_binary
+
+        if var_type == 'uuid':
+            to_obj = lambda uuid: uuid
+            from_obj = lambda obj: obj
+            is_iterable = lambda v: hasattr(v, '__iter__')
+        else:
+            if var_type.startswith('obj.'):
+                to_obj = lambda uuid: store.load(uuid)
+            else:
+                to_obj = lambda uuid: LoaderProxy(store, uuid)
+
+            from_obj = lambda obj: store.save(obj)
+            base_type = store.content_class
+            is_iterable = lambda v: \
+                v.base_cls is not base_type if hasattr(v, 'base_cls') else \
+                hasattr(v, '__iter__')
+
+        def get_entry(v):
+            objs = [None if uuid is None else to_obj(uuid)
+                    for uuid in decode(v)]
+            if vlen or np.ndim(v) > 1:
+                return objs
+            else:
+                return objs[0]
+
+        def getter(v):
+            if vlen and v.dtype == object:
+                # several entries of a vlen variable
+                return [get_entry(w) for w in v]
+            else:
+                return get_entry(v)
+
+        def setter(v):
+            if is_iterable(v):
+                values = list.__iter__(v) if isinstance(v, list) else v
+                binary = encode(
+                    [None if w is None else from_obj(w) for w in values])
+                if vlen:
+                    return binary.ravel()
+                else:
+                    return binary
+            else:
+                return encode([None if v is None else from_obj(v)])[0]
+
+        return getter, setter
+
     def create_type_delegate(self, var_type):
         """
         Create a variable value delegator for var_type
@@ -925,6 +1364,8 @@ class NetCDFPlus(netCDF4.Dataset):
     to_uuid_chunks = staticmethod(
         lambda x: [x[i:i + 36] for i in range(0, len(x), 36)])
 
+    _null_uuid_bytes = '\x00' * 16
+
     def create_variable_delegate(self, var_name):
         """
         Create a delegate property that wraps the netcdf.Variable and takes care
@@ -945,7 +1386,11 @@ class NetCDFPlus(netCDF4.Dataset):
 
             getter, setter, store = self.create_type_delegate(var.var_type)
 
-            if self.reference_by_uuid:
+            if self.is_binary_uuid_type(var.var_type):
+                getter, setter = self.create_binary_uuid_delegate(
+                    var.var_type, store, hasattr(var, 'var_vlen'))
+
+            elif self.reference_by_uuid:
 
                 to_uuid_chunks = NetCDFPlus.to_uuid_chunks
 
@@ -1006,7 +1451,7 @@ class NetCDFPlus(netCDF4.Dataset):
                         getter = _get2(lambda v: v)
 
             self.vars[var_name] = \
-                NetCDFPlus.ValueDelegate(var, getter, setter, store)
+                NetCDFPlus.ValueDelegate(var, getter, setter, store, self)
 
         else:
             raise ValueError("Variable '%s' is already taken!" % var_name)
@@ -1084,7 +1529,8 @@ class NetCDFPlus(netCDF4.Dataset):
         else:
             variable_length = False
 
-        if var_type == 'obj' or var_type == 'lazyobj':
+        if var_type == 'obj' or var_type == 'lazyobj' or (
+                self.is_binary_uuid_type(var_type) and not variable_length):
             dimensions.append('pair')
             if chunksizes is not None:
                 chunksizes = tuple(list(chunksizes) + [2])
@@ -2,6 +2,7 @@ import logging
 import weakref
 
 import yaml
+import numpy as np
 from uuid import UUID
 
 from cache import MaxCache, Cache, NoCache, WeakLRUCache
@@ -45,6 +46,232 @@ class UUIDDict(OrderedDict):
         return OrderedDict.get(self, self.id(item), default)
 
 
+class IndexedUUIDDict(object):
+    """
+    A dict of UUIDs that also finds the objects of a store in the storage index
+
+    The positions of objects restored from a file are only kept in the
+    :class:`openpathsampling.netcdfplus.uuidindex.UUIDIndex` of the storage.
+    The entries set in this session are kept in an `OrderedDict`.
+
+    This is not a subclass of `OrderedDict`, since `OrderedDict.__setitem__`
+    uses `__contains__` to decide if a key has to be linked and would not
+    link keys that are already in the storage index.
+    """
+    id = staticmethod(UUIDDict.id)
+
+    def __init__(self, uuid_index, store, factor=1):
+        """
+        Parameters
+        ----------
+        uuid_index : :class:`openpathsampling.netcdfplus.uuidindex.UUIDIndex`
+            the index of the storage
+        store : :class:`ObjectStore`
+            the store whose objects are looked up in the index
+        factor : int
+            the position in the index is multiplied by this factor
+        """
+        self.uuid_index = uuid_index
+        self.store = store
+        self.factor = factor
+        self.session = OrderedDict()
+
+    def _lookup(self, uuid):
+        found = self.uuid_index.get(uuid)
+        if found is not None and found[0] is self.store:
+            return found[1] * self.factor
+
+        return None
+
+    def __getitem__(self, item):
+        uuid = self.id(item)
+        try:
+            return self.session[uuid]
+        except KeyError:
+            value = self._lookup(uuid)
+            if value is None:
+                raise KeyError(item)
+
+            return value
+
+    def __setitem__(self, key, value):
+        self.session[self.id(key)] = value
+
+    def __delitem__(self, key):
+        del self.session[self.id(key)]
+
+    def __contains__(self, item):
+        uuid = self.id(item)
+        return uuid in self.session or self._lookup(uuid) is not None
+
+    def get(self, item, default=None):
+        uuid = self.id(item)
+        value = self.session.get(uuid)
+        if value is None:
+            value = self._lookup(uuid)
+
+        return default if value is None else value
+
+    def _index_items(self):
+        return sorted(
+            [(uuid, pos * self.factor)
+             for uuid, pos in self.uuid_index.items(self.store)],
+            key=lambda item: item[1])
+
+    def _index_count(self):
+        return self.uuid_index.count(self.store)
+
+    def iteritems(self):
+        # restored objects first and in the order they were saved. Loaded
+        # objects are also set in `session`, so that may change meanwhile
+        for uuid, value in self._index_items():
+            yield uuid, self.session.get(uuid, value)
+
+        for uuid, value in self.session.items():
+            if self._lookup(uuid) is None:
+                yield uuid, value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __iter__(self):
+        for uuid, _ in self.iteritems():
+            yield uuid
+
+    def keys(self):
+        return [uuid for uuid in self]
+
+    def values(self):
+        return [value for _, value in self.iteritems()]
+
+    def __len__(self):
+        return self._index_count() + len([
+            uuid for uuid in self.session
+            if self._lookup(uuid) is None])
+
+
+class IndexedPositionDict(dict):
+    """
+    A dict from indices to positions that reads restored entries lazily
+
+    Stores that save objects under arbitrary integer indices keep the index
+    of each position in their `index` variable. Instead of filling a dict
+    from it when a file is opened, the variable is only read and sorted at
+    the first lookup and then searched by bisection. The dict itself holds
+    the entries set in this session.
+    """
+    def __init__(self, store):
+        """
+        Parameters
+        ----------
+        store : :class:`ObjectStore`
+            the store with the `index` variable
+        """
+        dict.__init__(self)
+        self.store = store
+        self._restored = False
+        self._keys = None
+        self._positions = None
+        self._deleted = set()
+
+    def restore(self):
+        """
+        Use the entries in the `index` variable of the store from now on
+        """
+        self._restored = True
+        self._keys = None
+
+    def _load(self):
+        values = self.store.variables['index'][:]
+        valid = ~np.ma.getmaskarray(values)
+        positions = np.flatnonzero(valid)
+        keys = np.ma.getdata(values)[valid].astype(np.int64)
+
+        # like filling a dict in order of the positions keep the last one
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        positions = positions[order]
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        self._keys = keys[last]
+        self._positions = positions[last]
+
+    def _lookup(self, key):
+        if not self._restored or key in self._deleted or \
+                not isinstance(key, (int, long, np.integer)):
+            return None
+
+        if self._keys is None:
+            self._load()
+
+        at = int(np.searchsorted(self._keys, key))
+        if at < len(self._keys) and self._keys[at] == key:
+            return int(self._positions[at])
+
+        return None
+
+    def __getitem__(self, key):
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            value = self._lookup(key)
+            if value is None:
+                raise KeyError(key)
+
+            return value
+
+    def __setitem__(self, key, value):
+        self._deleted.discard(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if dict.__contains__(self, key):
+            dict.__delitem__(self, key)
+        elif self._lookup(key) is None:
+            raise KeyError(key)
+
+        self._deleted.add(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self._lookup(key) is not None
+
+    def get(self, key, default=None):
+        value = dict.get(self, key)
+        if value is None:
+            value = self._lookup(key)
+
+        return default if value is None else value
+
+    def __iter__(self):
+        if self._restored:
+            if self._keys is None:
+                self._load()
+
+            for key in self._keys.tolist():
+                if key not in self._deleted and \
+                        not dict.__contains__(self, key):
+                    yield key
+
+        for key in dict.__iter__(self):
+            yield key
+
+    def keys(self):
+        return [key for key in self]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [value for _, value in self.iteritems()]
+
+    def __len__(self):
+        return len(self.keys())
+
+
 class UUIDDictWeak(WeakKeyDictionary):
     def __init__(self):
         WeakKeyDictionary.__init__(self)
@@ -110,6 +337,25 @@ class ObjectStore(StorableNamedObject):
         def __getitem__(self, item):
             return self.dct[self.prefix + item]
 
+    class VariableDelegator(DictDelegator):
+        """
+        Gives access to the netCDF variables of a store
+
+        Rows staged by the write-behind of the variable delegates are
+        written first, so the variables always show all saved rows.
+        """
+        def __init__(self, store, dct, delegates):
+            super(ObjectStore.VariableDelegator, self).__init__(store, dct)
+            self.delegates = delegates
+
+        def __getitem__(self, item):
+            name = self.prefix + item
+            delegate = self.delegates.get(name)
+            if delegate is not None:
+                delegate.flush()
+
+            return self.dct[name]
+
     def prefix_delegate(self, dct):
         return ObjectStore.DictDelegator(self, dct)
 
@@ -232,7 +478,8 @@ class ObjectStore(StorableNamedObject):
         self._storage = storage
         self.prefix = prefix
 
-        self.variables = self.prefix_delegate(self.storage.variables)
+        self.variables = ObjectStore.VariableDelegator(
+            self, self.storage.variables, self.storage.vars)
         self.units = self.prefix_delegate(self.storage.units)
         self.vars = self.prefix_delegate(self.storage.vars)
 
@@ -242,7 +489,7 @@ class ObjectStore(StorableNamedObject):
             self.index = self.create_int_index()
 
     def create_uuid_index(self):
-        return UUIDDict()
+        return IndexedUUIDDict(self.storage.uuid_index, self)
 
     def create_int_index(self):
         return UUIDDictWeak()
@@ -256,9 +503,11 @@ class ObjectStore(StorableNamedObject):
             self.load_indices()
 
     def load_indices(self):
-        uuids = self.vars['uuid'][:]
-        for idx, uuid in enumerate(uuids):
-            self.index[uuid] = idx
+        # rows before `start` are already in a saved index
+        start = self.storage.uuid_index_start.get(self.prefix, 0)
+        keys, positions = self.storage.uuid_keys(
+            self.variables['uuid'][start:])
+        self.storage.uuid_index.add_many(keys, self, positions + start)
 
     @property
     def storage(self):
@@ -365,7 +614,7 @@ class ObjectStore(StorableNamedObject):
             number of stored objects
 
         """
-        return len(self.storage.dimensions[self.prefix])
+        return self.storage.dimension_length(self.prefix)
 
     def write(self, variable, idx, obj, attribute=None):
         if attribute is None:
@@ -582,7 +831,6 @@ class ObjectStore(StorableNamedObject):
             )
 
         if self.storage.reference_by_uuid:
-            # TODO: Change to 16byte string
             self.create_variable(
                 "uuid", 'uuid',
                 description='The uuid of the object',
@@ -981,6 +1229,7 @@ class ObjectStore(StorableNamedObject):
     def _set_id(self, idx, obj):
         if self.reference_by_uuid:
             self.vars['uuid'][idx] = obj.__uuid__
+            self.storage.uuid_index.add(obj.__uuid__, self, idx)
 
     def _get_id(self, idx, obj):
         if self.reference_by_uuid:
@@ -1038,7 +1287,7 @@ class NamedObjectStore(ObjectStore):
         if idx not in self.cache:
             obj = super(NamedObjectStore, self).add_single_to_cache(idx, json)
 
-            name = self.storage.variables[self.prefix + '_name'][idx]
+            name = self.variables['name'][idx]
             setattr(obj, '_name', name)
             if name != '':
                 self._update_name_in_cache(obj._name, idx)
@@ -1070,7 +1319,7 @@ class NamedObjectStore(ObjectStore):
         """
         if not self._names_loaded:
             for idx, name in enumerate(
-                    self.storage.variables[self.prefix + "_name"][:]):
+                    self.variables['name'][:]):
                 self._update_name_in_cache(name, idx)
 
             self._names_loaded = True
@@ -1181,7 +1430,7 @@ class NamedObjectStore(ObjectStore):
         if obj is not None:
             n_idx = self.index[obj]
             setattr(obj, '_name',
-                    self.storage.variables[self.prefix + '_name'][n_idx])
+                    self.variables['name'][n_idx])
             # make sure that you cannot change the name of loaded objects
             obj.fix_name()
 
@@ -1242,7 +1491,7 @@ class NamedObjectStore(ObjectStore):
             raise
 
         n_idx = self.index[obj]
-        self.storage.variables[self.prefix + '_name'][n_idx] = name
+        self.variables['name'][n_idx] = name
         self._update_name_in_cache(name, n_idx)
 
         return reference
@@ -1483,7 +1732,7 @@ class VariableStore(ObjectStore):
 
         if not self._cached_all:
             data = zip(*[
-                self.storage.variables[self.prefix + '_' + var][part]
+                self.variables[var][part]
                 for var in self.var_names
             ])
 
@@ -1636,7 +1885,7 @@ class DictStore(NamedObjectStore):
             (str(obj.__class__), idx, n_idx))
         self._save(obj, n_idx)
 
-        self.storage.variables[self.prefix + '_name'][n_idx] = idx
+        self.variables['name'][n_idx] = idx
         self._update_name_in_cache(idx, n_idx)
 
         return n_idx
@@ -1743,7 +1992,7 @@ class IndexedObjectStore(ObjectStore):
         return False
 
     def create_int_index(self):
-        return dict()
+        return IndexedPositionDict(self)
 
     def save(self, obj, idx=None):
         """
@@ -1796,8 +2045,7 @@ class IndexedObjectStore(ObjectStore):
         return idx
 
     def restore(self):
-        for pos, idx in enumerate(self.vars['index'][:]):
-            self.index[idx] = pos
+        self.index.restore()
 
     def initialize(self):
         super(IndexedObjectStore, self).initialize()
@@ -77,9 +77,13 @@ class LoaderProxy(object):
     def _load_(self):
         """
         Call the loader and get the referenced object
+
+        The lock of the storage is held while loading, since a background
+        thread (e.g. a `StepWriter`) might write to it at the same time.
         """
         try:
-            return self._store[self._idx]
+            with self._store.storage.lock:
+                return self._store[self._idx]
         except KeyError:
             if type(self._idx) is int:
                 raise RuntimeWarning(
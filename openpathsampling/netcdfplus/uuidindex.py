@@ -0,0 +1,427 @@
+'''
+A storage-wide index of UUIDs.
+
+In storages that reference objects by UUID each store has to know at which
+position an object with a given UUID is stored and the storage has to know
+in which store it is. Instead of a python dict per store (which has to be
+rebuilt from the file for millions of UUIDs at every opening) all UUIDs
+are kept in one :class:`UUIDIndex`: sorted numpy arrays of the 16-byte
+UUIDs with the store and the position of each, searched by bisection.
+The arrays are built with a few vectorized operations from the UUID
+variables of the stores, which are the persistent copy of the index.
+
+New UUIDs are collected in sorted runs whose sizes decrease at least by a
+factor of two from the oldest to the newest. A new run is merged with the
+previous one as long as that is not twice as large (like in a log
+structured merge tree), so each entry is copied only O(log n) times while
+the index grows and a lookup searches O(log n) runs.
+
+The arrays can also be saved next to the storage with
+:meth:`UUIDIndex.save` and memory-mapped from there when the storage is
+opened again. Then only the UUIDs of objects saved since are read from the
+file.
+'''
+
+import os
+import numpy as np
+from uuid import UUID
+
+
+class UUIDIndex(object):
+    """
+    Map UUIDs to the store and position of an object
+
+    New entries are kept in a small dict and added as a sorted run once
+    there are `merge_size` of them.
+
+    Attributes
+    ----------
+    runs : list of tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        the sorted runs, oldest first. Each has the UUIDs as 16 byte
+        big-endian strings (`S16`), the number of the store of each UUID
+        (`-1` for removed ones) and its position in the store. For equal
+        UUIDs the newest run wins
+    names : list of str
+        the names (prefixes) of the stores. The number of a store is its
+        position here
+    store_list : list of :class:`openpathsampling.netcdfplus.ObjectStore`
+        the registered stores or `None` if a store of a loaded index was
+        not registered yet
+    merge_size : int
+        the number of new entries kept before they are merged
+    modified : bool
+        `True` if entries were added or removed since the index was
+        created, saved or loaded
+    """
+
+    parts = ['keys', 'stores', 'positions', 'names']
+
+    def __init__(self, merge_size=10000):
+        """
+        Parameters
+        ----------
+        merge_size : int
+            the number of new entries kept before they are added as a
+            sorted run
+        """
+        self.merge_size = merge_size
+        self.names = []
+        self.store_list = []
+        self._store_numbers = {}
+        self.modified = False
+        self.runs = []
+        self._pending = {}
+
+    @staticmethod
+    def keys_from_binary(values):
+        """
+        Return the 16 byte keys of UUIDs stored as pairs of uint64
+
+        Parameters
+        ----------
+        values : numpy.ndarray, shape=(n, 2)
+            the UUIDs as written by `NetCDFPlus.uuids_to_binary`
+
+        Returns
+        -------
+        numpy.ndarray of `S16`
+        """
+        return np.ascontiguousarray(
+            np.ma.getdata(values), dtype='>u8'
+        ).reshape((-1, 2)).view('S16').ravel()
+
+    def register(self, store):
+        """
+        Return the number of a store, registering it if necessary
+
+        Parameters
+        ----------
+        store : :class:`openpathsampling.netcdfplus.ObjectStore`
+
+        Returns
+        -------
+        int
+        """
+        name = store.prefix
+        number = self._store_numbers.get(name)
+        if number is None:
+            number = len(self.names)
+            self.names.append(name)
+            self.store_list.append(store)
+            self._store_numbers[name] = number
+        elif self.store_list[number] is not store:
+            self.store_list[number] = store
+
+        return number
+
+    def add(self, uuid, store, position):
+        """
+        Add or replace a single UUID
+
+        Parameters
+        ----------
+        uuid : :class:`uuid.UUID`
+        store : :class:`openpathsampling.netcdfplus.ObjectStore`
+        position : int
+        """
+        self._pending[uuid.bytes] = (self.register(store), position)
+        self.modified = True
+        if len(self._pending) >= self.merge_size:
+            self.merge()
+
+    def add_many(self, keys, store, positions):
+        """
+        Add or replace the UUIDs of many objects of one store at once
+
+        Parameters
+        ----------
+        keys : numpy.ndarray of `S16`
+            the UUIDs as 16 byte big-endian strings
+        store : :class:`openpathsampling.netcdfplus.ObjectStore`
+        positions : numpy.ndarray of int
+            the positions in the store
+        """
+        self.merge()
+        number = self.register(store)
+        if len(keys) > 0:
+            self.modified = True
+
+        self._add_run(
+            np.asarray(keys, dtype='S16'),
+            np.repeat(np.int32(number), len(keys)),
+            np.asarray(positions, dtype=np.int64))
+
+    def merge(self):
+        """
+        Add all new entries as a sorted run
+        """
+        if not self._pending:
+            return
+
+        keys = np.array(self._pending.keys(), dtype='S16')
+        values = np.array(
+            self._pending.values(), dtype=np.int64).reshape((-1, 2))
+        self._pending.clear()
+        self._add_run(keys, values[:, 0].astype(np.int32), values[:, 1])
+
+    @staticmethod
+    def _unique_last(keys, stores, positions):
+        # keys are sorted and the last of equal keys is the newest
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        return keys[last], stores[last], positions[last]
+
+    @staticmethod
+    def _merge_runs(old, new):
+        # insert the new entries after equal old ones and keep the new ones
+        at = np.searchsorted(old[0], new[0], side='right')
+        return UUIDIndex._unique_last(*[
+            np.insert(old_part, at, new_part)
+            for old_part, new_part in zip(old, new)])
+
+    def _add_run(self, keys, stores, positions):
+        if len(keys) == 0:
+            return
+
+        order = np.argsort(keys, kind='mergesort')
+        run = UUIDIndex._unique_last(
+            keys[order], stores[order], positions[order])
+
+        while self.runs and len(self.runs[-1][0]) < 2 * len(run[0]):
+            run = UUIDIndex._merge_runs(self.runs.pop(), run)
+
+        self.runs.append(run)
+
+    def consolidate(self):
+        """
+        Merge all entries into a single sorted run
+        """
+        self.merge()
+        while len(self.runs) > 1:
+            new = self.runs.pop()
+            self.runs.append(UUIDIndex._merge_runs(self.runs.pop(), new))
+
+    def _arrays(self):
+        self.consolidate()
+        if self.runs:
+            return self.runs[0]
+
+        return (
+            np.zeros(0, dtype='S16'),
+            np.zeros(0, dtype=np.int32),
+            np.zeros(0, dtype=np.int64))
+
+    def _find(self, key):
+        probe = np.array([key], dtype='S16')
+        for keys, stores, positions in reversed(self.runs):
+            at = int(np.searchsorted(keys, probe)[0])
+            if at < len(keys) and keys[at] == probe[0]:
+                return int(stores[at]), int(positions[at])
+
+        return None
+
+    def _locate(self, key):
+        found = self._pending.get(key)
+        if found is None:
+            found = self._find(key)
+
+        if found is None or found[0] < 0:
+            return None
+
+        return found
+
+    def locate(self, uuid):
+        """
+        Return the name of the store and the position of a UUID
+
+        Parameters
+        ----------
+        uuid : :class:`uuid.UUID`
+
+        Returns
+        -------
+        tuple(str, int) or None
+            `None` if the UUID is not in the index
+        """
+        found = self._locate(uuid.bytes)
+        if found is None:
+            return None
+
+        return self.names[found[0]], found[1]
+
+    def get(self, uuid, default=None):
+        """
+        Return the store and position of a UUID
+
+        Parameters
+        ----------
+        uuid : :class:`uuid.UUID`
+        default : object
+            returned if the UUID is not in the index or its store is not
+            registered
+
+        Returns
+        -------
+        tuple(:class:`openpathsampling.netcdfplus.ObjectStore`, int)
+        """
+        found = self._locate(uuid.bytes)
+        if found is None or self.store_list[found[0]] is None:
+            return default
+
+        return self.store_list[found[0]], found[1]
+
+    def __contains__(self, uuid):
+        return self.get(uuid) is not None
+
+    def remove(self, uuid):
+        """
+        Remove a UUID from the index
+
+        Parameters
+        ----------
+        uuid : :class:`uuid.UUID`
+        """
+        self._pending[uuid.bytes] = (-1, 0)
+        self.modified = True
+        if len(self._pending) >= self.merge_size:
+            self.merge()
+
+    def items(self, store):
+        """
+        Return the UUIDs and positions of all objects of a store
+
+        Parameters
+        ----------
+        store : :class:`openpathsampling.netcdfplus.ObjectStore`
+
+        Returns
+        -------
+        list of tuple(:class:`uuid.UUID`, int)
+        """
+        number = self._store_numbers.get(store.prefix)
+        if number is None:
+            return []
+
+        keys, stores, positions = self._arrays()
+        mask = stores == number
+        return [
+            (UUID(bytes=key.ljust(16, '\x00')), position)
+            for key, position in zip(
+                keys[mask].tolist(), positions[mask].tolist())
+        ]
+
+    def count(self, store):
+        """
+        Return the number of UUIDs of a store
+
+        Parameters
+        ----------
+        store : :class:`openpathsampling.netcdfplus.ObjectStore`
+
+        Returns
+        -------
+        int
+        """
+        number = self._store_numbers.get(store.prefix)
+        if number is None:
+            return 0
+
+        return int((self._arrays()[1] == number).sum())
+
+    def __len__(self):
+        return int((self._arrays()[1] >= 0).sum())
+
+    @staticmethod
+    def _part_file(filename, part):
+        return '%s.%s.npy' % (filename, part)
+
+    @classmethod
+    def exists(cls, filename):
+        """
+        Return `True` if an index was saved under `filename`
+
+        Parameters
+        ----------
+        filename : str
+            the prefix of the files of the index
+
+        Returns
+        -------
+        bool
+        """
+        return all(
+            os.path.isfile(cls._part_file(filename, part))
+            for part in cls.parts)
+
+    def save(self, filename, lengths):
+        """
+        Save the index to numpy files that can be memory-mapped
+
+        Each file is first written under a temporary name and then moved,
+        so an index that is currently memory-mapped from the same files
+        stays valid.
+
+        Parameters
+        ----------
+        filename : str
+            the prefix of the files
+        lengths : dict of str to int
+            the number of rows of the UUID variable of each store that
+            are contained in the index
+        """
+        keys, stores, positions = self._arrays()
+        size = max([1] + [len(name) for name in self.names])
+        names = np.array(
+            [(name, lengths.get(name, 0)) for name in self.names],
+            dtype=[('name', 'S%d' % size), ('length', np.int64)])
+
+        arrays = {
+            'keys': keys,
+            'stores': stores,
+            'positions': positions,
+            'names': names
+        }
+
+        for part in self.parts:
+            fn = self._part_file(filename, part)
+            with open(fn + '.tmp', 'wb') as f:
+                np.save(f, arrays[part])
+
+            os.rename(fn + '.tmp', fn)
+
+        self.modified = False
+
+    def load(self, filename):
+        """
+        Replace the content of the index by memory-mapping saved files
+
+        Stores are registered by name and have to be registered again
+        (which happens when entries are added for them) before `get` will
+        find their objects.
+
+        Parameters
+        ----------
+        filename : str
+            the prefix of the files
+
+        Returns
+        -------
+        dict of str to int
+            the number of rows of the UUID variable of each store that
+            are contained in the index
+        """
+        names = np.load(self._part_file(filename, 'names'))
+        self.runs = [tuple(
+            np.load(self._part_file(filename, part), mmap_mode='r')
+            for part in ['keys', 'stores', 'positions'])]
+
+        self.names = [str(name) for name in names['name']]
+        self.store_list = [None] * len(self.names)
+        self._store_numbers = {
+            name: number for number, name in enumerate(self.names)}
+        self._pending.clear()
+        self.modified = False
+
+        return {
+            str(name): int(length)
+            for name, length in zip(names['name'], names['length'])}
@@ -71,12 +71,18 @@ class PathSimulator(StorableNamedObject):
     output_stream : file
         Subclasses should write output to this, allowing a standard way to
         redirect any output.
+    step_writer : :class:`openpathsampling.step_writer.StepWriter` or None
+        if set, steps are saved and the storage synced in a background
+        thread by the writer. While it runs, the storage must only be used
+        while holding `storage.lock` (see :mod:`openpathsampling.step_writer`)
     """
     __metaclass__ = abc.ABCMeta
 
     calc_name = "PathSimulator"
     _excluded_attr = ['sample_set', 'step', 'save_frequency',
-                      'output_stream']
+                      'output_stream', 'step_writer']
+
+    step_writer = None
 
     def __init__(self, storage):
         super(PathSimulator, self).__init__()
@@ -95,7 +101,9 @@ class PathSimulator(StorableNamedObject):
         """
         Will sync all collective variables and the storage to disk
         """
-        if self.storage is not None:
+        if self.step_writer is not None:
+            self.step_writer.sync()
+        elif self.storage is not None:
             self.storage.sync_all()
 
     @abc.abstractmethod
@@ -591,7 +599,10 @@ class PathSampling(PathSimulator):
 
         """
         if self.storage is not None and self._current_step is not None:
-            self.storage.steps.save(self._current_step)
+            if self.step_writer is not None:
+                self.step_writer.submit(self._current_step)
+            else:
+                self.storage.steps.save(self._current_step)
 
     @classmethod
     def from_step(cls, storage, step, initialize=True):
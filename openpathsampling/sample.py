@@ -232,7 +232,7 @@ class SampleSet(StorableObject):
             logger.info("Checking sanity of " + repr(sample.ensemble) +
                         " with " + str(sample.trajectory))
             try:
-                assert(sample.ensemble(sample.trajectory))
+                assert(sample.ensemble.check(sample.trajectory))
             except AssertionError as e:
                 failmsg = ("Trajectory does not match ensemble for replica "
                            + str(sample.replica))
@@ -854,7 +854,7 @@ class Sample(StorableObject):
                 self._valid = True
             else:
                 if self.ensemble is not None:
-                    self._valid = self.ensemble(self.trajectory)
+                    self._valid = self.ensemble.check(self.trajectory)
                 else:
                     # no ensemble means ALL ???
                     self._valid = True
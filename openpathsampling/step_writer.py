@@ -0,0 +1,176 @@
+'''
+Saving of simulation steps in a background thread.
+
+A :class:`openpathsampling.PathSampling` simulation saves every
+:class:`openpathsampling.MCStep` right after it was generated and syncs the
+storage every `save_frequency` steps. For fast engines the serialization and
+disk I/O take as long as the move itself. If a :class:`StepWriter` is set as
+the `step_writer` of the simulator, the steps are handed to a background
+thread instead and the next move starts at once.
+
+The queue of the writer is bounded, so the simulation can never run more than
+`queue_size` steps ahead of the storage. If saving fails, the writer skips
+all remaining steps and the next call from the simulator raises the error,
+which stops the simulation.
+
+Thread safety
+-------------
+Neither netCDF4 nor the indices and caches of the stores and CVs are
+thread-safe. The writer therefore holds `storage.lock` while it saves a step
+and the simulation thread has to follow these rules while the writer runs:
+
+* the values of CVs that are stored for new snapshots are evaluated by
+  `submit` in the simulation thread, so saving does not use the CVs
+* CVs read values from their disk cache while holding `storage.lock`
+* proxies (e.g. the snapshots of trajectories loaded to restart a
+  simulation) load their objects while holding `storage.lock`
+* any other access to the storage from user code (loading or saving objects
+  directly, `pos` lookups) has to hold `storage.lock` as well, or wait until
+  `sync` or `stop` returned. `sync` blocks the simulation thread until the
+  writer is done, so syncing the CVs can read their caches safely.
+'''
+
+import logging
+import threading
+import Queue
+
+logger = logging.getLogger(__name__)
+
+
+class StepWriter(object):
+    """
+    Save steps to a storage in a background thread
+
+    Examples
+    --------
+    >>> sampler.step_writer = StepWriter(storage)
+    >>> sampler.run(1000)  # syncs and waits for the writer at the end
+    >>> sampler.step_writer.stop()
+
+    Attributes
+    ----------
+    storage : :class:`openpathsampling.storage.Storage`
+        the storage the steps are saved to
+    queue_size : int
+        the maximal number of steps waiting to be saved. Submitting more
+        blocks until the writer caught up
+    error : Exception or None
+        the error that stopped the writer
+    lock : threading.RLock
+        the lock of the storage that is held while the writer saves
+    """
+
+    def __init__(self, storage, queue_size=10):
+        """
+        Parameters
+        ----------
+        storage : :class:`openpathsampling.storage.Storage`
+            the storage the steps are saved to
+        queue_size : int
+            the maximal number of steps waiting to be saved
+        """
+        self.storage = storage
+        self.queue_size = queue_size
+        self.error = None
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._thread = None
+
+    @property
+    def lock(self):
+        return self.storage.lock
+
+    @property
+    def running(self):
+        """bool : `True` if the background thread is running"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Start the background thread (done automatically by `submit`)
+        """
+        if not self.running:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def check(self):
+        """
+        Raise an error if saving failed
+
+        Raises
+        ------
+        RuntimeError
+            if the writer stopped because of an error
+        """
+        if self.error is not None:
+            raise RuntimeError(
+                'Saving to the storage failed in the step writer: %s' %
+                self.error)
+
+    def submit(self, step):
+        """
+        Queue a step to be saved
+
+        Parameters
+        ----------
+        step : :class:`openpathsampling.MCStep`
+            the step to be saved. It must not be changed afterwards
+        """
+        self.check()
+        self.start()
+
+        # evaluate the CVs in this thread, saving only writes the values
+        snapshots = [
+            snapshot
+            for sample in list(step.active) + list(step.change.trials)
+            for snapshot in sample.trajectory
+        ]
+        cv_values = self.storage.snapshots.auto_complete_values(snapshots)
+        self._queue.put((self._save_step, (step, cv_values)))
+
+    def _save_step(self, step, cv_values):
+        snapshot_store = self.storage.snapshots
+        snapshot_store.prepared_cv_values = cv_values
+        try:
+            self.storage.steps.save(step)
+        finally:
+            snapshot_store.prepared_cv_values = None
+
+    def sync(self):
+        """
+        Save all queued steps, sync the storage and wait until it is done
+        """
+        self.check()
+        self.start()
+        self._queue.put((self.storage.sync_all, ()))
+        self._queue.join()
+        self.check()
+
+    def stop(self):
+        """
+        Save all queued steps and stop the background thread
+        """
+        if self.running:
+            self._queue.put(None)
+            self._thread.join()
+
+        self._thread = None
+        self.check()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    # the stop signal
+                    return
+
+                if self.error is None:
+                    fnc, args = task
+                    with self.lock:
+                        fnc(*args)
+            except Exception as e:
+                logger.error('Step writer failed: %s' % e)
+                self.error = e
+            finally:
+                self._queue.task_done()
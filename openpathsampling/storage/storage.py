@@ -9,7 +9,7 @@ import time
 
 import openpathsampling as paths
 from openpathsampling.netcdfplus import NetCDFPlus, WeakLRUCache, ObjectStore, \
-    ImmutableDictStore, NamedObjectStore
+    ImmutableDictStore, NamedObjectStore, PositionCache
 import openpathsampling.engines as peng
 
 logger = logging.getLogger(__name__)
@@ -450,7 +450,7 @@ class AnalysisStorage(Storage):
 
     """
 
-    def __init__(self, filename, caching_mode='analysis'):
+    def __init__(self, filename, caching_mode='analysis', cv_arrays=False):
         """
         Open a storage in read-only and do caching useful for analysis.
 
@@ -464,6 +464,11 @@ class AnalysisStorage(Storage):
             size system and lots of memory you might want to try `unlimited`
             which will not load all objects but keep every object you load.
             This is fastest but might crash for large storages.
+        cv_arrays : bool
+            If `True` the stored CV values are memory-mapped from numpy
+            files next to the storage instead of being loaded into memory.
+            The files are created on first use, see
+            `SnapshotWrapperStore.cv_arrays`.
 
         """
         super(AnalysisStorage, self).__init__(
@@ -474,10 +479,10 @@ class AnalysisStorage(Storage):
         self.set_caching_mode(caching_mode)
 
         # Let's go caching
-        AnalysisStorage.cache_for_analysis(self)
+        AnalysisStorage.cache_for_analysis(self, cv_arrays=cv_arrays)
 
     @staticmethod
-    def cache_for_analysis(storage):
+    def cache_for_analysis(storage, cv_arrays=False):
         """
         Run specific caching useful for later analysis sessions.
 
@@ -485,12 +490,30 @@ class AnalysisStorage(Storage):
         ----------
         storage : :class:`openpathsampling.storage.Storage`
             The storage the caching should act upon.
+        cv_arrays : bool
+            If `True` use memory-mapped arrays for all CVs whose values
+            can be exported to numpy files
 
         """
 
         with AnalysisStorage.CacheTimer('Cached all CVs'):
             for cv, (cv_store, cv_store_idx) in \
                     storage.snapshots.cv_list.items():
+                if cv_arrays:
+                    try:
+                        values, valid = storage.snapshots.cv_arrays(cv)
+                    except (ValueError, IOError, OSError) as e:
+                        logger.info(
+                            'CV %s is not memory-mapped: %s' % (cv.name, e))
+                    else:
+                        # install the cache on the instance users get from
+                        # `storage.cvs`, not on the one in `cv_list`
+                        storage.cvs[cv.__uuid__].set_cache(
+                            PositionCache.from_arrays(
+                                storage.snapshots.pos, values, valid,
+                                time_reversible=cv_store.time_reversible))
+                        continue
+
                 cv_store.cache.load_max()
 
         stores_to_cache = ['cvs',
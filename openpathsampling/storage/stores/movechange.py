@@ -1,7 +1,6 @@
 from openpathsampling.movechange import MoveChange
 from openpathsampling.netcdfplus import StorableObject, ObjectStore
 
-from uuid import UUID
 
 
 class MoveChangeStore(ObjectStore):
@@ -118,9 +117,9 @@ class MoveChangeStore(ObjectStore):
     def _load_partial_subchanges(self, obj, subchanges_idxs):
         if len(subchanges_idxs) > 0:
             if self.reference_by_uuid:
-                subchanges_idxs = self.storage.to_uuid_chunks(subchanges_idxs)
-                obj.subchanges = \
-                    [self.load(UUID(idx)) for idx in subchanges_idxs]
+                obj.subchanges = [
+                    self.load(uuid)
+                    for uuid in self.storage.to_uuids(subchanges_idxs)]
             else:
                 obj.subchanges = \
                     [self.load(int(idx)) for idx in subchanges_idxs]
@@ -132,12 +131,13 @@ class MoveChangeStore(ObjectStore):
         cls = self.class_list[cls_name]
         obj = cls.__new__(cls)
         if self.reference_by_uuid:
-            if mover_idx[0] == '-':
+            mover_uuid = self.storage.to_uuids(mover_idx)[0]
+            if mover_uuid is None:
                 MoveChange.__init__(obj)
             else:
                 MoveChange.__init__(
                     obj,
-                    mover=self.storage.pathmovers[UUID(mover_idx)])
+                    mover=self.storage.pathmovers[mover_uuid])
         else:
             MoveChange.__init__(
                 obj,
@@ -145,16 +145,15 @@ class MoveChangeStore(ObjectStore):
 
         if self.reference_by_uuid:
             if len(samples_idxs) > 0:
-                samples_idxs = self.storage.to_uuid_chunks(samples_idxs)
-                input_samples_idxs = \
-                    self.storage.to_uuid_chunks(input_samples_idxs)
-                obj.samples = \
-                    [self.storage.samples[UUID(idx)] for idx in samples_idxs]
+                obj.samples = [
+                    self.storage.samples[uuid]
+                    for uuid in self.storage.to_uuids(samples_idxs)]
             if len(input_samples_idxs) > 0:
                 obj.input_samples = [
-                    self.storage.samples[UUID(idx)]
-                    for idx in input_samples_idxs]
-            obj.details = self.storage.details.proxy(str(details_idx))
+                    self.storage.samples[uuid]
+                    for uuid in self.storage.to_uuids(input_samples_idxs)]
+            obj.details = self.storage.details.proxy(
+                self.storage.to_uuids(details_idx)[0])
         else:
             if len(samples_idxs) > 0:
                 obj.samples = \
@@ -1,10 +1,15 @@
 import abc
+import itertools
+import os
 from collections import OrderedDict
 
+import numpy as np
+
 from openpathsampling.netcdfplus import StorableObject, LoaderProxy
-from openpathsampling.netcdfplus.objects import UUIDDict, IndexedObjectStore
+from openpathsampling.netcdfplus.objects import UUIDDict, IndexedObjectStore, \
+    IndexedUUIDDict, IndexedPositionDict
 from openpathsampling.netcdfplus import NetCDFPlus, ObjectStore, \
-    LRUChunkLoadingCache
+    LRUChunkLoadingCache, PositionCache
 import openpathsampling.engines as peng
 
 import logging
@@ -28,6 +33,43 @@ class UUIDReversalDict(UUIDDict):
         OrderedDict.__delitem__(self, self.rev_id(key))
 
 
+class IndexedUUIDReversalDict(IndexedUUIDDict):
+    """
+    An IndexedUUIDDict for snapshots and their reversed ones
+
+    Like in :class:`UUIDReversalDict`, the reversed snapshot of the one at
+    position `pos` is at `pos ^ 1`.
+    """
+    rev_id = staticmethod(UUIDReversalDict.rev_id)
+
+    def __setitem__(self, key, value):
+        self.session[self.id(key)] = value
+        self.session[self.rev_id(key)] = value ^ 1
+
+    def __delitem__(self, key):
+        del self.session[self.id(key)]
+        del self.session[self.rev_id(key)]
+
+    def _lookup(self, uuid):
+        value = IndexedUUIDDict._lookup(self, uuid)
+        if value is None:
+            value = IndexedUUIDDict._lookup(self, StorableObject.ruuid(uuid))
+            if value is not None:
+                value ^= 1
+
+        return value
+
+    def _index_items(self):
+        items = IndexedUUIDDict._index_items(self)
+        return sorted(
+            items + [(StorableObject.ruuid(uuid), value ^ 1)
+                     for uuid, value in items],
+            key=lambda item: item[1])
+
+    def _index_count(self):
+        return 2 * IndexedUUIDDict._index_count(self)
+
+
 # ==============================================================================
 # ABSTRACT BASE CLASS FOR SNAPSHOTS
 # ==============================================================================
@@ -236,11 +278,6 @@ class BaseSnapshotStore(IndexedObjectStore):
         if self.reference_by_uuid:
             self.vars['uuid'][int(idx / 2)] = obj.__uuid__
 
-    def load_indices(self):
-        if self.reference_by_uuid:
-            for pos, idx in enumerate(self.vars['index'][:]):
-                self.index[idx] = pos
-
     def all(self):
         return peng.Trajectory(map(self.proxy, range(len(self))))
 
@@ -301,7 +338,7 @@ class BaseSnapshotStore(IndexedObjectStore):
             return None
 
     def __len__(self):
-        return len(self.storage.dimensions[self.prefix]) * 2
+        return self.storage.dimension_length(self.prefix) * 2
 
 
 # ==============================================================================
@@ -369,6 +406,10 @@ class SnapshotWrapperStore(ObjectStore):
         # so CVs will be storable
         self.only_mention = False
 
+        # values from `auto_complete_values` used when saving snapshots
+        # instead of the caches and functions of the CVs
+        self.prepared_cv_values = None
+
     @property
     def treat_missing_snapshot_type(self):
         return self._treat_missing_snapshot_type
@@ -490,7 +531,7 @@ class SnapshotWrapperStore(ObjectStore):
             return snap
 
     def __len__(self):
-        return len(self.storage.dimensions[self.prefix]) * 2
+        return self.storage.dimension_length(self.prefix) * 2
 
     def initialize(self):
         super(SnapshotWrapperStore, self).initialize()
@@ -518,7 +559,7 @@ class SnapshotWrapperStore(ObjectStore):
 
         store = FeatureSnapshotStore(descriptor)
 
-        store_idx = int(len(self.storage.dimensions['snapshottype']))
+        store_idx = self.storage.dimension_length('snapshottype')
         store_name = 'snapshot' + str(store_idx)
         self.storage.register_store(store_name, store, False)
 
@@ -570,12 +611,8 @@ class SnapshotWrapperStore(ObjectStore):
 
             self.cv_list[cv] = (store, idx)
 
-        self.load_indices()
-
-    def load_indices(self):
         if self.reference_by_uuid:
-            for idx, uuid in enumerate(self.vars['uuid'][:]):
-                self.index[uuid] = idx * 2
+            self.load_indices()
 
     def get_cv_cache(self, idx):
         store_name = SnapshotWrapperStore._get_cv_name(idx)
@@ -694,7 +731,7 @@ class SnapshotWrapperStore(ObjectStore):
             mode = self.treat_missing_snapshot_type
             if mode == 'create' or \
                     (mode == 'single' and
-                             len(self.storage.dimensions['snapshottype']) == 0):
+                             self.storage.dimension_length('snapshottype') == 0):
                 # we just create space for it
                 store, store_idx = self.add_type(obj.engine.descriptor)
                 self.vars['store'][n_idx / 2] = store_idx
@@ -719,10 +756,57 @@ class SnapshotWrapperStore(ObjectStore):
                     )
                 )
 
+    def auto_complete_values(self, snapshots):
+        """
+        Evaluate the CVs that are filled in when saving new snapshots
+
+        Saving a snapshot also stores the values of all CVs that cannot be
+        incomplete, which reads their caches and can call their functions.
+        A background writer evaluates these values with this function in the
+        simulation thread and sets them as `prepared_cv_values` while
+        saving, so the CVs are only used by a single thread.
+
+        Parameters
+        ----------
+        snapshots : iterable of :obj:`openpathsampling.engines.BaseSnapshot`
+            the snapshots, already stored ones are skipped
+
+        Returns
+        -------
+        dict
+            the values by (cv, snapshot uuid)
+        """
+        with self.storage.lock:
+            missing = OrderedDict(
+                (snap.__uuid__, snap) for snap in snapshots
+                if snap not in self.index).values()
+
+        values = {}
+        for cv, (cv_store, cv_idx) in self.cv_list.items():
+            if not cv_store.allow_incomplete:
+                to_eval = []
+                for snap in missing:
+                    value = cv._cache_dict._get(snap)
+                    if value is None:
+                        to_eval.append(snap)
+                    else:
+                        values[(cv, snap.__uuid__)] = value
+
+                if to_eval and cv._eval_dict:
+                    for snap, value in zip(to_eval, cv._eval_dict(to_eval)):
+                        values[(cv, snap.__uuid__)] = value
+
+        return values
+
     def _auto_complete_single_snapshot(self, obj, pos):
+        prepared = self.prepared_cv_values
         for cv, (cv_store, cv_idx) in self.cv_list.items():
             if not cv_store.allow_incomplete:
-                value = cv._cache_dict._get(obj)
+                if prepared is not None and (cv, obj.__uuid__) in prepared:
+                    value = prepared[(cv, obj.__uuid__)]
+                else:
+                    value = cv._cache_dict._get(obj)
+
                 if value is None:
                     # not in cache so compute it if possible
                     if cv._eval_dict:
@@ -740,15 +824,81 @@ class SnapshotWrapperStore(ObjectStore):
                         cv_store.vars['value'][n_idx] = value
                         cv_store.cache[n_idx] = value
 
-    def complete_cv(self, cv):
+    @staticmethod
+    def _cv_values(cv, snapshots):
+        """
+        Return the values of a CV for a list of snapshots
+
+        Values are taken from the cache of the CV if possible and all
+        missing ones are computed in a single call of the CV function.
+
+        Returns
+        -------
+        list
+            the values, `None` if a value is not known and cannot be computed
+        """
+        values = list(cv._cache_dict._get_list(snapshots))
+        missing = [pos for pos, value in enumerate(values) if value is None]
+        if missing and cv._eval_dict:
+            computed = cv._eval_dict([snapshots[pos] for pos in missing])
+            for pos, value in zip(missing, computed):
+                values[pos] = value
+
+        return values
+
+    @staticmethod
+    def _stack_values(values):
+        """
+        Turn a list of CV values into an array for a single slice assignment
+        """
+        first = values[0]
+        if hasattr(first, 'unit') and hasattr(first, '_value'):
+            # a list of `simtk.unit.Quantity`
+            unit = first.unit
+            return np.array(
+                [value.value_in_unit(unit) for value in values]) * unit
+        else:
+            return np.array(values)
+
+    def _write_cv_values(self, cv_store, positions, values):
+        """
+        Append values to the store of an incomplete CV in one slice
+
+        Parameters
+        ----------
+        cv_store : :class:`SnapshotValueStore`
+        positions : list of int
+            the positions (in the CV store) of the snapshots
+        values : list
+            the values, all not `None`
+        """
+        if not positions:
+            return
+
+        n_start = cv_store.free()
+        n_end = n_start + len(positions)
+
+        cv_store.vars['value'][n_start:n_end] = self._stack_values(values)
+        cv_store.vars['index'][n_start:n_end] = positions
+
+        for n_idx, pos, value in zip(
+                range(n_start, n_end), positions, values):
+            cv_store.index[pos] = n_idx
+            cv_store.cache[n_idx] = value
+
+    def complete_cv(self, cv, chunksize=1000):
         """
         Compute all missing values of a CV and store them
 
+        The missing values are evaluated in chunks of snapshots with a
+        single call of the CV function and written with a single slice
+        assignment per chunk.
 
         Parameters
         ----------
         cv : :obj:`openpathsampling.CollectiveVariable`
-
+        chunksize : int
+            the number of snapshots evaluated and written at once
 
         """
         if cv not in self.cv_list:
@@ -758,80 +908,94 @@ class SnapshotWrapperStore(ObjectStore):
 
         if cv_store.allow_incomplete:
             # for complete this does not make sense
-
-            # TODO: Make better looping over this to not have
-            # to load all the indices at once
-            # can be problematic for 10M+ stored snapshots
-            if self.reference_by_uuid:
-                indices = self.vars['uuid'][:]
+            if cv_store.time_reversible:
+                n_positions = len(self) / 2
             else:
-                indices = range(0, len(self), 2)
-
-            for pos, idx in enumerate(indices):
-                if not cv_store.time_reversible:
-                    pos *= 2
-
-                proxy = None
-
-                if pos not in cv_store.index:
-                    # this value is not stored to go ahead
+                n_positions = len(self)
+
+            n_missing = n_positions - len(cv_store.index)
+            missing = self._missing_cv_snapshots(cv_store, chunksize)
+
+            n_done = 0
+            while True:
+                chunk = list(itertools.islice(missing, chunksize))
+                if not chunk:
+                    break
+
+                values = self._cv_values(cv, [snap for _, snap in chunk])
+
+                known = [
+                    (pos, value) for (pos, _), value in zip(chunk, values)
+                    if value is not None
+                ]
+                self._write_cv_values(
+                    cv_store,
+                    [pos for pos, _ in known],
+                    [value for _, value in known])
+
+                n_done += len(chunk)
+                logger.info(
+                    'Completed CV %s: %d of %d missing values' % (
+                        cv.name, n_done, n_missing))
+
+    def _missing_cv_snapshots(self, cv_store, chunksize):
+        """
+        Iterate the positions in a CV store without a value and their snapshots
 
-                    proxy = self.storage.snapshots[idx]
+        The uuids of the stored snapshots are read in blocks of `chunksize`,
+        so this does not load all indices at once.
 
-                    # get from cache first, this is fastest
-                    value = cv._cache_dict._get(proxy)
+        Parameters
+        ----------
+        cv_store : :class:`openpathsampling.netcdfplus.ValueStore`
+        chunksize : int
+            the number of snapshots read at once
 
-                    if value is None:
-                        # not in cache so compute it if possible
-                        if cv._eval_dict:
-                            value = cv._eval_dict([proxy])[0]
-                        else:
-                            value = None
+        Yields
+        ------
+        int
+            the position in the CV store
+        :class:`openpathsampling.engines.BaseSnapshot`
+            the snapshot for this position
 
-                    if value is not None:
-                        n_idx = cv_store.free()
+        """
+        n_snapshots = len(self) / 2
+        for block_start in range(0, n_snapshots, chunksize):
+            block_end = min(block_start + chunksize, n_snapshots)
+            if self.reference_by_uuid:
+                indices = self.vars['uuid'][block_start:block_end]
+            else:
+                indices = range(2 * block_start, 2 * block_end, 2)
 
-                        cv_store.vars['value'][n_idx] = value
-                        cv_store.vars['index'][n_idx] = pos
-                        cv_store.index[pos] = n_idx
-                        cv_store.cache[n_idx] = value
+            for snap_pos, idx in enumerate(indices, block_start):
+                if cv_store.time_reversible:
+                    positions = [(snap_pos, False)]
+                else:
+                    positions = [(2 * snap_pos, False),
+                                 (2 * snap_pos + 1, True)]
 
-                if not cv_store.time_reversible:
-                    pos += 1
-                    if pos not in cv_store.index:
-                        if proxy is None:
-                            proxy = self.storage.snapshots[idx]
+                for pos, reverse in positions:
+                    if pos in cv_store.index:
+                        continue
 
-                        if proxy._reversed is not None:
-                            proxy = proxy._reversed
+                    snapshot = self.storage.snapshots[idx]
+                    if reverse:
+                        if snapshot._reversed is not None:
+                            snapshot = snapshot._reversed
                         else:
-                            proxy = proxy.reversed
-
-                        # get from cache first, this is fastest
-                        value = cv._cache_dict._get(proxy)
-
-                        if value is None:
-                            # not in cache so compute it if possible
-                            if cv._eval_dict:
-                                value = cv._eval_dict([proxy])[0]
-                            else:
-                                value = None
+                            snapshot = snapshot.reversed
 
-                        if value is not None:
-                            n_idx = cv_store.free()
-
-                            cv_store.vars['value'][n_idx] = value
-                            cv_store.vars['index'][n_idx] = pos
-                            cv_store.index[pos] = n_idx
-                            cv_store.cache[n_idx] = value
+                    yield pos, snapshot
 
-    def sync_cv(self, cv):
+    def sync_cv(self, cv, chunksize=1000):
         """
         Store all cached values of a CV in the diskcache
 
         Parameters
         ----------
         cv : :obj:`openpathsampling.CollectiveVariable`
+        chunksize : int
+            the number of values written at once
 
 
         """
@@ -843,9 +1007,26 @@ class SnapshotWrapperStore(ObjectStore):
 
         # for complete this does not make sense
         if cv_store.allow_incomplete:
+            positions = []
+            values = []
+            found = set()
+
+            def add(pos, value):
+                if cv_store.time_reversible:
+                    pos /= 2
+
+                if pos in cv_store.index or pos in found:
+                    # this value is stored so skip it
+                    return
+
+                found.add(pos)
+                positions.append(pos)
+                values.append(value)
+
+            cache = cv._cache_dict.cache
 
             # loop all objects in the fast CV cache
-            for obj, value in cv._cache_dict.cache.iteritems():
+            for obj, value in cache.iteritems():
                 if value is not None:
                     pos = self.pos(obj)
 
@@ -853,19 +1034,23 @@ class SnapshotWrapperStore(ObjectStore):
                     if pos is None:
                         continue
 
-                    if cv_store.time_reversible:
-                        pos /= 2
+                    add(pos, value)
 
-                    if pos in cv_store.index:
-                        # this value is stored so skip it
-                        continue
-
-                    n_idx = cv_store.free()
+            # the rows of a position cache are positions in this store
+            if isinstance(cache, PositionCache) and cache.pos == self.pos:
+                for row, value in cache.row_items():
+                    if cache.time_reversible:
+                        add(2 * row, value)
+                        add(2 * row + 1, value)
+                    else:
+                        add(row, value)
 
-                    cv_store.vars['value'][n_idx] = value
-                    cv_store.vars['index'][n_idx] = pos
-                    cv_store.index[pos] = n_idx
-                    cv_store.cache[n_idx] = value
+            for chunk_start in range(0, len(positions), chunksize):
+                chunk_end = chunk_start + chunksize
+                self._write_cv_values(
+                    cv_store,
+                    positions[chunk_start:chunk_end],
+                    values[chunk_start:chunk_end])
 
     def free(self):
         idx = len(self)
@@ -1005,7 +1190,7 @@ class SnapshotWrapperStore(ObjectStore):
 
         store.initialize()
 
-        store_idx = int(len(self.storage.dimensions['cvcache']))
+        store_idx = self.storage.dimension_length('cvcache')
         self.cv_list[cv] = (store, store_idx)
         self.storage.vars['cvcache'][store_idx] = store
 
@@ -1017,27 +1202,34 @@ class SnapshotWrapperStore(ObjectStore):
             else:
                 indices = range(0, len(self), 2)
 
-            for pos, idx in enumerate(indices):
-
-                proxy = LoaderProxy(self.storage.snapshots, idx)
-                value = cv._cache_dict._get(proxy)
-
-                if value is None:
-                    # not in cache so compute it if possible
-                    if cv._eval_dict:
-                        value = cv._eval_dict([proxy])[0]
-                    else:
-                        value = None
+            chunk_length = 1000
+            for chunk_start in range(0, len(indices), chunk_length):
+                proxies = [
+                    LoaderProxy(self.storage.snapshots, idx)
+                    for idx in indices[chunk_start:chunk_start + chunk_length]
+                ]
+                values = self._cv_values(cv, proxies)
+                positions = range(chunk_start, chunk_start + len(proxies))
+
+                if all(value is not None for value in values):
+                    store.vars['value'][
+                        chunk_start:chunk_start + len(values)] = \
+                        self._stack_values(values)
+                else:
+                    for pos, value in zip(positions, values):
+                        if value is not None:
+                            store.vars['value'][pos] = value
 
-                if value is not None:
-                    store.vars['value'][pos] = value
-                    store.cache[pos] = value
+                for pos, value in zip(positions, values):
+                    if value is not None:
+                        store.cache[pos] = value
 
         cv.set_cache_store(store)
         return store, store_idx
 
     def create_uuid_index(self):
-        return UUIDReversalDict()
+        return IndexedUUIDReversalDict(
+            self.storage.uuid_index, self, factor=2)
 
     def _get_id(self, idx, obj):
         if self.reference_by_uuid:
@@ -1066,6 +1258,7 @@ class SnapshotWrapperStore(ObjectStore):
     def _set_id(self, idx, obj):
         if self.reference_by_uuid:
             self.vars['uuid'][idx / 2] = obj.__uuid__
+            self.storage.uuid_index.add(obj.__uuid__, self, idx / 2)
 
     def idx(self, obj):
         """
@@ -1091,10 +1284,84 @@ class SnapshotWrapperStore(ObjectStore):
             except KeyError:
                 raise KeyError(obj)
 
+    def _cv_entry(self, cv):
+        # the instance loaded while restoring the store can differ from the
+        # one `storage.cvs` returns later, e.g. after the caches of the
+        # object stores were replaced, so fall back to compare UUIDs
+        if cv in self.cv_list:
+            return self.cv_list[cv]
+
+        for other, entry in self.cv_list.items():
+            if other.__uuid__ == cv.__uuid__:
+                return entry
+
+        raise KeyError(cv)
+
     def cache_all_cvs(self):
         for store, idx in self.cv_list.values():
             store.fill_cache()
 
+    def cv_arrays(self, cv, filename=None, update=False):
+        """
+        Return read-only memory-mapped arrays of all stored values of a CV
+
+        On first use the values are exported from the netCDF file into two
+        numpy files next to it, one with the values and one that marks the
+        rows that hold a value. Later calls (also in other sessions) only
+        map these files which is much faster than reading the values from
+        the netCDF file. The files are exported again if they are older
+        than the storage.
+
+        The row of a snapshot is its position `pos` in this store, halved
+        for time reversible CVs (like in
+        :class:`openpathsampling.netcdfplus.PositionCache`).
+
+        Parameters
+        ----------
+        cv : :obj:`openpathsampling.CollectiveVariable`
+            a CV that is stored in this storage
+        filename : str or None
+            the prefix of the two files. Default is the filename of the
+            storage followed by the name of the CV store
+        update : bool
+            if `True` the files are always exported again
+
+        Returns
+        -------
+        values : numpy.memmap
+            the values of the CV without units
+        valid : numpy.memmap of bool
+            `True` for all rows that hold a value
+
+        Raises
+        ------
+        ValueError
+            if the values of the CV are not plain numbers or numpy arrays
+        """
+        cv_store, cv_idx = self._cv_entry(cv)
+        if filename is None:
+            filename = '%s.%s' % (
+                self.storage.filename,
+                SnapshotWrapperStore._get_cv_name(cv_idx))
+
+        values_file = filename + '.values.npy'
+        valid_file = filename + '.valid.npy'
+
+        if update or any(
+                not os.path.isfile(fn) or
+                os.path.getmtime(fn) < os.path.getmtime(self.storage.filename)
+                for fn in [values_file, valid_file]):
+            n_rows = len(self)
+            if cv_store.time_reversible:
+                n_rows /= 2
+
+            cv_store.export_arrays(values_file, valid_file, n_rows)
+
+        return (
+            np.load(values_file, mmap_mode='r'),
+            np.load(valid_file, mmap_mode='r')
+        )
+
     def pos(self, obj):
         if hasattr(obj, '_idx'):
             if self.reference_by_uuid:
@@ -1108,7 +1375,7 @@ class SnapshotWrapperStore(ObjectStore):
             pos = self.index.get(obj)
 
             if pos is None and not self.reference_by_uuid:
-                if obj._reversed:
+                if getattr(obj, '_reversed', None):
                     pos = self.index.get(obj._reversed)
                     if pos is None:
                         return None
@@ -1168,17 +1435,17 @@ class SnapshotValueStore(ObjectStore):
         }
 
     def create_uuid_index(self):
-        return dict()
+        return IndexedPositionDict(self)
 
     def create_int_index(self):
-        return dict()
+        return IndexedPositionDict(self)
 
     def register(self, storage, prefix):
         super(SnapshotValueStore, self).register(storage, prefix)
         self.snapshot_pos = self.storage.snapshots.pos
 
     def __len__(self):
-        return len(self.variables['value'])
+        return len(self.vars['value'])
 
     # ==========================================================================
     # LOAD/SAVE DECORATORS FOR CACHE HANDLING
@@ -1266,10 +1533,67 @@ class SnapshotValueStore(ObjectStore):
     def fill_cache(self):
         self.cache.load_max()
 
+    def export_arrays(self, values_file, valid_file, n_rows, chunksize=10000):
+        """
+        Write all stored values to numpy files that can be memory-mapped
+
+        Parameters
+        ----------
+        values_file : str
+            the `.npy` file for the values, one row per snapshot position
+        valid_file : str
+            the `.npy` file for the bool array that marks the rows with a
+            value
+        n_rows : int
+            the number of rows, i.e. of snapshot positions
+        chunksize : int
+            the number of values read from the netCDF file at once
+
+        Raises
+        ------
+        ValueError
+            if the values are not plain numbers or numpy arrays
+        """
+        variable = self.variables['value']
+        var_type = variable.var_type
+        if hasattr(variable, 'unit_simtk') or not (
+                var_type in ['int', 'float', 'bool'] or
+                var_type.startswith('numpy.')):
+            raise ValueError(
+                'Only values of type int, float, bool or numpy arrays '
+                'without units can be exported, not "%s"' % var_type)
+
+        dtype = np.bool_ if var_type == 'bool' else variable.dtype
+        values = np.lib.format.open_memmap(
+            values_file, mode='w+', dtype=dtype,
+            shape=(n_rows,) + variable.shape[1:])
+        valid = np.lib.format.open_memmap(
+            valid_file, mode='w+', dtype=np.bool_, shape=(n_rows,))
+        valid[:] = False
+
+        n_values = len(self) if self.allow_incomplete else self._len
+        for start in range(0, n_values, chunksize):
+            stop = min(start + chunksize, n_values)
+            chunk = variable[start:stop]
+            present = ~np.ma.getmaskarray(chunk).reshape(
+                (stop - start, -1)).any(axis=1)
+            if self.allow_incomplete:
+                rows = np.ma.filled(self.variables['index'][start:stop], -1)
+                present &= (rows >= 0) & (rows < n_rows)
+            else:
+                rows = np.arange(start, stop)
+                present &= rows < n_rows
+
+            values[rows[present]] = np.ma.getdata(chunk)[present]
+            valid[rows[present]] = True
+
+        values.flush()
+        valid.flush()
+        del values, valid
+
     def restore(self):
         if self.allow_incomplete:  # only if partial storage is used
-            for pos, idx in enumerate(self.vars['index'][:]):
-                self.index[idx] = pos
+            self.index.restore()
 
         self._len = len(self)
         self.initialize_cache()
@@ -0,0 +1,93 @@
+from nose.tools import assert_equal, assert_true, assert_false
+from test_helpers import make_1d_traj, data_filename
+
+import os
+
+import openpathsampling as paths
+from openpathsampling.cv_prefetch import (
+    CVPrefetcher, find_collectivevariables)
+
+
+class testCVPrefetcher(object):
+    def setup(self):
+        self.evaluated = []
+
+        def x(snap):
+            self.evaluated.append(snap)
+            return snap.coordinates[0][0]
+
+        self.cv = paths.FunctionCV("x", x)
+        self.cv2 = paths.FunctionCV("y", lambda snap: snap.coordinates[0][0])
+        self.stateA = paths.CVDefinedVolume(self.cv, float("-inf"), 0.0)
+        self.stateB = paths.CVDefinedVolume(self.cv2, 1.0, float("inf"))
+        self.traj = make_1d_traj([-0.5, 0.2, 0.6, 1.5])
+
+    def test_find_collectivevariables(self):
+        ensemble = paths.SequentialEnsemble([
+            paths.AllInXEnsemble(self.stateA) & paths.LengthEnsemble(1),
+            paths.AllOutXEnsemble(self.stateA | self.stateB),
+            paths.AllInXEnsemble(self.stateB) & paths.LengthEnsemble(1)
+        ])
+        assert_equal(find_collectivevariables([ensemble]),
+                     [self.cv, self.cv2])
+        assert_equal(find_collectivevariables([self.stateB, self.cv]),
+                     [self.cv2, self.cv])
+
+    def test_prefetch(self):
+        prefetcher = CVPrefetcher([self.cv])
+        assert_false(prefetcher.running)
+        for snap in self.traj:
+            prefetcher.submit(snap)
+        assert_true(prefetcher.running)
+        prefetcher.wait()
+        assert_equal(len(self.evaluated), 4)
+
+        # the values are taken from the cache now
+        assert_equal(self.cv(self.traj), [-0.5, 0.2, 0.6, 1.5])
+        assert_equal(len(self.evaluated), 4)
+
+        prefetcher.stop()
+        assert_false(prefetcher.running)
+
+    def test_exclude(self):
+        prefetcher = CVPrefetcher([self.cv, self.cv2])
+        ensemble = paths.AllOutXEnsemble(self.stateA)
+        # stopping conditions are bound methods of ensembles
+        prefetcher.exclude([ensemble.can_append])
+        assert_equal(prefetcher.cvs, [self.cv2])
+        prefetcher.exclude([ensemble.can_append, self.stateB])
+        assert_equal(prefetcher.cvs, [])
+
+    def test_failing_cv(self):
+        failing = paths.FunctionCV("fail", lambda snap: 1.0 / 0.0)
+        prefetcher = CVPrefetcher([failing, self.cv])
+        prefetcher.submit(self.traj[0])
+        prefetcher.stop()
+        assert_equal(len(prefetcher.errors), 1)
+        assert_equal(prefetcher.cvs, [self.cv])
+        assert_equal(len(self.evaluated), 1)
+
+    def test_for_storage(self):
+        fname = data_filename("prefetch_test.nc")
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+        storage = paths.Storage(fname, "w")
+        storage.snapshots.save(self.traj[0])
+        cvs = [
+            paths.FunctionCV(
+                name, lambda snap: snap.coordinates[0][0],
+                cv_time_reversible=True
+            ).with_diskcache(allow_incomplete=incomplete)
+            for name, incomplete in [('a', False), ('b', False), ('c', True)]
+        ]
+        for cv in cvs:
+            storage.save(cv)
+
+        # CVs of the stopping conditions are evaluated anyway
+        state = paths.CVDefinedVolume(cvs[0], float("-inf"), 0.0)
+        prefetcher = CVPrefetcher.for_storage(storage, exclude=[state])
+        assert_equal(prefetcher.cvs, [cvs[1]])
+
+        storage.close()
+        os.remove(fname)
@@ -0,0 +1,127 @@
+from nose.tools import assert_equal, assert_is, assert_is_not
+from test_helpers import make_1d_traj
+
+import random
+
+import openpathsampling as paths
+from openpathsampling.ensemble_labels import LabelEvaluator, FrameLabels
+
+
+class testLabelEvaluator(object):
+    def setUp(self):
+        op = paths.FunctionCV("x", lambda snap: snap.coordinates[0][0])
+        self.stateA = paths.CVDefinedVolume(op, float("-inf"), 0.0)
+        self.stateB = paths.CVDefinedVolume(op, 1.0, float("inf"))
+        self.interface = paths.CVDefinedVolume(op, float("-inf"), 0.5)
+        in_A = paths.AllInXEnsemble(self.stateA)
+        out_A = paths.AllOutXEnsemble(self.stateA)
+        self.ensembles = [
+            paths.TISEnsemble(self.stateA, self.stateB, self.interface),
+            paths.MinusInterfaceEnsemble(self.stateA, self.interface),
+            paths.AllInXEnsemble(self.interface),
+            paths.PartInXEnsemble(self.stateB),
+            paths.LengthEnsemble(slice(2, 5)),
+            in_A | paths.PartOutXEnsemble(self.interface),
+            paths.NegatedEnsemble(paths.AllInXEnsemble(self.interface)),
+            paths.SequentialEnsemble([
+                paths.SingleFrameEnsemble(in_A),
+                paths.OptionalEnsemble(out_A & paths.LengthEnsemble(2)),
+                paths.AllInXEnsemble(self.stateA | self.stateB)
+            ]),
+            paths.LengthEnsemble(2) & paths.SequentialEnsemble([
+                paths.SingleFrameEnsemble(in_A),
+                paths.SingleFrameEnsemble(out_A)
+            ]),
+            # pieces that are evaluated with their own functions
+            paths.AllInXEnsemble(self.interface) &
+            paths.ExitsXEnsemble(self.stateA),
+            paths.SequentialEnsemble([
+                paths.AllInXEnsemble(self.interface) &
+                paths.ExitsXEnsemble(self.stateA),
+                paths.AllOutXEnsemble(self.interface)
+            ])
+        ]
+        # random walks over values in A, in/out of the interface, and in B
+        values = [-0.5, 0.2, 0.6, 0.8, 1.5]
+        rng = random.Random(5)
+        self.trajs = []
+        for length in [1, 2, 5, 12, 25]:
+            idx = rng.randint(0, 4)
+            coordinates = []
+            for i in range(length):
+                idx = min(4, max(0, idx + rng.choice([-1, 0, 1])))
+                coordinates.append(values[idx])
+            self.trajs.append(make_1d_traj(coordinates))
+
+    def teardown(self):
+        paths.Ensemble.use_frame_labels = True
+
+    def test_labels(self):
+        traj = make_1d_traj([-0.5, 0.2, 0.6, 1.5])
+        labels = FrameLabels(traj, [self.stateA, self.interface])
+        assert_equal(list(labels.labels), [3, 2, 0, 0])
+        assert_equal(labels.n_frames, 4)
+
+    def test_unsupported_ensembles(self):
+        assert_is(LabelEvaluator.from_ensemble(
+            paths.ExitsXEnsemble(self.stateA)), None)
+        nested = paths.SequentialEnsemble([
+            paths.AllInXEnsemble(self.stateA),
+            paths.SequentialEnsemble([paths.AllOutXEnsemble(self.stateA)])
+        ])
+        assert_is(LabelEvaluator.from_ensemble(nested), None)
+        assert_is_not(LabelEvaluator.from_ensemble(self.ensembles[0]), None)
+        assert_is_not(LabelEvaluator.from_ensemble(self.ensembles[-1]),
+                      None)
+
+    def test_sequential_call_uses_labels(self):
+        ens = self.ensembles[0]
+        traj = make_1d_traj([-0.5, 0.2, 0.6, 1.5])
+        assert_equal(ens(traj), True)
+        assert_is_not(ens._label_evaluator, None)
+        # an ensemble whose labels say the opposite
+        ens._label_evaluator = LabelEvaluator.from_ensemble(
+            paths.NegatedEnsemble(ens))
+        assert_equal(ens(traj), False)
+        assert_equal(ens(traj, trusted=True), True)
+        ens.use_frame_labels = False
+        assert_equal(ens(traj), True)
+
+    def test_same_as_ensemble(self):
+        # the ensembles themselves must not use the labels
+        paths.Ensemble.use_frame_labels = False
+        for ens in self.ensembles:
+            evaluator = LabelEvaluator.from_ensemble(ens)
+            for traj in self.trajs:
+                labels = evaluator.label(traj)
+                for start in range(len(traj)):
+                    for end in range(start + 1, len(traj) + 1):
+                        subtraj = traj[start:end]
+                        msg = str(ens) + " " + str(start) + ":" + str(end)
+                        assert_equal(evaluator(labels, start, end),
+                                     ens(subtraj), msg)
+                        assert_equal(
+                            evaluator.can_append(labels, start, end),
+                            ens.can_append(subtraj), msg)
+                        assert_equal(
+                            evaluator.can_append(labels, start, end, True),
+                            ens.strict_can_append(subtraj), msg)
+                        assert_equal(
+                            evaluator.can_prepend(labels, start, end),
+                            ens.can_prepend(subtraj), msg)
+                        assert_equal(
+                            evaluator.can_prepend(labels, start, end, True),
+                            ens.strict_can_prepend(subtraj), msg)
+
+    def test_iter_valid_slices(self):
+        options = [{}, {'reverse': True}, {'overlap': 0}, {'max_length': 4},
+                   {'min_length': 3, 'reverse': True},
+                   {'max_length': 5, 'overlap': 2, 'reverse': True}]
+        for ens in self.ensembles:
+            for traj in self.trajs:
+                for kwargs in options:
+                    fast = list(ens.iter_valid_slices(traj, **kwargs))
+                    paths.Ensemble.use_frame_labels = False
+                    slow = list(ens.iter_valid_slices(traj, **kwargs))
+                    paths.Ensemble.use_frame_labels = True
+                    assert_equal(fast, slow, str(ens) + str(kwargs))
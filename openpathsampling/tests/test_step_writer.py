@@ -0,0 +1,107 @@
+from nose.tools import assert_equal, assert_true, assert_false, raises
+
+import threading
+
+from openpathsampling.step_writer import StepWriter
+
+
+class DummySample(object):
+    def __init__(self, trajectory):
+        self.trajectory = trajectory
+
+
+class DummyChange(object):
+    def __init__(self, trials):
+        self.trials = trials
+
+
+class DummyStep(object):
+    # the snapshots are simply the numbers of the step
+    def __init__(self, number):
+        self.number = number
+        self.active = [DummySample([number])]
+        self.change = DummyChange([DummySample([number, -number])])
+
+
+class DummySnapshots(object):
+    def __init__(self):
+        self.prepared_cv_values = None
+        self.threads = set()
+
+    def auto_complete_values(self, snapshots):
+        self.threads.add(threading.current_thread())
+        return {snapshot: 2 * snapshot for snapshot in snapshots}
+
+
+class DummySteps(object):
+    def __init__(self, storage, fail_at=None):
+        self.storage = storage
+        self.saved = []
+        self.prepared = []
+        self.fail_at = fail_at
+        self.threads = set()
+
+    def save(self, step):
+        self.threads.add(threading.current_thread())
+        if step.number == self.fail_at:
+            raise IOError('disk full')
+        self.saved.append(step.number)
+        self.prepared.append(self.storage.snapshots.prepared_cv_values)
+
+
+class DummyStorage(object):
+    def __init__(self, fail_at=None):
+        self.lock = threading.RLock()
+        self.snapshots = DummySnapshots()
+        self.steps = DummySteps(self, fail_at)
+        self.n_syncs = 0
+
+    def sync_all(self):
+        self.n_syncs += 1
+
+
+class testStepWriter(object):
+    def test_save_and_sync(self):
+        storage = DummyStorage()
+        writer = StepWriter(storage, queue_size=2)
+        assert_false(writer.running)
+        for step in range(10):
+            writer.submit(DummyStep(step))
+        assert_true(writer.running)
+        writer.sync()
+        assert_equal(storage.steps.saved, range(10))
+        assert_equal(storage.n_syncs, 1)
+        assert_false(threading.current_thread() in storage.steps.threads)
+        # CVs are evaluated in the simulation thread and passed on
+        assert_equal(storage.snapshots.threads,
+                     set([threading.current_thread()]))
+        assert_equal(storage.steps.prepared[3], {3: 6, -3: -6})
+        assert_equal(storage.snapshots.prepared_cv_values, None)
+        writer.stop()
+        assert_false(writer.running)
+
+    @raises(RuntimeError)
+    def test_failure_stops_simulation(self):
+        storage = DummyStorage(fail_at=3)
+        writer = StepWriter(storage)
+        for step in range(6):
+            writer.submit(DummyStep(step))
+        try:
+            writer.sync()
+        finally:
+            # all steps after the failure are skipped
+            assert_equal(storage.steps.saved, [0, 1, 2])
+            assert_equal(storage.n_syncs, 0)
+            writer.stop()
+
+    def test_lock_blocks_writer(self):
+        storage = DummyStorage()
+        writer = StepWriter(storage)
+        with writer.lock:
+            writer.submit(DummyStep(0))
+            writer.submit(DummyStep(1))
+            # the writer waits until the simulation releases the storage
+            assert_equal(storage.steps.saved, [])
+        writer.sync()
+        assert_equal(storage.steps.saved, [0, 1])
+        writer.stop()
@@ -3,6 +3,7 @@
 '''
 
 import os
+import threading
 
 from nose.tools import (assert_equal, assert_not_equal, assert_items_equal,
                         assert_almost_equal)
@@ -211,6 +212,33 @@ class testToyEngine(object):
         else:
             raise RuntimeError('Did not raise MaxLength Error')
 
+    def test_generate_with_prefetcher(self):
+        class RecordingPrefetcher(object):
+            def __init__(self):
+                self.snapshots = []
+                self.n_waits = 0
+                self.excluded = []
+                self.lock = threading.RLock()
+
+            def exclude(self, objects):
+                self.excluded.extend(objects)
+
+            def submit(self, snapshot):
+                self.snapshots.append(snapshot)
+
+            def wait(self):
+                self.n_waits += 1
+
+        self.sim.initialized = True
+        self.sim.prefetcher = RecordingPrefetcher()
+        ens = paths.LengthEnsemble(4)
+        traj = self.sim.generate(self.sim.current_snapshot, [ens.can_append])
+        assert_equal(self.sim.prefetcher.snapshots, list(traj[1:]))
+        # the engine waits for the prefetcher before returning
+        assert_equal(self.sim.prefetcher.n_waits, 1)
+        # and does not prefetch the CVs of the stopping conditions
+        assert_equal(self.sim.prefetcher.excluded, [ens.can_append])
+
     def test_generate_n_frames(self):
         self.sim.initialized = True
         ens = paths.LengthEnsemble(4) # first snap plus n_frames
@@ -0,0 +1,82 @@
+from nose.tools import assert_equal, assert_true, assert_false
+
+import os
+import tempfile
+import uuid
+
+import numpy as np
+
+from openpathsampling.netcdfplus import UUIDIndex
+
+
+class DummyStore(object):
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+
+class testUUIDIndex(object):
+    def setup(self):
+        self.stores = [DummyStore('first'), DummyStore('second')]
+        self.index = UUIDIndex(merge_size=7)
+        self.expected = {}
+
+    def add(self, count):
+        for _ in range(count):
+            uid = uuid.uuid4()
+            store = self.stores[len(self.expected) % 2]
+            self.index.add(uid, store, len(self.expected))
+            self.expected[uid] = (store, len(self.expected))
+
+    def check(self):
+        for uid, value in self.expected.items():
+            assert_equal(self.index.get(uid), value)
+
+        assert_equal(len(self.index), len(self.expected))
+
+    def test_add_and_get(self):
+        self.add(500)
+        # the runs shrink at least by a factor of two
+        sizes = [len(run[0]) for run in self.index.runs]
+        for older, newer in zip(sizes[:-1], sizes[1:]):
+            assert_true(older >= 2 * newer)
+
+        self.check()
+        assert_equal(len(self.index.runs), 1)
+        assert_equal(self.index.count(self.stores[0]), 250)
+        assert_false(uuid.uuid4() in self.index)
+
+    def test_add_many_replace_and_remove(self):
+        self.add(100)
+        uids = list(self.expected)[:10]
+        keys = np.array([uid.bytes for uid in uids], dtype='S16')
+        self.index.add_many(keys, self.stores[1], np.arange(10) + 1000)
+        for pos, uid in enumerate(uids):
+            self.expected[uid] = (self.stores[1], pos + 1000)
+
+        self.index.remove(uids[0])
+        del self.expected[uids[0]]
+        assert_false(uids[0] in self.index)
+        self.add(30)
+        self.check()
+
+    def test_save_and_load(self):
+        self.add(100)
+        filename = os.path.join(tempfile.mkdtemp(), 'index')
+        self.index.save(filename, {'first': 50, 'second': 50})
+        assert_true(UUIDIndex.exists(filename))
+
+        self.index = UUIDIndex(merge_size=7)
+        lengths = self.index.load(filename)
+        assert_equal(lengths, {'first': 50, 'second': 50})
+
+        # stores have to be registered again
+        for store in self.stores:
+            self.index.register(store)
+
+        self.add(20)
+        self.check()
+
+        for part in UUIDIndex.parts:
+            os.remove('%s.%s.npy' % (filename, part))
+
+        os.rmdir(os.path.dirname(filename))
@@ -9,13 +9,16 @@ import numpy as np
 
 import openpathsampling.collectivevariable as op
 import openpathsampling.engines.openmm as peng
-from openpathsampling.netcdfplus import NetCDFPlus
+from openpathsampling.netcdfplus import NetCDFPlus, ObjectJSON
 
 from msmbuilder.featurizer import AtomPairsFeaturizer
 
 import openpathsampling as paths
 from openpathsampling.tests.test_helpers import make_1d_traj
 import os
+import sys
+import gc
+import cPickle
 
 
 class test_FunctionCV(object):
@@ -42,6 +45,291 @@ class test_FunctionCV(object):
         storage.save(cv)
         storage.close()
 
+    def test_parallel_evaluation(self):
+        traj = make_1d_traj([float(x) for x in range(25)])
+
+        class CountingMap(object):
+            def __init__(self):
+                self.chunks = []
+
+            def map(self, fnc, chunks):
+                # chunks are pickled for all executors except thread pools
+                self.chunks.extend(
+                    len(cPickle.loads(chunk)) for chunk in chunks)
+                return map(fnc, chunks)
+
+        for kwargs in [{}, {'cv_requires_lists': True}]:
+            if kwargs:
+                fnc = lambda snaps: [snap.coordinates[0][0] for snap in snaps]
+            else:
+                fnc = lambda snap: snap.coordinates[0][0]
+
+            executor = CountingMap()
+            cv = paths.FunctionCV("x", fnc, **kwargs)
+            cv.set_executor(executor, chunk_size=10)
+            # a short list is evaluated in one call
+            assert_close_unit(cv(traj[0:5]), range(5))
+            assert (executor.chunks == [])
+            # the remaining 20 snapshots are split into chunks
+            assert_close_unit(cv(traj), range(25))
+            assert (executor.chunks == [10, 10])
+            cv.set_executor(None)
+            assert (cv._eval_dict.executor is None)
+
+        for backend in ['thread', 'process']:
+            cv = paths.FunctionCV("x", lambda snap: snap.coordinates[0][0])
+            with cv.parallel(processes=2, backend=backend, chunk_size=4):
+                assert_close_unit(cv(traj), range(25))
+            assert (cv._eval_dict.executor is None)
+            assert (cv._eval_dict.chunk_size == 1000)
+
+        # errors in the workers are raised in the main process
+        cv = paths.FunctionCV("fails", lambda snap: snap.no_such_attribute)
+        with cv.parallel(processes=2, backend='process', chunk_size=4):
+            try:
+                cv(traj)
+                raise AssertionError('worker error was not raised')
+            except RuntimeError as e:
+                assert ('no_such_attribute' in str(e))
+
+    def test_uuid_lru_cache(self):
+        from openpathsampling.netcdfplus import UUIDLRUCache, ByteBudget
+        from openpathsampling.netcdfplus.cache import value_nbytes
+        traj = make_1d_traj([float(x) for x in range(10)])
+        evaluated = []
+
+        def fnc(snap):
+            evaluated.append(snap)
+            return np.zeros(100) + snap.coordinates[0][0]
+
+        cv = paths.FunctionCV("x", fnc)
+        cv(traj[0:2])
+        cache = UUIDLRUCache(size_limit=5)
+        cv.set_cache(cache)
+        # values of the old cache are transferred
+        assert (traj[0].__uuid__ in cache)
+        assert (traj[0] in cache)
+        cv(traj[0:2])
+        assert (len(evaluated) == 2)
+
+        cv(traj)
+        assert (len(cache) == 5)
+        assert (cache.nbytes > 5 * 800)
+        assert (traj[0] not in cache)
+        assert (traj[9] in cache)
+
+        cache.byte_limit = 2 * cache.nbytes / 5
+        assert (len(cache) == 2)
+        assert (list(cache) == [traj[8].__uuid__, traj[9].__uuid__])
+
+        # a budget shared by two caches evicts the oldest values of both
+        budget = ByteBudget(byte_limit=4 * cache.nbytes / 2)
+        cache1 = UUIDLRUCache(budget=budget)
+        cache2 = UUIDLRUCache(budget=budget)
+        for snap in traj[0:3]:
+            cache1[snap] = np.zeros(100)
+            cache2[snap] = np.zeros(100)
+        assert (len(cache1) + len(cache2) == 4)
+        assert (traj[0] not in cache1)
+        assert (traj[0] not in cache2)
+        assert (traj[1] in cache2)
+        assert (budget.nbytes == cache1.nbytes + cache2.nbytes)
+        cache1.clear()
+        assert (budget.nbytes == cache2.nbytes)
+
+        # replaced and garbage collected caches release their bytes
+        del cache1, cache2
+        gc.collect()
+        assert (budget.nbytes == 0)
+
+        budget = ByteBudget(byte_limit=15 * value_nbytes(np.zeros(100)))
+        cv.set_cache(UUIDLRUCache(budget=budget))
+        cv(traj)
+        old_cache = cv._cache_dict.cache
+        cv.set_cache(UUIDLRUCache(budget=budget))
+        assert (len(cv._cache_dict.cache) == 10)
+        assert (len(old_cache) == 0)
+        assert (budget.nbytes == cv._cache_dict.cache.nbytes)
+
+    def test_uuid_cache_reversal(self):
+        from openpathsampling.netcdfplus import UUIDLRUCache
+        traj = make_1d_traj([float(x) for x in range(5)])
+        evaluated = []
+
+        def fnc(snap):
+            evaluated.append(snap)
+            return snap.coordinates[0][0]
+
+        cv = paths.CoordinateFunctionCV("x", fnc)
+        cache = UUIDLRUCache()
+        cv.set_cache(cache)
+        assert (cv._cache_dict.pair_keys)
+        assert_close_unit(cv(traj), range(5))
+
+        # a single entry per pair, found for both orientations
+        assert (len(cache) == 5)
+        assert_close_unit(cv(traj.reversed), range(5)[::-1])
+        assert (len(evaluated) == 5)
+        assert (len(cache) == 5)
+
+        # not reversible CVs keep separate values
+        cv2 = paths.FunctionCV("x2", fnc)
+        cv2.set_cache(UUIDLRUCache())
+        assert (not cv2._cache_dict.pair_keys)
+        cv2(traj)
+        cv2(traj.reversed)
+        assert (len(evaluated) == 15)
+
+    def test_position_cache(self):
+        from openpathsampling.netcdfplus import PositionCache
+        traj = make_1d_traj([float(x) for x in range(10)])
+        storage = paths.Storage("myfile.nc", "w", traj[0])
+        storage.save(traj[0:6])
+
+        cv = paths.CoordinateFunctionCV(
+            "x", lambda snap: snap.coordinates[0][0])
+        cache = PositionCache(
+            storage.snapshots.pos, time_reversible=True, initial_size=2)
+        cv.set_cache(cache)
+
+        assert_close_unit(cv(traj), range(10))
+        # stored snapshots are kept in the array, the others in the fallback
+        assert (cache.valid.sum() == 6)
+        assert (len(cache.fallback) == 4)
+        assert (len(cache) == 10)
+        assert_close_unit(cache.values[cache.valid], range(6))
+
+        # reversed snapshots share the row with their partner
+        assert (traj[2].reversed in cache)
+        assert_close_unit(cv(traj.reversed), range(10)[::-1])
+        assert_close_unit(cache.get_list(list(traj[4:8])), range(4, 8))
+        # traj[0] was stored first as template, so traj[4] is at position 8
+        assert_close_unit(cv(storage.snapshots[8]), 4.0)
+
+        # the first value fixes the dtype, later floats must not be truncated
+        cache = PositionCache(storage.snapshots.pos, time_reversible=True)
+        cache[traj[0]] = 0
+        cache[traj[1]] = 0.75
+        assert (cache[traj[0]] == 0)
+        assert (cache[traj[1]] == 0.75)
+        assert (cache.valid.sum() == 2)
+
+        storage.close()
+
+    def test_position_cache_sync(self):
+        from openpathsampling.netcdfplus import PositionCache
+        fname = data_filename("cv_storage_test.nc")
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+        traj = make_1d_traj([float(x) for x in range(6)])
+        storage_w = paths.Storage(fname, "w")
+        storage_w.snapshots.save(traj[0])
+        cv = paths.FunctionCV(
+            'x', lambda snap: snap.coordinates[0][0],
+            cv_time_reversible=True
+        ).with_diskcache(allow_incomplete=True)
+        storage_w.save(cv)
+        storage_w.trajectories.save(traj[0:4])
+
+        cv.set_cache(
+            PositionCache(storage_w.snapshots.pos, time_reversible=True))
+        # unstored snapshots are kept in the fallback and cannot be synced
+        cv(traj)
+        storage_w.cvs.sync_all()
+        cv_store = storage_w.snapshots.cv_list[cv][0]
+        assert (len(cv_store.index) == 4)
+        storage_w.close()
+
+        storage_r = paths.Storage(fname, "r")
+        value_store = storage_r.cvs['x']._store_dict.value_store
+        for snap in storage_r.trajectories[0]:
+            assert_close_unit(value_store[snap], snap.coordinates[0][0])
+            assert_close_unit(
+                value_store[snap.reversed], snap.coordinates[0][0])
+
+        storage_r.close()
+        os.remove(fname)
+
+    def test_return_type_with_cache(self):
+        traj = make_1d_traj([float(x) for x in range(4)])
+        for wrap, result_type in [(False, list), (True, np.ndarray)]:
+            cv = paths.FunctionCV(
+                "x", lambda snaps: np.array(
+                    [snap.coordinates[0][0] for snap in snaps]),
+                cv_requires_lists=True, cv_wrap_numpy_array=wrap)
+            # nothing, everything and some values cached
+            for part in [traj[0:2], traj[0:2], traj]:
+                assert (type(cv(part)) is result_type)
+
+    def test_coordinate_array_cv(self):
+        traj = make_1d_traj([float(x) for x in range(6)])
+        shapes = []
+
+        def shifted_x(xyz, shift):
+            shapes.append(xyz.shape)
+            return xyz[:, 0, 0] + shift
+
+        cv = paths.CoordinateArrayCV("x", shifted_x, shift=0.5)
+        values = cv(traj[0:4])
+        assert (isinstance(values, np.ndarray))
+        assert_close_unit(values, np.arange(4) + 0.5)
+        # only the missing frames are passed in a single array
+        assert_close_unit(cv(traj), np.arange(6) + 0.5)
+        assert_close_unit(cv(traj[5]), 5.5)
+        assert (shapes == [(4, 1, 3), (2, 1, 3)])
+
+        dct = cv.to_dict()
+        assert ('cv_requires_lists' not in dct)
+        assert (dct['kwargs'] == {'shift': 0.5})
+
+    def test_derived_cv(self):
+        traj = make_1d_traj([float(x) for x in range(6)])
+        calls = []
+
+        def square(snaps):
+            calls.append(len(snaps))
+            return np.array([snap.coordinates[0][0] ** 2 for snap in snaps])
+
+        cv_sq = paths.CoordinateFunctionCV(
+            "sq", square, cv_requires_lists=True)
+        cv_sum = paths.DerivedCV("sum", lambda x, y: x + y, [cv_sq, cv_sq])
+        cv_shift = paths.DerivedCV(
+            "shift", lambda x, shift: x + shift, [cv_sum], shift=1.0)
+        cv_all = paths.DerivedCV(
+            "all", lambda x, y: np.array(x) * np.array(y), [cv_sq, cv_shift],
+            cv_requires_lists=True)
+
+        assert (cv_shift.cv_time_reversible)
+        assert (paths.collectivevariable.cv_dependency_order([cv_all]) ==
+                [cv_sq, cv_sum, cv_shift, cv_all])
+
+        values = paths.evaluate_cvs([cv_shift, cv_all], traj)
+        squares = np.array(range(6)) ** 2
+        assert_close_unit(values[0], 2 * squares + 1.0)
+        assert_close_unit(values[1], squares * (2 * squares + 1.0))
+        # the shared input is evaluated once for the whole batch
+        assert (calls == [6])
+
+        dct = cv_shift.to_dict()
+        assert (dct['inputs'] == [cv_sum])
+        assert (dct['kwargs'] == {'shift': 1.0})
+
+        # restore a DerivedCV the way storage does (`square` above uses
+        # globals and cannot be stored)
+        cv_x = paths.FunctionCV("x", lambda snap: snap.coordinates[0][0])
+        cv_shift = paths.DerivedCV(
+            "shift", lambda x, shift: x + shift, [cv_x], shift=1.0)
+        simplifier = ObjectJSON()
+        cv_copy = simplifier.from_json(simplifier.to_json_object(cv_shift))
+        assert (type(cv_copy) is paths.DerivedCV)
+        assert (cv_copy.kwargs == {'shift': 1.0})
+        assert (cv_copy.f(1.0, shift=2.0) == 3.0)
+        assert (len(cv_copy.inputs) == 1)
+        assert (type(cv_copy.inputs[0]) is paths.FunctionCV)
+        assert (cv_copy.inputs[0].name == "x")
+        assert_close_unit(cv_copy(traj), np.array(range(6)) + 1.0)
+
     def test_dihedral_op(self):
         """ Create a dihedral order parameter """
         psi_atoms = [6, 8, 14, 16]
@@ -58,6 +346,49 @@ class test_FunctionCV(object):
             md_dihed.reshape(md_dihed.shape[:-1]),
             my_dihed, rtol=10 ** -6, atol=10 ** -10)
 
+    def test_mdtraj_conversion_cache(self):
+        cache = peng.MDTrajConversionCache(size_limit=2)
+        md_topology = self.topology.mdtraj
+        md_traj = cache(self.traj_topology, md_topology)
+        np.testing.assert_allclose(md_traj.xyz, self.mdtraj.xyz, rtol=1e-6)
+        assert (cache(self.traj_topology, md_topology) is md_traj)
+        assert (cache(list(self.traj_topology), md_topology) is md_traj)
+
+        # the least recently used conversion is removed
+        cache(self.traj_topology[0:2], md_topology)
+        cache(self.traj_topology[1:3], md_topology)
+        assert (cache(self.traj_topology, md_topology) is not md_traj)
+
+        cache.size_limit = 0
+        md_traj = cache(self.traj_topology[0:2], md_topology)
+        assert (cache(self.traj_topology[0:2], md_topology) is not md_traj)
+
+    def test_mdtraj_conversion_cache_threads(self):
+        from multiprocessing.pool import ThreadPool
+        import openpathsampling.engines.openmm.tools as tools
+
+        traj = make_1d_traj([float(x) for x in range(8)])
+        cache = peng.MDTrajConversionCache(size_limit=2)
+        convert = tools.trajectory_to_mdtraj
+        # only the cache itself is tested, not the conversion
+        tools.trajectory_to_mdtraj = lambda trajectory, top: list(trajectory)
+        pool = ThreadPool(8)
+        # switch threads as often as possible
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            results = pool.map(
+                lambda n: cache(traj[n % 8:n % 8 + 2]), range(2000),
+                chunksize=1)
+        finally:
+            sys.setcheckinterval(check_interval)
+            tools.trajectory_to_mdtraj = convert
+            pool.close()
+
+        for n, result in enumerate(results):
+            assert (result == list(traj[n % 8:n % 8 + 2]))
+        assert (len(cache._cache) <= 2)
+
     def test_atom_pair_featurizer(self):
         """ Create an atom pair collectivevariable using MSMSBuilder3 """
 
@@ -193,6 +524,94 @@ class test_FunctionCV(object):
             if os.path.isfile(fname):
                 os.remove(fname)
 
+    def test_storage_cv_arrays(self):
+        import glob
+
+        for allow_incomplete in [True, False]:
+            fname = data_filename("cv_storage_test.nc")
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+            traj = make_1d_traj([float(x) for x in range(10)])
+
+            storage_w = paths.Storage(fname, "w")
+            storage_w.snapshots.save(traj[0])
+
+            cv1 = paths.FunctionCV(
+                'x',
+                lambda snap: snap.coordinates[0][0],
+                cv_time_reversible=True
+            ).with_diskcache(
+                allow_incomplete=allow_incomplete
+            )
+
+            storage_w.save(cv1)
+            storage_w.trajectories.save(traj)
+            storage_w.snapshots.complete_cv(cv1)
+            storage_w.close()
+
+            storage_r = paths.AnalysisStorage(fname, cv_arrays=True)
+            rcv1 = storage_r.cvs['x']
+
+            values, valid = storage_r.snapshots.cv_arrays(rcv1)
+            assert (not values.flags.writeable)
+            assert (valid.all())
+            assert (len(glob.glob(fname + '.cv*.npy')) == 2)
+
+            for snap in storage_r.trajectories[0]:
+                row = storage_r.snapshots.pos(snap) / 2
+                assert (values[row] == snap.coordinates[0][0])
+                assert (rcv1(snap) == snap.coordinates[0][0])
+                assert (rcv1(snap.reversed) == snap.coordinates[0][0])
+
+            storage_r.close()
+
+            for filename in [fname] + glob.glob(fname + '.cv*.npy'):
+                os.remove(filename)
+
+    def test_complete_cv_in_chunks(self):
+        fname = data_filename("cv_storage_test.nc")
+        traj = make_1d_traj(
+            coordinates=[float(x) for x in range(10)],
+            velocities=[float(x) + 1.0 for x in range(10)])
+
+        for use_uuid in [True, False]:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+            storage_w = paths.Storage(fname, "w", use_uuid=use_uuid)
+            storage_w.snapshots.save(traj[0])
+
+            cv1 = paths.FunctionCV(
+                'x',
+                lambda snap: snap.coordinates[0][0] +
+                100.0 * snap.velocities[0][0],
+                cv_time_reversible=False
+            ).with_diskcache()
+
+            storage_w.save(cv1)
+            store = storage_w.cvs.cache_store(cv1)
+            assert (store.allow_incomplete)
+
+            storage_w.trajectories.save(traj[:2])
+            storage_w.snapshots.complete_cv(cv1, chunksize=3)
+            assert (len(store.vars['value']) == 4)
+
+            # 16 missing values in chunks of 3
+            storage_w.trajectories.save(traj)
+            storage_w.snapshots.complete_cv(cv1, chunksize=3)
+            assert (len(store.vars['value']) == 20)
+
+            for snap in traj:
+                for s in [snap, snap.reversed]:
+                    assert (store[s] == s.coordinates[0][0] +
+                            100.0 * s.velocities[0][0])
+
+            storage_w.close()
+
+        if os.path.isfile(fname):
+            os.remove(fname)
+
     def test_storage_sync_and_complete(self):
         import os
 
@@ -301,6 +301,20 @@ class testAllInXEnsemble(EnsembleTest):
         assert_equal(self.inX.__str__(),
                      "x[t] in "+volstr+" for all t")
 
+    def test_inX_batch_evaluation(self):
+        n_calls = []
+        def list_cv(snapshots):
+            n_calls.append(len(snapshots))
+            return [snap.coordinates[0][0] for snap in snapshots]
+        cv = paths.FunctionCV("list_cv", list_cv, cv_requires_lists=True)
+        inX = AllInXEnsemble(paths.CVDefinedVolume(cv, lower, upper))
+        traj = make_1d_traj([0.2, 0.3, 0.4, 0.6, 0.3])
+        assert_equal(inX(traj), False)
+        assert_equal(inX(traj[:3]), True)
+        assert_equal((~inX)(traj[3:4]), True)
+        # all frames are evaluated in a single call to the CV
+        assert_equal(n_calls, [5])
+
 class testAllOutXEnsemble(EnsembleTest):
     def setUp(self):
         self.outX = AllOutXEnsemble(vol1)
@@ -1401,6 +1415,48 @@ class testEnsembleCache(EnsembleCacheTest):
         assert_equal(self._was_cache_reset(self.rev), True)
 
 
+    def test_prev_last_index(self):
+        self.fwd.check(self.traj[0:2])
+        assert_equal(self.fwd.prev_last_index, 1)
+        self.fwd.check(self.traj[0:3])
+        assert_equal(self.fwd.prev_last_index, 2)
+        self.rev.check(self.traj[-2:])
+        assert_equal(self.rev.prev_last_index, 0)
+        self.rev.check(self.traj[-3:])
+        assert_equal(self.rev.prev_last_index, 0)
+
+    def test_alternating_trajectories(self):
+        traj2 = ttraj['lower_in_out_in']
+        self.fwd.check(self.traj[0:2])
+        self.fwd.contents = { 'test' : 'traj' }
+        self.fwd.check(traj2[0:2])
+        assert_equal(self._was_cache_reset(self.fwd), True)
+        self.fwd.contents = { 'test' : 'traj2' }
+        # extending either trajectory finds its own contents again
+        assert_equal(self.fwd.check(self.traj[0:3]), False)
+        assert_equal(self.fwd.contents, { 'test' : 'traj' })
+        assert_equal(self.fwd.check(traj2[0:3]), False)
+        assert_equal(self.fwd.contents, { 'test' : 'traj2' })
+        # same for backward, keyed by the final frame
+        self.rev.check(self.traj[-2:])
+        self.rev.contents = { 'test' : 'traj' }
+        self.rev.check(traj2[-2:])
+        self.rev.contents = { 'test' : 'traj2' }
+        assert_equal(self.rev.check(self.traj[-3:]), False)
+        assert_equal(self.rev.contents, { 'test' : 'traj' })
+
+    def test_least_recently_used_dropped(self):
+        cache = EnsembleCache(direction=+1, max_size=2)
+        for start in range(3):
+            cache.check(self.traj[start:start+1])
+            cache.contents = { 'start' : start }
+        # start 0 was dropped, start 1 and start 2 are kept
+        assert_equal(cache.check(self.traj[0:2]), True)
+        assert_equal(self._was_cache_reset(cache), True)
+        assert_equal(cache.check(self.traj[2:4]), False)
+        assert_equal(cache.contents, { 'start' : 2 })
+
+
 class testSequentialEnsembleCache(EnsembleCacheTest):
     def setUp(self):
         self.inX = AllInXEnsemble(vol1)
@@ -1458,6 +1514,19 @@ class testSequentialEnsembleCache(EnsembleCacheTest):
         assert_equal(cache.contents['ens_from'], 0)
         assert_equal(cache.contents['subtraj_from'], 5)
 
+    def test_sequential_caching_does_not_search(self):
+        # with a trusted cache, the trajectory should never be searched for
+        # the previous final frame (that makes can_append O(len(traj)))
+        class UnsearchableTrajectory(paths.Trajectory):
+            def index(self, value):
+                raise AssertionError("trajectory was searched")
+
+        for i in range(len(self.traj)):
+            traj = UnsearchableTrajectory(self.traj[0:i+1])
+            assert_equal(self.pseudo_minus.can_append(traj), i < 5)
+            rev_traj = UnsearchableTrajectory(self.traj[-(i+1):])
+            assert_equal(self.pseudo_minus.can_prepend(rev_traj), i < 5)
+
     def test_sequential_caching_resets(self):
         #cache = self.pseudo_minus._cache_can_append
         assert_equal(self.pseudo_minus.can_append(self.traj[2:3]), True)
@@ -2722,6 +2791,119 @@ class testVolumeCombinations(EnsembleTest):
             direction=-1
         )
 
+    def test_short_circuit_profile(self):
+        traj_in = make_1d_traj([0.2, 0.3])
+        traj_out = make_1d_traj([0.7, 0.8])
+        combo = self.outA & self.partinA
+        combo.profiling = True
+        assert_equal(combo(traj_in), False)
+        assert_equal(combo(traj_out), False)
+        profile = combo.short_circuit_profile()
+        assert_equal(profile.n_evaluated, [2, 1])
+        assert_equal(profile.n_decided, [1, 1])
+        # each function has its own statistics
+        assert_equal(
+            combo.short_circuit_profile('can_append').n_evaluated, [0, 0])
+
+    def test_short_circuit_reorder(self):
+        traj_in = make_1d_traj([0.2, 0.3])
+        traj_out = make_1d_traj([0.7, 0.8])
+        combo = self.outA & self.partinA
+        combo.reorder = True
+        profile = combo.short_circuit_profile()
+        # partinA looks cheaper and decides more often
+        profile.n_evaluated = [20, 20]
+        profile.total_time = [2.0, 0.2]
+        profile.n_decided = [5, 15]
+        assert_equal(combo(traj_out), False)
+        assert_equal(profile.swapped, True)
+        assert_equal(profile.n_evaluated, [20, 21])
+        assert_equal(combo(traj_in), False)
+        assert_equal(profile.n_evaluated, [21, 22])
+
+        # non-commutative combinations are never reordered
+        combo = paths.EnsembleCombination(
+            self.outA, self.partinA, fnc=lambda a, b: a and b,
+            str_fnc='{0}\nand\n{1}')
+        combo.reorder = True
+        profile = combo.short_circuit_profile()
+        profile.n_evaluated = [20, 20]
+        profile.total_time = [2.0, 0.2]
+        profile.n_decided = [5, 15]
+        assert_equal(combo(traj_out), False)
+        assert_equal(profile.swapped, False)
+        assert_equal(profile.n_evaluated, [21, 21])
+
+
+class CountingLengthEnsemble(LengthEnsemble):
+    def __init__(self, length):
+        super(CountingLengthEnsemble, self).__init__(length)
+        self.n_calls = 0
+
+    def __call__(self, trajectory, trusted=None):
+        self.n_calls += 1
+        return super(CountingLengthEnsemble, self).__call__(trajectory,
+                                                            trusted)
+
+
+class testEnsembleMemo(object):
+    def setup(self):
+        self.ensemble = CountingLengthEnsemble(3)
+        self.ensemble.memoize = True
+        self.traj = make_1d_traj([0.1, 0.2, 0.3])
+
+    def test_memo_off(self):
+        self.ensemble.memoize = False
+        assert_equal(self.ensemble.check(self.traj), True)
+        assert_equal(self.ensemble.check(self.traj), True)
+        assert_equal(self.ensemble.n_calls, 2)
+
+    def test_memo(self):
+        assert_equal(self.ensemble.check(self.traj), True)
+        assert_equal(self.ensemble.check(self.traj), True)
+        assert_equal(self.ensemble.n_calls, 1)
+        # results are remembered per trajectory object
+        assert_equal(self.ensemble.check(paths.Trajectory(self.traj)), True)
+        assert_equal(self.ensemble.n_calls, 2)
+        self.ensemble.clear_memo()
+        assert_equal(self.ensemble.check(self.traj), True)
+        assert_equal(self.ensemble.n_calls, 3)
+
+    def test_memo_changed_in_place(self):
+        extra = make_1d_traj([0.4, 0.5])
+        assert_equal(self.ensemble.check(self.traj), True)
+        self.traj.append(extra[0])
+        assert_equal(self.ensemble.check(self.traj), False)
+        assert_equal(self.ensemble.n_calls, 2)
+        del self.traj[-1]
+        self.traj.insert(0, extra[1])
+        assert_equal(self.ensemble.check(self.traj), False)
+        assert_equal(self.ensemble.n_calls, 3)
+        del self.traj[0]
+        assert_equal(self.ensemble.check(self.traj), True)
+        assert_equal(self.ensemble.n_calls, 4)
+
+    def test_memo_size(self):
+        self.ensemble.memo_size = 2
+        trajs = [paths.Trajectory(self.traj) for i in range(3)]
+        for traj in trajs:
+            self.ensemble.check(traj)
+        assert_equal(self.ensemble.n_calls, 3)
+        self.ensemble.check(trajs[2])
+        self.ensemble.check(trajs[1])
+        assert_equal(self.ensemble.n_calls, 3)
+        self.ensemble.check(trajs[0])
+        assert_equal(self.ensemble.n_calls, 4)
+
+    def test_memo_weak(self):
+        import weakref
+        import gc
+        self.ensemble.check(self.traj)
+        traj_ref = weakref.ref(self.traj)
+        del self.traj
+        gc.collect()
+        assert_equal(traj_ref(), None)
+
 
 class testAbstract(object):
     @raises_with_message_like(TypeError, "Can't instantiate abstract class")
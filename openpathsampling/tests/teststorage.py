@@ -3,6 +3,7 @@
 @author Jan-Hendrik Prinz
 """
 import os
+import threading
 
 import mdtraj as md
 from nose.tools import (assert_equal)
@@ -12,7 +13,7 @@ import openpathsampling as paths
 import openpathsampling.engines.openmm as peng
 import openpathsampling.engines.toy as toys
 
-from openpathsampling.netcdfplus import ObjectJSON
+from openpathsampling.netcdfplus import ObjectJSON, UUIDIndex
 from openpathsampling.storage import Storage
 from test_helpers import (data_filename,
                           compare_snapshot
@@ -342,6 +343,208 @@ class testStorage(object):
 
         store.close()
 
+    def test_write_behind(self):
+        store = Storage(filename=self.filename, mode='w')
+        store.set_write_behind(1000)
+        assert(os.path.isfile(self.filename))
+
+        traj = paths.Trajectory(list(self.traj))
+        store.trajectories.save(traj)
+
+        # rows are staged, but indices and lengths are updated
+        assert(len(store.snapshots) == 2 * len(traj))
+        assert(len(store.trajectories) == 1)
+        assert(store._staged > 0)
+
+        store.trajectories.save(traj.reversed)
+        assert(len(store.snapshots) == 2 * len(traj))
+        assert(len(store.trajectories) == 2)
+
+        store.sync()
+        assert(store._staged == 0)
+        assert(len(store.dimensions['snapshots']) == len(traj))
+
+        store.close()
+
+        store = Storage(filename=self.filename, mode='r')
+        assert(len(store.trajectories) == 2)
+        loaded = store.trajectories[0]
+        for snap, loaded_snap in zip(traj, loaded):
+            compare_snapshot(snap, loaded_snap, True)
+
+        loaded = store.trajectories[1]
+        for snap, loaded_snap in zip(traj.reversed, loaded):
+            compare_snapshot(snap, loaded_snap)
+
+        store.close()
+
+    def test_binary_uuids(self):
+        uuids = [self.toy_template.__uuid__, None,
+                 self.toy_template.reversed.__uuid__]
+        binary = Storage.uuids_to_binary(uuids)
+        assert_equal(binary.shape, (3, 2))
+        assert_equal(Storage.binary_to_uuids(binary), uuids)
+        assert_equal(Storage.binary_to_uuids(binary.ravel()), uuids)
+
+        store = Storage(filename=self.filename, mode='w', use_uuid=True)
+        assert(store.binary_uuid)
+
+        traj = paths.Trajectory(list(self.traj))
+        store.trajectories.save(traj)
+        assert_equal(store.variables['trajectories_uuid'].dtype, np.uint64)
+        store.close()
+
+        store = Storage(filename=self.filename, mode='r')
+        assert(store.binary_uuid)
+        loaded = store.trajectories[0]
+        assert_equal(loaded.__uuid__, traj.__uuid__)
+        for snap, loaded_snap in zip(traj, loaded):
+            assert_equal(snap.__uuid__, loaded_snap.__uuid__)
+            compare_snapshot(snap, loaded_snap, True)
+
+        store.close()
+
+    def test_uuid_index(self):
+        store = Storage(filename=self.filename, mode='w', use_uuid=True)
+        traj = paths.Trajectory(list(self.traj))
+        store.trajectories.save(traj)
+        store.close()
+
+        store = Storage(filename=self.filename, mode='r')
+        assert_equal(store.uuid_index.count(store.trajectories), 1)
+        assert_equal(
+            store.uuid_index.count(store.snapshots), len(store.snapshots) / 2)
+
+        # the positions of restored objects are only found in the index
+        assert(traj in store.trajectories.index)
+        assert_equal(store.trajectories.index[traj], 0)
+        assert_equal(list(store.trajectories.index), [traj.__uuid__])
+
+        for snap in traj:
+            rev = snap.reversed
+            assert_equal(
+                store.snapshots.index[rev], store.snapshots.index[snap] ^ 1)
+            assert_equal(store.load(snap.__uuid__).__uuid__, snap.__uuid__)
+            assert_equal(store.load(rev.__uuid__).__uuid__, rev.__uuid__)
+
+        assert_equal(store.load(traj.__uuid__).__uuid__, traj.__uuid__)
+        store.close()
+
+    def test_iterate_restored(self):
+        store = Storage(filename=self.filename, mode='w', use_uuid=True)
+        trajs = [paths.Trajectory(list(self.traj)[:n]) for n in [2, 3, 4]]
+        for traj in trajs:
+            store.trajectories.save(traj)
+        store.close()
+
+        store = Storage(filename=self.filename, mode='r')
+        # loading an object must not change the iteration over the store
+        assert_equal(store.trajectories[1].__uuid__, trajs[1].__uuid__)
+        for _ in range(2):
+            assert_equal([t.__uuid__ for t in store.trajectories],
+                         [t.__uuid__ for t in trajs])
+            assert_equal(len(store.trajectories.index), 3)
+        store.close()
+
+    def test_proxy_holds_lock(self):
+        store = Storage(filename=self.filename, mode='w')
+        tm = self.template_snapshot
+        store.save(tm)
+        store.snapshots.cache.clear()
+        px = store.snapshots.proxy(0)
+
+        # another thread (e.g. a step writer) uses the storage
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            with store.lock:
+                acquired.set()
+                release.wait()
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        acquired.wait()
+
+        loaded = []
+        loader = threading.Thread(
+            target=lambda: loaded.append(px.__subject__))
+        loader.start()
+        try:
+            loader.join(0.2)
+            assert_equal(loaded, [])
+        finally:
+            release.set()
+            loader.join()
+            holder.join()
+
+        compare_snapshot(loaded[0], tm)
+        store.close()
+
+    def test_reopen_without_uuid(self):
+        store = Storage(filename=self.filename, mode='w', use_uuid=False)
+        traj = paths.Trajectory(list(self.traj))
+        store.trajectories.save(traj)
+        store.close()
+
+        store = Storage(filename=self.filename, mode='r')
+        assert_equal(len(store.snapshots), 2 * len(traj))
+        compare_snapshot(store.trajectories[0][1], traj[1])
+        store.close()
+
+    def test_saved_uuid_index(self):
+        store = Storage(filename=self.filename, mode='w', use_uuid=True)
+        traj = paths.Trajectory(list(self.traj))
+        store.trajectories.save(traj)
+        store.save_uuid_index()
+        store.close()
+
+        store = Storage(filename=self.filename, mode='a')
+        assert_equal(store.uuid_index_start['trajectories'], 1)
+        assert_equal(store.load(traj.__uuid__).__uuid__, traj.__uuid__)
+
+        # objects saved later are added when the storage is closed
+        rev = traj.reversed
+        store.trajectories.save(rev)
+        store.close()
+
+        store = Storage(filename=self.filename, mode='r')
+        assert_equal(store.uuid_index_start['trajectories'], 2)
+        assert_equal(store.trajectories.index[rev], 1)
+        for snap in rev:
+            assert_equal(store.load(snap.__uuid__).__uuid__, snap.__uuid__)
+
+        store.close()
+
+        for part in UUIDIndex.parts:
+            os.remove('%s.uuids.%s.npy' % (self.filename, part))
+
+    def test_saved_uuid_index_read_only(self):
+        store = Storage(filename=self.filename, mode='w', use_uuid=True)
+        traj = paths.Trajectory(list(self.traj))
+        store.trajectories.save(traj)
+        store.save_uuid_index()
+        # objects saved later are missing in the saved index (as if the
+        # writing process stopped before closing)
+        rev = traj.reversed
+        store.trajectories.save(rev)
+        store.uuid_index.modified = False
+        store.close()
+
+        files = ['%s.uuids.%s.npy' % (self.filename, part)
+                 for part in UUIDIndex.parts]
+        for filename in files:
+            os.utime(filename, (0, 0))
+
+        # opening read-only must not rewrite the saved index
+        store = Storage(filename=self.filename, mode='r')
+        assert_equal(store.load(rev.__uuid__).__uuid__, rev.__uuid__)
+        store.close()
+
+        for filename in files:
+            assert_equal(os.path.getmtime(filename), 0)
+            os.remove(filename)
+
     def test_reverse_bug(self):
         store = Storage(filename=self.filename,
                         mode='w', use_uuid=False)
@@ -4,11 +4,14 @@
 
 from nose.tools import assert_equal, assert_not_equal, assert_is, raises
 from nose.plugins.skip import Skip, SkipTest
-from test_helpers import CallIdentity, raises_with_message_like
+from test_helpers import CallIdentity, raises_with_message_like, make_1d_traj
 
 import unittest
+import numpy as np
 
+import openpathsampling as paths
 import openpathsampling.volume as volume
+import openpathsampling.engines.toy as toys
 
 class Identity2(CallIdentity):
     def __str__(self):
@@ -350,6 +353,299 @@ class testCVRangeVolumePeriodic(object):
                      volume.PeriodicCVDefinedVolume(op_id, -100, 75))
 
 
+class testVolumeMask(object):
+    def setUp(self):
+        self.cv = paths.FunctionCV("x", lambda snap: snap.coordinates[0][0])
+        self.traj = make_1d_traj([-0.8, -0.5, -0.1, 0.3, 0.5, 0.7, 160.0])
+
+    def _check_mask(self, vol, traj):
+        expected = [vol(snap) for snap in traj]
+        mask = vol.mask(traj)
+        assert_equal(mask.dtype, np.bool_)
+        assert_equal(list(mask), expected)
+
+    def test_cv_defined_mask(self):
+        vol = volume.CVDefinedVolume(self.cv, -0.5, 0.5)
+        assert_equal(list(vol.mask(self.traj)),
+                     [False, True, True, True, True, False, False])
+        self._check_mask(vol, self.traj)
+        self._check_mask(~vol, self.traj)
+        self._check_mask(
+            volume.CVDefinedVolume(self.cv, float("-inf"), 0.0), self.traj)
+
+    def test_periodic_mask(self):
+        for vol in [volume.PeriodicCVDefinedVolume(self.cv, -100, 75),
+                    volume.PeriodicCVDefinedVolume(self.cv, 75, -100),
+                    volume.PeriodicCVDefinedVolume(self.cv, 150, -150,
+                                                   -180, 180),
+                    volume.PeriodicCVDefinedVolume(self.cv, 0.2, 0.6,
+                                                   0.0, 1.0)]:
+            self._check_mask(vol, self.traj)
+
+    def test_empty_mask(self):
+        vol = volume.CVDefinedVolume(self.cv, -0.5, 0.5)
+        assert_equal(len(vol.mask(paths.Trajectory([]))), 0)
+
+    def test_mask_without_cv(self):
+        # plain callables and values with units are tested frame by frame
+        import simtk.unit as u
+        vol = volume.CVDefinedVolume(
+            op_id, -0.5 * u.nanometers, 0.25 * u.nanometers)
+        values = [-0.25 * u.nanometers, -0.75 * u.nanometers]
+        assert_equal(list(vol.mask(values)), [True, False])
+        assert_equal(list(volA.mask([-0.6, 0.0, 0.6])), [False, True, False])
+
+
+    def test_combination_masks(self):
+        volA_ = volume.CVDefinedVolume(self.cv, -0.5, 0.5)
+        volB_ = volume.CVDefinedVolume(self.cv, 0.25, 0.75)
+        volC_ = volume.PeriodicCVDefinedVolume(self.cv, -0.6, -0.2)
+        for vol in [volume.UnionVolume(volA_, volC_),
+                    volume.IntersectionVolume(volA_, volC_),
+                    volume.SymmetricDifferenceVolume(volA_, volC_),
+                    volume.RelativeComplementVolume(volA_, volC_),
+                    (volA_ | volC_) - volB_,
+                    ~(volA_ & volC_) ^ volB_,
+                    volume.VolumeCombination(volA_, volC_,
+                                             lambda a, b: a and b,
+                                             '{0} and {1}')]:
+            self._check_mask(vol, self.traj)
+
+    def test_combination_mask_short_circuit(self):
+        n_calls = []
+        def list_cv(snapshots):
+            n_calls.append(len(snapshots))
+            return [snap.coordinates[0][0] for snap in snapshots]
+        cv2 = paths.FunctionCV("list_cv", list_cv, cv_requires_lists=True)
+        vol1 = volume.CVDefinedVolume(self.cv, -0.5, 0.5)
+        vol2 = volume.CVDefinedVolume(cv2, 0.0, 1.0)
+        # only the 3 frames outside vol1 need to be tested in vol2
+        assert_equal(list((vol1 | vol2).mask(self.traj)),
+                     [False, True, True, True, True, True, False])
+        assert_equal(n_calls, [3])
+
+    def test_empty_full_mask(self):
+        assert_equal(list(volume.EmptyVolume().mask(self.traj)),
+                     [False] * len(self.traj))
+        assert_equal(list(volume.FullVolume().mask(self.traj)),
+                     [True] * len(self.traj))
+
+    def test_voronoi_mask(self):
+        centers = np.array([-0.5, 0.0, 1.0])
+        dist_cv = paths.FunctionCV(
+            "dist", lambda snap: np.abs(snap.coordinates[0][0] - centers))
+        vol = volume.VoronoiVolume(dist_cv, 1)
+        assert_equal(list(vol.cells(self.traj)), [0, 0, 1, 1, 1, 2, 2])
+        assert_equal(list(vol.cells(self.traj)),
+                     [vol.cell(snap) for snap in self.traj])
+        self._check_mask(vol, self.traj)
+        assert_equal(list(vol.mask(self.traj, state=2)),
+                     [False, False, False, False, False, True, True])
+        assert_equal(len(vol.cells(paths.Trajectory([]))), 0)
+
+
+class testVolumeCombinationProfile(object):
+    def setUp(self):
+        self.calls = []
+        def cv1(x):
+            self.calls.append(1)
+            return x
+        def cv2(x):
+            self.calls.append(2)
+            return x
+        self.vol1 = volume.CVDefinedVolume(cv1, -0.5, 0.5)
+        self.vol2 = volume.CVDefinedVolume(cv2, 0.0, 1.0)
+
+    def test_profile(self):
+        combo = self.vol1 & self.vol2
+        combo.profiling = True
+        values = [-0.6, 0.1, 0.6, 0.2]
+        assert_equal([combo(x) for x in values], [False, True, False, True])
+        assert_equal(self.calls, [1, 1, 2, 1, 1, 2])
+        profile = combo.short_circuit_profile()
+        assert_equal(profile.n_evaluated, [4, 2])
+        assert_equal(profile.n_decided, [2, 0])
+
+        assert_equal(list(combo.mask(values)), [False, True, False, True])
+        profile = combo.short_circuit_profile('mask')
+        assert_equal(profile.n_evaluated, [4, 2])
+        assert_equal(profile.n_decided, [2, 0])
+
+    def test_reorder(self):
+        combo = self.vol1 & self.vol2
+        combo.reorder = True
+        for fname in ['__call__', 'mask']:
+            profile = combo.short_circuit_profile(fname)
+            # vol2 looks cheaper and decides more often
+            profile.n_evaluated = [20, 20]
+            profile.total_time = [2.0, 0.2]
+            profile.n_decided = [5, 15]
+        assert_equal(combo(0.3), True)
+        assert_equal(combo(1.5), False)
+        assert_equal(self.calls, [2, 1, 2])
+        assert_equal(combo.short_circuit_profile().swapped, True)
+
+        self.calls[:] = []
+        values = [-0.6, 0.1, 0.6, 1.5]
+        assert_equal(list(combo.mask(values)), [False, True, False, False])
+        assert_equal(self.calls, [2, 2, 2, 2, 1, 1])
+
+    def test_no_reorder_of_complement(self):
+        combo = self.vol1 - self.vol2
+        combo.reorder = True
+        profile = combo.short_circuit_profile()
+        profile.n_evaluated = [20, 20]
+        profile.total_time = [2.0, 0.2]
+        profile.n_decided = [5, 15]
+        assert_equal(combo(-0.3), True)
+        assert_equal(self.calls, [1, 2])
+        assert_equal(profile.swapped, False)
+
+
+class testKDTreeVoronoiVolume(object):
+    def setUp(self):
+        self.centers = np.array([[-0.5, 0.0], [0.0, 1.0], [1.0, 0.0]])
+        self.pos_cv = paths.FunctionCV(
+            "pos", lambda snap: snap.coordinates[0][0:2])
+        self.dist_cv = paths.FunctionCV(
+            "dist", lambda snap: np.sqrt(np.sum(
+                (snap.coordinates[0][0:2] - self.centers)**2, axis=1)))
+        self.traj = paths.Trajectory([
+            toys.Snapshot(coordinates=np.array([[x, y, 0.0]]),
+                                velocities=np.array([[0.0, 0.0, 0.0]]))
+            for (x, y) in [(-0.8, 0.1), (0.0, 0.6), (0.6, 0.0),
+                           (2.0, -1.0), (-0.1, 2.0)]
+        ])
+
+    def test_cells(self):
+        vol = volume.KDTreeVoronoiVolume(self.pos_cv, self.centers, 1)
+        reference = volume.VoronoiVolume(self.dist_cv, 1)
+        assert_equal(list(vol.cells(self.traj)), [0, 1, 2, 2, 1])
+        assert_equal([vol.cell(snap) for snap in self.traj],
+                     list(reference.cells(self.traj)))
+        assert_equal([vol(snap) for snap in self.traj],
+                     [reference(snap) for snap in self.traj])
+        assert_equal(list(vol.mask(self.traj)),
+                     [False, True, False, False, True])
+        assert_equal(list(vol.mask(self.traj, state=2)),
+                     [False, False, True, True, False])
+        assert_equal(len(vol.cells(paths.Trajectory([]))), 0)
+
+    def test_one_dimensional_centers(self):
+        x_cv = paths.FunctionCV("x", lambda snap: snap.coordinates[0][0])
+        vol = volume.KDTreeVoronoiVolume(x_cv, [-0.5, 0.0, 1.0], 0)
+        assert_equal(list(vol.cells(self.traj)), [0, 1, 2, 2, 1])
+        assert_equal(vol(self.traj[0]), True)
+
+
+class testCompiledVolume(object):
+    def setUp(self):
+        self.cv = paths.FunctionCV("x", lambda snap: snap.coordinates[0][0])
+        self.cv2 = paths.FunctionCV("2x",
+                                    lambda snap: 2 * snap.coordinates[0][0])
+        self.traj = make_1d_traj([-0.8, -0.5, -0.25, -0.1, 0.0, 0.25, 0.3,
+                                  0.5, 0.6, 0.7, 0.75, 1.0, 160.0, -181.0])
+
+    def _check_compiled(self, vol):
+        compiled = volume.CompiledVolume(vol)
+        assert_equal([compiled(snap) for snap in self.traj],
+                     [vol(snap) for snap in self.traj])
+        assert_equal(list(compiled.mask(self.traj)),
+                     [vol(snap) for snap in self.traj])
+        return compiled
+
+    def test_compiled_cv_defined(self):
+        volA_ = volume.CVDefinedVolume(self.cv, -0.5, 0.5)
+        volB_ = volume.CVDefinedVolume(self.cv, 0.25, 0.75)
+        volC_ = volume.CVDefinedVolume(self.cv, float("-inf"), 0.0)
+        for vol in [volA_, ~volA_, volA_ | volB_, volA_ & volB_,
+                    volA_ ^ volB_, volA_ - volB_, (volA_ | volC_) - volB_,
+                    ~(volA_ & volC_) ^ volB_]:
+            compiled = self._check_compiled(vol)
+            assert_equal(compiled.n_channels, 1)
+            assert_equal(str(compiled), str(vol))
+
+    def test_compiled_periodic(self):
+        volA_ = volume.PeriodicCVDefinedVolume(self.cv, 150, -150, -180, 180)
+        volB_ = volume.PeriodicCVDefinedVolume(self.cv, -100, 75)
+        volC_ = volume.PeriodicCVDefinedVolume(self.cv, 0.2, 0.6, 0.0, 1.0)
+        volD_ = volume.CVDefinedVolume(self.cv, -0.5, 0.5)
+        for vol in [volA_, volB_, volC_, volA_ | volB_, volA_ & volD_,
+                    volB_ - volD_, volC_ | volD_, ~volC_ ^ volA_]:
+            self._check_compiled(vol)
+        # the domains [-180, 180) and [0, 1) need separate channels
+        assert_equal(
+            volume.CompiledVolume(volA_ | volB_ | volC_ | volD_).n_channels,
+            3)
+
+    def test_compiled_mixed(self):
+        volA_ = volume.CVDefinedVolume(self.cv, -0.5, 0.5)
+        volB_ = volume.CVDefinedVolume(self.cv2, 0.5, 1.0)
+        volC_ = volume.CVDefinedVolume(self.cv, 0.0, 0.75)
+        voronoi = volume.VoronoiVolume(
+            paths.FunctionCV("dist", lambda snap:
+                             np.abs(snap.coordinates[0][0] -
+                                    np.array([-0.5, 0.5]))), 0)
+        for vol in [(volA_ | volB_) & volC_, volA_ - (volB_ ^ volC_),
+                    (volA_ & voronoi) | volB_,
+                    volA_ & volume.FullVolume(),
+                    volA_ | volume.EmptyVolume()]:
+            self._check_compiled(vol)
+        assert_equal(
+            volume.CompiledVolume((volA_ | volB_) & volC_).n_channels, 2)
+
+    def test_compiled_constant(self):
+        volA_ = volume.CVDefinedVolume(self.cv, -0.5, 0.5)
+        compiled = self._check_compiled(volA_ | ~volA_)
+        assert_equal(compiled.n_channels, 1)
+        assert_equal(compiled(self.traj[0]), True)
+        self._check_compiled(volA_ & volume.EmptyVolume())
+
+        # constant subtrees in a relative complement
+        volB_ = volume.CVDefinedVolume(self.cv, 0.25, 0.75)
+        for vol in [
+            volume.RelativeComplementVolume(
+                volA_, volume.UnionVolume(volB_, volume.NegatedVolume(volB_))),
+            volume.RelativeComplementVolume(volA_, volume.FullVolume()),
+            volume.RelativeComplementVolume(
+                volume.FullVolume(), volume.FullVolume()),
+            volume.RelativeComplementVolume(volume.FullVolume(), volA_)
+        ]:
+            self._check_compiled(vol)
+
+    def test_compiled_units(self):
+        # values with units are passed on to the original volume
+        import simtk.unit as u
+        vol = volume.CVDefinedVolume(
+            op_id, -0.5 * u.nanometers, 0.25 * u.nanometers)
+        compiled = volume.CompiledVolume(vol)
+        assert_equal(compiled.n_channels, 0)
+        assert_equal(compiled(-0.25 * u.nanometers), True)
+        assert_equal(compiled(-0.75 * u.nanometers), False)
+
+
+    def test_compiled_cv_errors(self):
+        # errors of the CV are raised and not hidden by the fallback
+        calls = []
+
+        def fail(snap):
+            calls.append(snap)
+            raise ValueError('bad snapshot')
+
+        compiled = volume.CompiledVolume(volume.CVDefinedVolume(
+            paths.FunctionCV("fail", fail), -0.5, 0.5))
+        for evaluate in [lambda: compiled(self.traj[0]),
+                         lambda: compiled.mask(self.traj[:2])]:
+            del calls[:]
+            try:
+                evaluate()
+            except ValueError as e:
+                assert_equal(str(e), 'bad snapshot')
+            else:
+                raise AssertionError('ValueError not raised')
+            assert_equal(len(calls), 1)
+        assert_equal(compiled._incompatible, False)
+
 class testVolumeFactory(object):
     def test_check_minmax(self):
         minmax1 = volume.VolumeFactory._check_minmax(0, [2, 2])
@@ -6,7 +6,14 @@ Created on 03.09.2014
 
 import range_logic
 import abc
+import bisect
+import numbers
+import time
+import numpy as np
+import scipy.spatial
+import chaindict as cd
 from openpathsampling.netcdfplus import StorableNamedObject
+from combination_profile import ShortCircuitProfile
 
 # TODO: Make Full and Empty be Singletons to avoid storing them several times!
 
@@ -32,6 +39,46 @@ def join_volumes(volume_list):
     return volume
 
 
+def _as_frames(trajectory):
+    """
+    Return the frames of a trajectory (or any iterable of snapshots) as list.
+
+    For :class:`openpathsampling.Trajectory` objects the proxies are used so
+    that no snapshot needs to be loaded from storage.
+    """
+    try:
+        return trajectory.as_proxies()
+    except AttributeError:
+        return list(trajectory)
+
+
+def _cv_values(collectivevariable, frames):
+    """
+    Evaluate a collective variable for a list of frames.
+
+    Collective variables are called once with the whole list, so that the
+    list path of the underlying ChainDicts (cache lookup and evaluation of
+    missing values) is used. Any other callable is evaluated frame by frame.
+    """
+    if isinstance(collectivevariable, cd.ChainDict):
+        return collectivevariable(frames)
+    else:
+        return [collectivevariable(frame) for frame in frames]
+
+
+def _float_array(values):
+    """
+    Convert a list of CV values into a 1D numpy array of floats
+    """
+    try:
+        arr = np.asarray(values, dtype=float)
+    except (TypeError, ValueError):
+        arr = np.array([value.__float__() for value in values], dtype=float)
+
+    # allow singletons like [[0.1], [0.2]] as we do with __float__
+    return arr.reshape(len(values))
+
+
 class Volume(StorableNamedObject):
     """
     A Volume describes a set of snapshots 
@@ -49,7 +96,29 @@ class Volume(StorableNamedObject):
         '''
         
         return False # pragma: no cover
-                
+
+    def mask(self, trajectory):
+        '''
+        Returns a boolean array with `True` for all frames in the Region
+
+        The default implementation calls the volume for each frame.
+        Subclasses can override this to evaluate all frames at once.
+
+        Parameters
+        ----------
+        trajectory : :class:`openpathsampling.Trajectory` or list
+            the frames to be tested
+
+        Returns
+        -------
+        numpy.ndarray of bool
+            entry `i` is `True` if frame `i` is inside the volume
+        '''
+        frames = _as_frames(trajectory)
+        return np.fromiter(
+            (bool(self(frame)) for frame in frames),
+            dtype=bool, count=len(frames))
+
     def __str__(self):
         '''
         Returns a string representation of the volume
@@ -109,15 +178,69 @@ class VolumeCombination(Volume):
 
     This should be treated as an abstract class. For storage purposes, use
     specific subclasses in practice.
+
+    Attributes
+    ----------
+    profiling : bool
+        if `True`, record the evaluation time of both volumes and how often
+        each decides the result (see :meth:`.short_circuit_profile`).
+        Default is `False`.
+    reorder : bool
+        if `True`, commutative combinations evaluate the volume with the
+        lower expected cost first, based on the recorded statistics. This
+        implies `profiling`. Default is `False`.
+    commutative : bool
+        whether the order of the two volumes can be changed
     """
-    def __init__(self, volume1, volume2, fnc, str_fnc):
+
+    profiling = False
+    reorder = False
+    commutative = False
+
+    def __init__(self, volume1, volume2, fnc, str_fnc, mask_fnc=None):
         super(VolumeCombination, self).__init__()
         self.volume1 = volume1
         self.volume2 = volume2
         self.fnc = fnc
         self.sfnc = str_fnc
+        self.mask_fnc = mask_fnc
+
+    def short_circuit_profile(self, fname='__call__'):
+        """
+        Statistics of the two volumes for `__call__` or `mask`
+
+        Returns
+        -------
+        :class:`openpathsampling.combination_profile.ShortCircuitProfile`
+            the statistics; empty unless `profiling` or `reorder` is set
+        """
+        try:
+            profiles = self._short_circuit_profiles
+        except AttributeError:
+            profiles = self._short_circuit_profiles = {}
+        if fname not in profiles:
+            profiles[fname] = ShortCircuitProfile(self.fnc)
+        return profiles[fname]
+
+    def _ordered_volumes(self, profile):
+        """
+        The two volumes (with their index) in the order of evaluation
+        """
+        if self.reorder and self.commutative and profile.update_order():
+            return [(1, self.volume2), (0, self.volume1)]
+        else:
+            return [(0, self.volume1), (1, self.volume2)]
 
     def __call__(self, snapshot):
+        if self.profiling or self.reorder:
+            profile = self.short_circuit_profile('__call__')
+            (idx1, vol1), (idx2, vol2) = self._ordered_volumes(profile)
+            a = profile.evaluate(idx1, vol1, snapshot)
+            if profile.decides(a):
+                return self.fnc(a, True)
+            else:
+                return self.fnc(a, profile.evaluate(idx2, vol2, snapshot))
+
         # short circuit following JHP's implementation in ensemble.py
         a = self.volume1(snapshot)
         res_true = self.fnc(a, True)
@@ -129,6 +252,43 @@ class VolumeCombination(Volume):
             return self.fnc(a, b)
         #return self.fnc(self.volume1.__call__(snapshot),
                         #self.volume2.__call__(snapshot))
+
+    def mask(self, trajectory):
+        if self.mask_fnc is None:
+            return super(VolumeCombination, self).mask(trajectory)
+
+        frames = _as_frames(trajectory)
+        profile = None
+        vol1, vol2 = self.volume1, self.volume2
+        if self.profiling or self.reorder:
+            profile = self.short_circuit_profile('mask')
+            (idx1, vol1), (idx2, vol2) = self._ordered_volumes(profile)
+            start = time.time()
+
+        a = vol1.mask(frames)
+
+        # short circuit as in __call__: volume2 is only evaluated for the
+        # frames where the result actually depends on it
+        res_true = self.mask_fnc(a, np.ones_like(a))
+        res_false = self.mask_fnc(a, np.zeros_like(a))
+        result = res_false.copy()
+        undecided = np.flatnonzero(res_true != res_false)
+        if profile is not None:
+            profile.record(idx1, time.time() - start, len(a),
+                           len(a) - len(undecided))
+        if len(undecided) > 0:
+            undecided_frames = [frames[idx] for idx in undecided]
+            if profile is not None:
+                start = time.time()
+            b = vol2.mask(undecided_frames)
+            result[undecided] = self.mask_fnc(a[undecided], b)
+            if profile is not None:
+                b_true = self.mask_fnc(b, np.ones_like(b))
+                b_false = self.mask_fnc(b, np.zeros_like(b))
+                profile.record(idx2, time.time() - start, len(b),
+                               int(np.sum(b_true == b_false)))
+
+        return result
     
     def __str__(self):
         return '(' + self.sfnc.format(str(self.volume1), str(self.volume2)) + ')'
@@ -139,26 +299,44 @@ class VolumeCombination(Volume):
 
 class UnionVolume(VolumeCombination):
     """ "Or" combination (union) of two volumes."""
+    commutative = True
+
     def __init__(self, volume1, volume2):
-        super(UnionVolume, self).__init__(volume1, volume2, lambda a,b : a or b, str_fnc = '{0} or {1}')
+        super(UnionVolume, self).__init__(
+            volume1, volume2, lambda a,b : a or b, str_fnc = '{0} or {1}',
+            mask_fnc = np.logical_or
+        )
 
 
 class IntersectionVolume(VolumeCombination):
     """ "And" combination (intersection) of two volumes."""
+    commutative = True
+
     def __init__(self, volume1, volume2):
-        super(IntersectionVolume, self).__init__(volume1, volume2, lambda a,b : a and b, str_fnc = '{0} and {1}')
+        super(IntersectionVolume, self).__init__(
+            volume1, volume2, lambda a,b : a and b, str_fnc = '{0} and {1}',
+            mask_fnc = np.logical_and
+        )
 
 
 class SymmetricDifferenceVolume(VolumeCombination):
     """ "Xor" combination of two volumes."""
+    commutative = True
+
     def __init__(self, volume1, volume2):
-        super(SymmetricDifferenceVolume, self).__init__(volume1, volume2, lambda a,b : a ^ b, str_fnc = '{0} xor {1}')
+        super(SymmetricDifferenceVolume, self).__init__(
+            volume1, volume2, lambda a,b : a ^ b, str_fnc = '{0} xor {1}',
+            mask_fnc = np.logical_xor
+        )
 
 
 class RelativeComplementVolume(VolumeCombination):
     """ "Subtraction" combination (relative complement) of two volumes."""
     def __init__(self, volume1, volume2):
-        super(RelativeComplementVolume, self).__init__(volume1, volume2, lambda a,b : a and not b, str_fnc = '{0} and not {1}')
+        super(RelativeComplementVolume, self).__init__(
+            volume1, volume2, lambda a,b : a and not b, str_fnc = '{0} and not {1}',
+            mask_fnc = lambda a,b : np.logical_and(a, ~b)
+        )
 
 
 class NegatedVolume(Volume):
@@ -169,7 +347,10 @@ class NegatedVolume(Volume):
 
     def __call__(self, snapshot):
         return not self.volume(snapshot)
-    
+
+    def mask(self, trajectory):
+        return ~self.volume.mask(trajectory)
+
     def __str__(self):
         return '(not ' + str(self.volume) + ')'
     
@@ -182,6 +363,9 @@ class EmptyVolume(Volume):
     def __call__(self, snapshot):
         return False
 
+    def mask(self, trajectory):
+        return np.zeros(len(_as_frames(trajectory)), dtype=bool)
+
     def __and__(self, other):
         return self
 
@@ -209,6 +393,9 @@ class FullVolume(Volume):
     def __call__(self, snapshot):
         return True
 
+    def mask(self, trajectory):
+        return np.ones(len(_as_frames(trajectory)), dtype=bool)
+
     def __invert__(self):
         return EmptyVolume()
 
@@ -365,9 +552,8 @@ class CVDefinedVolume(Volume):
         else:
             return super(CVDefinedVolume, self).__sub__(other)
 
-    def __call__(self, snapshot):
-        l = self.collectivevariable(snapshot).__float__()
-
+    def _in_range(self, l):
+        """Test if the value `l` of the collectivevariable is in range"""
         # we explicitely test for infinity to allow the user to
         # define `lambda_min/max='inf'` also when using units
         # a simtk unit cannot be compared to a python infinite float
@@ -379,6 +565,49 @@ class CVDefinedVolume(Volume):
 
         return True
 
+    def __call__(self, snapshot):
+        l = self.collectivevariable(snapshot).__float__()
+        return self._in_range(l)
+
+    def _bounds(self):
+        return [self.lambda_min, self.lambda_max]
+
+    def _cv_array(self, trajectory):
+        """
+        Values of the collective variable for all frames as float array
+
+        Returns `None` if the values (or the bounds of the volume) cannot be
+        represented as plain floats, e.g. if they carry simtk units.
+        """
+        if not all(isinstance(bound, numbers.Real)
+                   for bound in self._bounds()):
+            return None
+
+        frames = _as_frames(trajectory)
+        if len(frames) == 0:
+            return np.zeros(0, dtype=float)
+
+        try:
+            return _float_array(_cv_values(self.collectivevariable, frames))
+        except (TypeError, ValueError):
+            return None
+
+    def mask(self, trajectory):
+        l = self._cv_array(trajectory)
+        if l is None:
+            return super(CVDefinedVolume, self).mask(trajectory)
+
+        result = np.ones(len(l), dtype=bool)
+
+        # same treatment of infinite bounds (and NaN) as in __call__
+        if self.lambda_min != float('-inf'):
+            result &= ~(self.lambda_min > l)
+
+        if self.lambda_min != float('inf'):
+            result &= ~(self.lambda_max < l)
+
+        return result
+
     def __str__(self):
         return '{{x|{2}(x) in [{0}, {1}]}}'.format(
             self.lambda_min, self.lambda_max, self.collectivevariable.name)
@@ -445,6 +674,20 @@ class PeriodicCVDefinedVolume(CVDefinedVolume):
 
             return wrapped
 
+    def _do_wrap_array(self, values):
+        """Same as `do_wrap` for a numpy array of plain floats."""
+        val = values - self._period_shift
+        positive = val > val * 0
+        wrapped = np.where(
+            positive,
+            values - np.trunc(val / self._period_len) * self._period_len,
+            values + np.trunc((self._period_len - val) / self._period_len)
+            * self._period_len
+        )
+        overflow = np.logical_and(~positive, wrapped >= self._period_len)
+        wrapped[overflow] -= self._period_len
+        return wrapped
+
     # next few functions add support for range logic
     def _copy_with_new_range(self, lmin, lmax):
         return PeriodicCVDefinedVolume(self.collectivevariable, lmin, lmax,
@@ -469,14 +712,36 @@ class PeriodicCVDefinedVolume(CVDefinedVolume):
                                     self.period_min, self.period_max
                                    )
 
+    def _in_range(self, l):
+        """Test if the (wrapped) value `l` is in range"""
+        if self.lambda_min > self.lambda_max:
+            return l >= self.lambda_min or l <= self.lambda_max
+        else:
+            return self.lambda_min <= l <= self.lambda_max
+
     def __call__(self, snapshot):
         l = self.collectivevariable(snapshot).__float__()
         if self.wrap:
             l = self.do_wrap(l)
+        return self._in_range(l)
+
+    def _bounds(self):
+        bounds = [self.lambda_min, self.lambda_max]
+        if self.wrap:
+            bounds += [self._period_shift, self._period_len]
+        return bounds
+
+    def mask(self, trajectory):
+        l = self._cv_array(trajectory)
+        if l is None:
+            return Volume.mask(self, trajectory)
+
+        if self.wrap:
+            l = self._do_wrap_array(l)
         if self.lambda_min > self.lambda_max:
-            return l >= self.lambda_min or l <= self.lambda_max
+            return np.logical_or(l >= self.lambda_min, l <= self.lambda_max)
         else:
-            return self.lambda_min <= l <= self.lambda_max
+            return np.logical_and(self.lambda_min <= l, l <= self.lambda_max)
 
     def __str__(self):
         if self.wrap:
@@ -546,6 +811,44 @@ class VoronoiVolume(Volume):
         
         return min_idx
 
+    def cells(self, trajectory):
+        '''
+        Returns the indices of the voronoi cells of all frames in trajectory
+
+        The distances for all frames are computed in a single call to the
+        collectivevariable.
+
+        Parameters
+        ----------
+        trajectory : :class:`openpathsampling.Trajectory` or list
+            the frames to be tested
+
+        Returns
+        -------
+        numpy.ndarray of int
+            index of the voronoi cell for each frame
+        '''
+        frames = _as_frames(trajectory)
+        if len(frames) == 0:
+            return np.zeros(0, dtype=int)
+
+        distances = _cv_values(self.collectivevariable, frames)
+        try:
+            distances = np.asarray(distances, dtype=float)
+        except (TypeError, ValueError):
+            distances = None
+
+        if distances is None or distances.ndim != 2:
+            return np.array([self.cell(frame) for frame in frames], dtype=int)
+
+        # mimic `cell`: NaN is never a minimum and no cell is found, if all
+        # distances are larger than the initial threshold
+        distances = np.where(np.isnan(distances), np.inf, distances)
+        indices = np.argmin(distances, axis=1)
+        min_vals = distances[np.arange(len(frames)), indices]
+        indices[min_vals >= 1000000000.0] = -1
+        return indices
+
     def __call__(self, snapshot, state=None):
         '''
         Returns `True` if snapshot belongs to voronoi cell in state
@@ -572,6 +875,469 @@ class VoronoiVolume(Volume):
         
         return self.cell(snapshot) == state
 
+    def mask(self, trajectory, state=None):
+        '''
+        Returns a boolean array with `True` for all frames in cell `state`
+
+        Parameters
+        ----------
+        trajectory : :class:`openpathsampling.Trajectory` or list
+            the frames to be tested
+        state : int or None
+            index of the cell to be tested. If `None` (Default) then the
+            internal self.state is used
+
+        Returns
+        -------
+        numpy.ndarray of bool
+            entry `i` is `True` if frame `i` is in the specified voronoi cell
+        '''
+        if state is None:
+            state = self.state
+
+        return self.cells(trajectory) == state
+
+
+class KDTreeVoronoiVolume(VoronoiVolume):
+    '''
+    Voronoi cell defined by explicit centers and found using a k-d tree
+
+    In contrast to :class:`VoronoiVolume` the collectivevariable does not
+    return the distances to all centers but the position of the snapshot
+    in the space of the centers (e.g. a vector of features). The nearest
+    center (with euclidean distance) is found by a
+    :class:`scipy.spatial.cKDTree`, which scales logarithmically in the
+    number of centers.
+
+    Parameters
+    ----------
+    collectivevariable : :class:`openpathsampling.CollectiveVariable`
+        returns the position of a snapshot as a vector of length
+        `n_features`
+    centers : numpy.ndarray, shape=(n_centers, n_features)
+        the positions of the centers of the voronoi cells
+    state : int
+        the index of the center for the chosen voronoi cell
+
+    Attributes
+    ----------
+    collectivevariable : collectivevariable
+        the collectivevariable object
+    centers : numpy.ndarray
+        the positions of the centers of the voronoi cells
+    state : int
+        the index of the center for the chosen voronoi cell
+
+    '''
+
+    def __init__(self, collectivevariable, centers, state):
+        super(KDTreeVoronoiVolume, self).__init__(collectivevariable, state)
+        self.centers = np.asarray(centers, dtype=float)
+        if self.centers.ndim == 1:
+            self.centers = self.centers.reshape((len(self.centers), 1))
+        self._tree = None
+
+    @property
+    def tree(self):
+        '''
+        :class:`scipy.spatial.cKDTree` : spatial index of the centers
+        '''
+        if self._tree is None:
+            self._tree = scipy.spatial.cKDTree(self.centers)
+        return self._tree
+
+    def _query(self, points):
+        points = np.asarray(points, dtype=float)
+        points = points.reshape((-1, self.centers.shape[1]))
+        _, indices = self.tree.query(points)
+        # points with NaN are not assigned to any cell
+        indices = np.asarray(indices, dtype=int)
+        indices[indices >= len(self.centers)] = -1
+        return indices
+
+    def cell(self, snapshot):
+        '''
+        Returns the index of the voronoicell snapshot is in
+
+        Parameters
+        ----------
+        snapshot : :class:`opensampling.engines.BaseSnapshot`
+            the snapshot to be tested
+
+        Returns
+        -------
+        int
+            index of the voronoi cell
+        '''
+        return int(self._query(self.collectivevariable(snapshot))[0])
+
+    def cells(self, trajectory):
+        '''
+        Returns the indices of the voronoi cells of all frames in trajectory
+
+        The positions of all frames are computed in a single call to the
+        collectivevariable and looked up in the tree at once.
+
+        Parameters
+        ----------
+        trajectory : :class:`openpathsampling.Trajectory` or list
+            the frames to be tested
+
+        Returns
+        -------
+        numpy.ndarray of int
+            index of the voronoi cell for each frame
+        '''
+        frames = _as_frames(trajectory)
+        if len(frames) == 0:
+            return np.zeros(0, dtype=int)
+
+        return self._query(_cv_values(self.collectivevariable, frames))
+
+
+class _CVChannel(object):
+    """
+    Sorted boundaries of all range volumes on one collectivevariable.
+
+    The boundaries split the values of the collectivevariable into
+    elementary cells: cell `2*k+1` is the boundary `k` itself, cell `2*k`
+    the open interval below it, cell `2*m` the values above the last of the
+    `m` boundaries and cell `2*m+1` is NaN. Every range volume on the
+    channel is constant on each cell and can be written as a lookup table.
+    """
+    def __init__(self, collectivevariable, wrapper=None):
+        self.collectivevariable = collectivevariable
+        self.wrapper = wrapper
+        self.boundaries = []
+
+    def matches(self, volume):
+        if volume.collectivevariable is not self.collectivevariable:
+            return False
+        if self._is_wrapped(volume) or self.wrapper is not None:
+            return (self._is_wrapped(volume) and
+                    self.wrapper is not None and
+                    volume.period_min == self.wrapper.period_min and
+                    volume.period_max == self.wrapper.period_max)
+        return True
+
+    @staticmethod
+    def _is_wrapped(volume):
+        return isinstance(volume, PeriodicCVDefinedVolume) and volume.wrap
+
+    def add(self, volume):
+        self.boundaries.extend([volume.lambda_min, volume.lambda_max])
+
+    def finalize(self):
+        self.boundaries = np.unique(np.array(self.boundaries, dtype=float))
+        self._boundary_list = self.boundaries.tolist()
+        n_bounds = len(self.boundaries)
+
+        representatives = []
+        for k in range(n_bounds + 1):
+            lower = self.boundaries[k - 1] if k > 0 else float('-inf')
+            upper = self.boundaries[k] if k < n_bounds else float('inf')
+            if lower == float('-inf') and upper == float('inf'):
+                representatives.append(0.0)
+            elif lower == float('-inf'):
+                representatives.append(upper - 1.0 - abs(upper))
+            elif upper == float('inf'):
+                representatives.append(lower + 1.0 + abs(lower))
+            else:
+                representatives.append(lower / 2.0 + upper / 2.0)
+            if k < n_bounds:
+                representatives.append(self.boundaries[k])
+
+        representatives.append(float('nan'))
+        self.representatives = representatives
+
+    def table(self, volume):
+        """Lookup table of `volume` for all cells of this channel"""
+        return np.array(
+            [bool(volume._in_range(l)) for l in self.representatives],
+            dtype=bool)
+
+    def cell(self, value):
+        if self.wrapper is not None:
+            value = self.wrapper.do_wrap(value)
+        if value != value:
+            return 2 * len(self._boundary_list) + 1
+        idx = bisect.bisect_left(self._boundary_list, value)
+        if idx < len(self._boundary_list) and \
+                self._boundary_list[idx] == value:
+            return 2 * idx + 1
+        return 2 * idx
+
+    def cells(self, values):
+        if self.wrapper is not None:
+            values = self.wrapper._do_wrap_array(values)
+        n_bounds = len(self.boundaries)
+        idx = np.searchsorted(self.boundaries, values, side='left')
+        hit = self.boundaries[np.minimum(idx, n_bounds - 1)] == values
+        hit = np.logical_and(hit, idx < n_bounds)
+        result = 2 * idx + hit
+        result[np.isnan(values)] = 2 * n_bounds + 1
+        return result
+
+
+class _TableNode(object):
+    def __init__(self, channel, table):
+        self.channel = channel
+        self.table = table
+
+    def evaluate(self, evaluation):
+        return self.table[evaluation.cells(self.channel)]
+
+
+class _NegatedNode(object):
+    def __init__(self, node):
+        self.node = node
+
+    def evaluate(self, evaluation):
+        return np.logical_not(self.node.evaluate(evaluation))
+
+
+class _CombinationNode(object):
+    def __init__(self, node1, node2, fnc, mask_fnc):
+        self.node1 = node1
+        self.node2 = node2
+        self.fnc = fnc
+        self.mask_fnc = mask_fnc
+
+    def evaluate(self, evaluation):
+        a = self.node1.evaluate(evaluation)
+        if evaluation.single:
+            # same short circuit as VolumeCombination.__call__
+            a = bool(a)
+            res_true = self.fnc(a, True)
+            if res_true == self.fnc(a, False):
+                return res_true
+            return self.fnc(a, bool(self.node2.evaluate(evaluation)))
+        else:
+            return self.mask_fnc(a, self.node2.evaluate(evaluation))
+
+
+class _VolumeNode(object):
+    def __init__(self, volume):
+        self.volume = volume
+
+    def evaluate(self, evaluation):
+        return evaluation.evaluate_volume(self.volume)
+
+
+class _IncompatibleValues(Exception):
+    """
+    Values of a collectivevariable cannot be converted into plain floats
+    """
+    pass
+
+
+class _CompiledEvaluation(object):
+    """
+    Evaluation of a `CompiledVolume` for a snapshot or a list of frames.
+
+    Values of collectivevariables and the cells of each channel are only
+    computed once and only if they are needed.
+    """
+    def __init__(self, frames, single):
+        self.frames = frames
+        self.single = single
+        self._values = {}
+        self._cells = {}
+
+    def values(self, collectivevariable):
+        key = id(collectivevariable)
+        if key not in self._values:
+            # errors of the collectivevariable itself are not caught, only
+            # the conversion of its values
+            if self.single:
+                values = collectivevariable(self.frames)
+                convert = float
+            else:
+                values = _cv_values(collectivevariable, self.frames)
+                convert = _float_array
+            try:
+                self._values[key] = convert(values)
+            except (TypeError, ValueError) as e:
+                raise _IncompatibleValues(str(e))
+        return self._values[key]
+
+    def cells(self, channel):
+        key = id(channel)
+        if key not in self._cells:
+            values = self.values(channel.collectivevariable)
+            if self.single:
+                self._cells[key] = channel.cell(values)
+            else:
+                self._cells[key] = channel.cells(values)
+        return self._cells[key]
+
+    def evaluate_volume(self, volume):
+        if self.single:
+            return volume(self.frames)
+        else:
+            return volume.mask(self.frames)
+
+
+class CompiledVolume(Volume):
+    """
+    Volume which evaluates a combination of CV range volumes in one pass
+
+    Any tree of `CVDefinedVolume` and `PeriodicCVDefinedVolume` objects
+    combined by `&`, `|`, `^`, `-` and `~` is flattened: the boundaries of
+    all volumes on the same collectivevariable (and periodic domain) are
+    collected into one sorted array, and every part of the tree that only
+    depends on this collectivevariable is replaced by a lookup table over
+    the intervals between these boundaries. A snapshot is then tested with
+    one CV lookup and one binary search per distinct collectivevariable,
+    independent of the number of volumes in the tree. Other volumes are
+    kept and evaluated as they are.
+
+    Parameters
+    ----------
+    volume : :class:`openpathsampling.Volume`
+        the volume to be compiled
+
+    Attributes
+    ----------
+    volume : :class:`openpathsampling.Volume`
+        the original volume. The compiled volume contains exactly the same
+        snapshots.
+
+    Notes
+    -----
+    If the values of a collectivevariable cannot be converted into plain
+    floats (e.g. values with simtk units) the original volume is used from
+    then on. Errors raised by the collectivevariables are not caught.
+    """
+
+    _combination_types = (UnionVolume, IntersectionVolume,
+                          SymmetricDifferenceVolume, RelativeComplementVolume)
+
+    def __init__(self, volume):
+        super(CompiledVolume, self).__init__()
+        self.volume = volume
+        self._incompatible = False
+
+        self._channels = []
+        self._collect_channels(volume)
+        for channel in self._channels:
+            channel.finalize()
+
+        self._root = self._compile(volume)
+
+    @staticmethod
+    def _is_range_volume(volume):
+        return (type(volume) in [CVDefinedVolume, PeriodicCVDefinedVolume]
+                and all(isinstance(bound, numbers.Real)
+                        for bound in volume._bounds()))
+
+    def _find_channel(self, volume):
+        for channel in self._channels:
+            if channel.matches(volume):
+                return channel
+        return None
+
+    def _collect_channels(self, volume):
+        if type(volume) in self._combination_types:
+            self._collect_channels(volume.volume1)
+            self._collect_channels(volume.volume2)
+        elif type(volume) is NegatedVolume:
+            self._collect_channels(volume.volume)
+        elif self._is_range_volume(volume):
+            channel = self._find_channel(volume)
+            if channel is None:
+                wrapper = volume if _CVChannel._is_wrapped(volume) else None
+                channel = _CVChannel(volume.collectivevariable, wrapper)
+                self._channels.append(channel)
+            channel.add(volume)
+
+    def _compile(self, volume):
+        """
+        Returns a constant (bool) or a node that evaluates `volume`
+        """
+        if type(volume) is EmptyVolume:
+            return False
+        elif type(volume) is FullVolume:
+            return True
+        elif type(volume) is NegatedVolume:
+            node = self._compile(volume.volume)
+            if type(node) is bool:
+                return not node
+            elif type(node) is _TableNode:
+                return _TableNode(node.channel, ~node.table)
+            else:
+                return _NegatedNode(node)
+        elif type(volume) in self._combination_types:
+            node1 = self._compile(volume.volume1)
+            node2 = self._compile(volume.volume2)
+            tables = [node for node in [node1, node2]
+                      if type(node) is _TableNode]
+            if len(set(id(node.channel) for node in tables)) <= 1 and \
+                    all(type(node) in [bool, _TableNode]
+                        for node in [node1, node2]):
+                # both sides depend on at most one channel: merge the tables.
+                # constants are passed as numpy bools since `~True == -2`
+                result = volume.mask_fnc(
+                    *[node.table if type(node) is _TableNode
+                      else np.bool_(node) for node in [node1, node2]])
+                if len(tables) == 0:
+                    return bool(result)
+                elif not result.any():
+                    return False
+                elif result.all():
+                    return True
+                return _TableNode(tables[0].channel, result)
+
+            return _CombinationNode(
+                self._as_node(node1), self._as_node(node2),
+                volume.fnc, volume.mask_fnc)
+        elif self._is_range_volume(volume):
+            channel = self._find_channel(volume)
+            return _TableNode(channel, channel.table(volume))
+        else:
+            return _VolumeNode(volume)
+
+    @staticmethod
+    def _as_node(node):
+        if type(node) is bool:
+            return _VolumeNode(FullVolume() if node else EmptyVolume())
+        return node
+
+    @property
+    def n_channels(self):
+        """Number of distinct collectivevariable channels"""
+        return len(self._channels)
+
+    def __call__(self, snapshot):
+        if type(self._root) is bool:
+            return self._root
+        if self._incompatible:
+            return self.volume(snapshot)
+        try:
+            evaluation = _CompiledEvaluation(snapshot, single=True)
+            return bool(self._root.evaluate(evaluation))
+        except _IncompatibleValues:
+            self._incompatible = True
+            return self.volume(snapshot)
+
+    def mask(self, trajectory):
+        frames = _as_frames(trajectory)
+        if type(self._root) is bool:
+            return np.repeat(self._root, len(frames))
+        if len(frames) == 0:
+            return np.zeros(0, dtype=bool)
+        if self._incompatible:
+            return self.volume.mask(frames)
+        try:
+            evaluation = _CompiledEvaluation(frames, single=False)
+            return np.asarray(self._root.evaluate(evaluation), dtype=bool)
+        except _IncompatibleValues:
+            self._incompatible = True
+            return self.volume.mask(frames)
+
+    def __str__(self):
+        return str(self.volume)
+
 
 class VolumeFactory(object):
     @staticmethod